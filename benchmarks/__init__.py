@@ -0,0 +1,10 @@
+"""Benchmarks for essaybuddy, run against a local fake OpenAI endpoint.
+
+Run from the repository root::
+
+    python -m benchmarks --output bench.json
+    python -m benchmarks --output new.json --baseline bench.json
+
+See `python -m benchmarks --help` for the latency, token rate, streaming and
+concurrency settings.
+"""
@@ -0,0 +1,198 @@
+"""Run the benchmarks and save the results as JSON."""
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+# The app's modules import each other by their top-level names.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "essaybuddy"))
+
+from benchmarks import suite
+
+log = logging.getLogger(__name__)
+
+CASES = ("run_request", "llmlib_overhead", "startup", "message_words")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command-line arguments."""
+
+    _parser = argparse.ArgumentParser(description=__doc__)
+    _parser.add_argument("--output", type=Path, default=Path("bench.json"))
+    _parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="an earlier results file to compare against",
+    )
+    _parser.add_argument(
+        "--cases",
+        nargs="+",
+        choices=CASES,
+        default=list(CASES),
+    )
+    _parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 8, 64],
+    )
+    _parser.add_argument(
+        "--requests",
+        type=int,
+        default=64,
+        help="essays per concurrency level",
+    )
+    _parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        help="fake endpoint time to first byte",
+    )
+    _parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=0.0,
+        help="fake endpoint streaming pace; 0 for no pacing",
+    )
+    _parser.add_argument("--stream", action="store_true")
+    _parser.add_argument(
+        "--precheck",
+        action="store_true",
+        help="check evaluations locally instead of with the LLM",
+    )
+    _parser.add_argument("--iterations", type=int, default=1000)
+    _parser.add_argument("--repeats", type=int, default=5)
+    return _parser.parse_args(argv)
+
+
+def run_case(name: str, func: Callable[[], dict]) -> dict:
+    """Run one case, recording an error instead of stopping the suite."""
+
+    _msg = f"Running {name}"
+    log.info(_msg)
+    _start = time.perf_counter()
+    try:
+        _result = func()
+    except Exception as e:  # noqa: BLE001
+        _msg = f"{name} failed: {e!r}"
+        log.error(_msg)  # noqa: TRY400
+        _result = {"error": repr(e)}
+    _result["wall_seconds"] = round(time.perf_counter() - _start, 3)
+    return _result
+
+
+def git_commit() -> str | None:
+    """Return the current commit, if this is a git checkout."""
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S603, S607
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    """Return the numeric leaves of the results keyed by their dotted path."""
+
+    _flat = {}
+    for _key, _value in results.items():
+        _path = f"{prefix}{_key}"
+        if isinstance(_value, dict):
+            _flat.update(flatten(_value, f"{_path}."))
+        elif isinstance(_value, (int, float)) and not isinstance(_value, bool):
+            _flat[_path] = _value
+    return _flat
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    """Return one line per metric found in both runs, with the change."""
+
+    _new = flatten(results["results"])
+    _old = flatten(baseline["results"])
+    _lines = [f"Compared with {baseline.get('commit')}:"]
+    for _path in sorted(_new.keys() & _old.keys()):
+        if _path.endswith(("count", "concurrency", "wall_seconds", "words")):
+            continue
+        _change = (_new[_path] - _old[_path]) / _old[_path] if _old[_path] else 0.0
+        _lines.append(
+            f"  {_path}: {_old[_path]} -> {_new[_path]} ({_change:+.1%})",
+        )
+    return _lines
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the selected cases and write the results file."""
+
+    logging.basicConfig(level=logging.INFO)
+    for _logger_name in ("httpcore", "httpx", "openai", "essaylib", "llmlib"):
+        logging.getLogger(_logger_name).setLevel(logging.WARNING)
+
+    _args = parse_args(argv)
+
+    _results: dict = {}
+    if "run_request" in _args.cases:
+        _results["run_request"] = {
+            f"concurrency_{_level}": run_case(
+                f"run_request at concurrency {_level}",
+                lambda _level=_level: suite.bench_run_request(
+                    _level,
+                    _args.requests,
+                    _args.latency,
+                    _args.tokens_per_second,
+                    stream=_args.stream,
+                    precheck=_args.precheck,
+                ),
+            )
+            for _level in _args.concurrency
+        }
+    if "llmlib_overhead" in _args.cases:
+        _results["llmlib_overhead"] = run_case(
+            "llmlib overhead",
+            lambda: suite.bench_llmlib_overhead(_args.iterations),
+        )
+    if "startup" in _args.cases:
+        _results["startup"] = run_case(
+            "startup",
+            lambda: suite.bench_startup(_args.repeats),
+        )
+    if "message_words" in _args.cases:
+        _results["message_words"] = run_case(
+            "message_words",
+            lambda: suite.bench_message_words(_args.iterations),
+        )
+
+    _report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            _key: _value
+            for _key, _value in vars(_args).items()
+            if _key not in ("output", "baseline")
+        },
+        "results": _results,
+    }
+    _args.output.write_text(json.dumps(_report, indent=2))
+    _msg = f"Wrote {_args.output}"
+    log.info(_msg)
+
+    if _args.baseline is not None:
+        _baseline = json.loads(_args.baseline.read_text())
+        print("\n".join(compare(_report, _baseline)))  # noqa: T201
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+"""The benchmark cases.
+
+Each case returns a dict of plain values, so the results can be saved as
+JSON and compared between commits. Times are in seconds unless the key
+says otherwise.
+"""
+
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+from essaylib import EssayOptions, run_request, run_request_stream
+from fake_openai import DEFAULT_CRITIQUE, FakeOpenAIServer
+from llmlib import OpenAIConnection, request_completion
+from message_parser import estimate_tokens, message_words
+from openai.types.chat import ChatCompletion
+from precheck import Prechecker
+
+ESSAYBUDDY_DIR = Path(__file__).resolve().parent.parent / "essaybuddy"
+
+ESSAY_OPTIONS = EssayOptions(
+    author="College student",
+    audience="General audience",
+    essay_type="an English essay",
+    tone="Formal",
+)
+
+_VOCABULARY = (
+    "the essay argues that reading every day builds a habit of attention and "
+    "students who read widely write with more variety while teachers can help "
+    "by choosing texts that match the interests of the class because a good "
+    "example makes an abstract point concrete and memorable for the reader"
+).split()
+
+
+def sample_essay(words: int, seed: int = 0) -> str:
+    """Return a deterministic essay of about `words` words in paragraphs."""
+
+    # Seeded, so every run measures the same essay; nothing here is secret.
+    _random = random.Random(seed)  # noqa: S311
+    _paragraphs = []
+    _written = 0
+    while _written < words:
+        _sentences = []
+        for _ in range(_random.randint(3, 6)):
+            _length = _random.randint(8, 20)
+            _sentence = " ".join(_random.choice(_VOCABULARY) for _ in range(_length))
+            _sentences.append(_sentence.capitalize() + ".")
+            _written += _length
+        _paragraphs.append(" ".join(_sentences))
+    return "\n\n".join(_paragraphs)
+
+
+def summarize(latencies: list[float]) -> dict:
+    """Return the count, mean and percentiles of a list of latencies."""
+
+    _sorted = sorted(latencies)
+
+    def _percentile(q: float) -> float:
+        return _sorted[min(len(_sorted) - 1, int(q * len(_sorted)))]
+
+    return {
+        "count": len(_sorted),
+        "mean": round(statistics.fmean(_sorted), 6),
+        "p50": round(_percentile(0.5), 6),
+        "p95": round(_percentile(0.95), 6),
+        "p99": round(_percentile(0.99), 6),
+        "max": round(_sorted[-1], 6),
+    }
+
+
+def bench_run_request(  # noqa: PLR0913
+    concurrency: int,
+    requests: int,
+    latency: float,
+    tokens_per_second: float,
+    *,
+    stream: bool = False,
+    precheck: bool = False,
+) -> dict:
+    """Measure `run_request` end to end against the fake endpoint.
+
+    Parameters
+    ----------
+    concurrency : int
+        The number of threads submitting essays at once.
+    requests : int
+        The number of essays to evaluate.
+    latency : float
+        The fake endpoint's time to first byte.
+    tokens_per_second : float
+        The fake endpoint's streaming pace; 0 for no pacing.
+    stream : bool, optional
+        Use `run_request_stream` and consume every chunk.
+    precheck : bool, optional
+        Check evaluations locally, skipping the LLM completion check.
+
+    Returns
+    -------
+    dict
+        Latency percentiles per essay, essays per second, and the number of
+        requests the endpoint received.
+
+    """
+
+    _essays = [sample_essay(600, seed=_seed) for _seed in range(requests)]
+    _prechecker = Prechecker() if precheck else None
+
+    with FakeOpenAIServer(
+        latency=latency,
+        tokens_per_second=tokens_per_second,
+    ) as _server:
+        _oaiconn = OpenAIConnection(
+            "benchmark",
+            _server.url,
+            max_connections=max(concurrency, 1),
+            max_keepalive_connections=max(concurrency, 1),
+            max_concurrency=max(concurrency, 1),
+        )
+
+        def _evaluate(essay_text: str) -> float:
+            _start = time.perf_counter()
+            _options = {
+                "essay_options": ESSAY_OPTIONS,
+                "open_ai_key": "benchmark",
+                "model": "gpt-4o",
+                "oaiconn": _oaiconn,
+                "prechecker": _prechecker,
+            }
+            if stream:
+                for _ in run_request_stream(essay_text, **_options):
+                    pass
+            else:
+                run_request(essay_text, **_options)
+            return time.perf_counter() - _start
+
+        _start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as _pool:
+            _latencies = list(_pool.map(_evaluate, _essays))
+        _elapsed = time.perf_counter() - _start
+        _oaiconn.close()
+
+        return {
+            "concurrency": concurrency,
+            "stream": stream,
+            "latency": summarize(_latencies),
+            "essays_per_second": round(requests / _elapsed, 3),
+            "endpoint_requests": _server.requests,
+        }
+
+
+def bench_llmlib_overhead(iterations: int) -> dict:
+    """Measure the time `request_completion` adds around the network.
+
+    The client is replaced with one that returns a prepared completion at
+    once, so what is left is llmlib's own work: validation, sanitizing,
+    scheduling, retries, stats and metrics. For comparison, a round trip to
+    the fake endpoint over loopback is measured too.
+
+    """
+
+    _messages = [
+        {"role": "system", "content": "You are an editor."},
+        {"role": "user", "content": sample_essay(600)},
+    ]
+    _completion = ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": DEFAULT_CRITIQUE},
+                    "finish_reason": "stop",
+                },
+            ],
+            "usage": {
+                "prompt_tokens": 800,
+                "completion_tokens": 100,
+                "total_tokens": 900,
+            },
+        },
+    )
+
+    _oaiconn = OpenAIConnection("benchmark", "http://127.0.0.1:1/v1/")
+    _oaiconn._client = SimpleNamespace(  # noqa: SLF001
+        chat=SimpleNamespace(
+            completions=SimpleNamespace(create=lambda **_kwargs: _completion),
+        ),
+    )
+    _overhead = []
+    for _ in range(iterations):
+        _start = time.perf_counter()
+        request_completion(_oaiconn, _messages)
+        _overhead.append(time.perf_counter() - _start)
+
+    with FakeOpenAIServer() as _server:
+        _oaiconn = OpenAIConnection("benchmark", _server.url)
+        request_completion(_oaiconn, _messages)  # open the connection
+        _roundtrip = []
+        for _ in range(max(iterations // 10, 1)):
+            _start = time.perf_counter()
+            request_completion(_oaiconn, _messages)
+            _roundtrip.append(time.perf_counter() - _start)
+        _oaiconn.close()
+
+    return {
+        "overhead_us": {
+            _key: round(_value * 1e6, 1) if _key != "count" else _value
+            for _key, _value in summarize(_overhead).items()
+        },
+        "loopback_roundtrip": summarize(_roundtrip),
+    }
+
+
+def bench_startup(repeats: int) -> dict:
+    """Measure how long importing `main` takes in a fresh interpreter.
+
+    The bare interpreter start is measured too and subtracted, so the
+    result is the cost of the app's imports and module-level setup. The
+    "imports" entry profiles the cold start: the median time to import each
+    module that `main` imports directly, and everything it imports in turn,
+    from `python -X importtime`. A module another one already imported
+    shows with the one that imported it first.
+
+    """
+
+    _env = {**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "x")}
+
+    def _time(code: str) -> float:
+        _start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code],  # noqa: S603
+            cwd=ESSAYBUDDY_DIR,
+            env=_env,
+            check=True,
+            capture_output=True,
+        )
+        return time.perf_counter() - _start
+
+    def _import_times() -> dict[str, float]:
+        _stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],  # noqa: S603
+            cwd=ESSAYBUDDY_DIR,
+            env=_env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stderr
+        return parse_import_times(_stderr, depth=1)
+
+    _interpreter = [_time("pass") for _ in range(repeats)]
+    _main = [_time("import main") for _ in range(repeats)]
+    _profiles = [_import_times() for _ in range(repeats)]
+    _imports = {
+        _module: round(
+            statistics.median(_profile.get(_module, 0.0) for _profile in _profiles),
+            6,
+        )
+        for _module in set().union(*_profiles)
+    }
+    return {
+        "interpreter": summarize(_interpreter),
+        "import_main": summarize(_main),
+        "import_main_net": round(
+            statistics.median(_main) - statistics.median(_interpreter),
+            6,
+        ),
+        "imports": dict(sorted(_imports.items(), key=lambda _item: -_item[1])),
+    }
+
+
+def parse_import_times(report: str, depth: int = 0) -> dict[str, float]:
+    """Return the cumulative import seconds per module from `-X importtime`.
+
+    Only modules nested at most `depth` levels below a top-level import are
+    returned, e.g. depth 1 for `main` and the modules it imports itself.
+
+    """
+
+    _times = {}
+    for _line in report.splitlines():
+        if not _line.startswith("import time:") or "|" not in _line:
+            continue
+        _self, _cumulative, _name = _line[len("import time:") :].split("|")
+        if not _cumulative.strip().isdigit():
+            # The header line.
+            continue
+        _level = (len(_name) - len(_name.lstrip())) // 2
+        if _level <= depth:
+            _times[_name.strip()] = int(_cumulative) / 1e6
+    return _times
+
+
+def bench_message_words(iterations: int) -> dict:
+    """Measure `message_words`, and `estimate_tokens` for comparison."""
+
+    _results = {}
+    for _words in (100, 1000, 10000):
+        _text = sample_essay(_words)
+        _word_count = len(_text.split())
+        for _name, _func in (
+            ("message_words", message_words),
+            ("estimate_tokens", estimate_tokens),
+        ):
+            _func(_text)  # load any lazy data first
+            _times = []
+            for _ in range(max(iterations * 100 // _words, 3)):
+                _start = time.perf_counter()
+                _func(_text)
+                _times.append(time.perf_counter() - _start)
+            _median = statistics.median(_times)
+            _results[f"{_name}_{_words}"] = {
+                "words": _word_count,
+                "median": round(_median, 6),
+                "us_per_word": round(_median * 1e6 / _word_count, 3),
+            }
+    return _results
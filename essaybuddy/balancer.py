@@ -0,0 +1,474 @@
+import logging
+import threading
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, TypeVar
+
+from openai import APIConnectionError, APIStatusError
+
+if TYPE_CHECKING:
+    from llmlib import OpenAIConnection
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+STRATEGIES = ("least_outstanding", "ewma")
+
+
+@dataclass
+class _Endpoint:
+    """One connection in the pool and its routing state."""
+
+    connection: "OpenAIConnection"
+    outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    ejections: int = 0
+    # By stage, as a one-token check and a full evaluation take very
+    # different times.
+    ewma_latency: dict[str, float] = field(default_factory=dict)
+    ejected_until: float | None = None
+    probing: bool = False
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """Return True if `error` says the endpoint, not the request, is at fault.
+
+    Connection errors, timeouts, rate limits and server errors count against
+    the endpoint. Other errors, such as a bad request or a rejected
+    evaluation, would fail on any endpoint.
+
+    """
+
+    if isinstance(error, (APIConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500  # noqa: PLR2004
+    return False
+
+
+class EndpointPool:
+    """Spread requests over several OAI-compatible endpoints.
+
+    Each endpoint is an `OpenAIConnection` with its own key, rate limits and
+    token stats, so the pool's throughput is the sum of its endpoints'.
+    Requests are routed by one of two strategies:
+
+    - "least_outstanding" picks the endpoint with the fewest requests in
+      flight, then the one that has served the fewest.
+    - "ewma" picks the lowest exponentially weighted mean latency, scaled by
+      the requests in flight, so a slow endpoint gets less traffic. The mean
+      is kept for each stage, such as "completion" or "verdict", given by
+      the caller. An endpoint without a sample for the stage is scored with
+      the mean of the others; if none has one, by its requests in flight.
+
+    An endpoint that fails `max_failures` times in a row is ejected for
+    `eject_seconds`. After that it is health checked with a models request
+    in the background, and only routed to again once the check passes. A
+    request that fails on an endpoint is sent to the next healthy one.
+
+    Pass the pool wherever an `OpenAIConnection` is accepted.
+
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        connections: list["OpenAIConnection"],
+        strategy: str = "least_outstanding",
+        max_failures: int = 3,
+        eject_seconds: float = 30.0,
+        ewma_alpha: float = 0.3,
+        *,
+        failover: bool = True,
+    ) -> None:
+        """Initialize the EndpointPool class.
+
+        Parameters
+        ----------
+        connections : list of OpenAIConnection
+            The endpoints to route between.
+        strategy : str, optional
+            "least_outstanding" (the default) or "ewma".
+        max_failures : int, optional
+            The consecutive failures after which an endpoint is ejected.
+        eject_seconds : float, optional
+            How long an ejected endpoint waits before its health check.
+        ewma_alpha : float, optional
+            The weight of the newest latency in the moving average.
+        failover : bool, optional
+            If True, a request that fails on one endpoint is retried on the
+            next. Default is True.
+
+        Raises
+        ------
+        ValueError
+            If there are no connections or the strategy is unknown.
+
+        """
+
+        if not connections:
+            _msg = "An endpoint pool needs at least one connection"
+            log.error(_msg)
+            raise ValueError(_msg)
+
+        if strategy not in STRATEGIES:
+            _msg = (
+                f"Unknown routing strategy {strategy!r},"
+                f" expected one of {STRATEGIES}"
+            )
+            log.error(_msg)
+            raise ValueError(_msg)
+
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.ewma_alpha = ewma_alpha
+        self.failover = failover
+        self._endpoints = [_Endpoint(_connection) for _connection in connections]
+        self._lock = threading.Lock()
+
+    @property
+    def connections(self) -> list["OpenAIConnection"]:
+        """Return the connections in the pool."""
+
+        return [_endpoint.connection for _endpoint in self._endpoints]
+
+    @property
+    def api_key(self) -> str:
+        """Return the key of the first endpoint."""
+
+        return self._endpoints[0].connection.api_key
+
+    @property
+    def request_tokens(self) -> int:
+        """Return the request tokens used across all endpoints."""
+
+        return sum(_c.request_tokens for _c in self.connections)
+
+    @property
+    def response_tokens(self) -> int:
+        """Return the response tokens used across all endpoints."""
+
+        return sum(_c.response_tokens for _c in self.connections)
+
+    @property
+    def cached_tokens(self) -> int:
+        """Return the request tokens served from the endpoints' prompt caches."""
+
+        return sum(_c.cached_tokens for _c in self.connections)
+
+    @property
+    def truncated(self) -> int:
+        """Return the completions cut off by `max_tokens` across all endpoints."""
+
+        return sum(_c.truncated for _c in self.connections)
+
+    def stats(self) -> list[dict]:
+        """Return the routing and token stats of each endpoint."""
+
+        _now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "endpoint_url": _e.connection.endpoint_url,
+                    "healthy": _e.ejected_until is None,
+                    "outstanding": _e.outstanding,
+                    "requests": _e.requests,
+                    "failures": _e.failures,
+                    "ejections": _e.ejections,
+                    "ewma_latency": {
+                        _stage: round(_latency, 3)
+                        for _stage, _latency in _e.ewma_latency.items()
+                    },
+                    "ejected_for": None
+                    if _e.ejected_until is None
+                    else round(max(0.0, _e.ejected_until - _now), 1),
+                    "request_tokens": _e.connection.request_tokens,
+                    "response_tokens": _e.connection.response_tokens,
+                    "cached_tokens": _e.connection.cached_tokens,
+                    "truncated": _e.connection.truncated,
+                    "models": {
+                        _model: _stats.summary()
+                        for _model, _stats in _e.connection.model_stats.items()
+                    },
+                }
+                for _e in self._endpoints
+            ]
+
+    def warm_up(self) -> bool:
+        """Warm up every endpoint, ejecting those that do not answer.
+
+        Returns
+        -------
+        bool
+            True if at least one endpoint answered.
+
+        """
+
+        _healthy = False
+        for _endpoint in self._endpoints:
+            if _endpoint.connection.warm_up():
+                _healthy = True
+            else:
+                with self._lock:
+                    self._eject(_endpoint, time.monotonic())
+        return _healthy
+
+    def close(self) -> None:
+        """Close every endpoint's pooled client."""
+
+        for _connection in self.connections:
+            _connection.close()
+
+    def call(
+        self,
+        send: Callable[["OpenAIConnection"], T],
+        *,
+        stage: str = "request",
+    ) -> T:
+        """Call `send` with the best endpoint, failing over on errors.
+
+        Parameters
+        ----------
+        send : callable
+            Makes the request on the connection it is given.
+        stage : str, optional
+            The kind of request, whose latencies the "ewma" strategy keeps
+            apart from the others'. Default is "request".
+
+        Returns
+        -------
+        The result of `send`.
+
+        Raises
+        ------
+        Exception
+            The error of the last endpoint tried.
+
+        """
+
+        _tried: set[int] = set()
+        while True:
+            _endpoint = self._acquire(_tried, stage)
+            _start = time.monotonic()
+            try:
+                _result = send(_endpoint.connection)
+            except Exception as e:
+                if not self._release(
+                    _endpoint,
+                    _start,
+                    e,
+                    stage=stage,
+                ) or not self._can_failover(_endpoint, _tried):
+                    raise
+                continue
+            self._release(_endpoint, _start, None, stage=stage)
+            return _result
+
+    async def call_async(
+        self,
+        send: Callable[["OpenAIConnection"], Awaitable[T]],
+        *,
+        stage: str = "request",
+    ) -> T:
+        """Await `send` with the best endpoint, failing over on errors.
+
+        The async counterpart of `call`.
+
+        """
+
+        _tried: set[int] = set()
+        while True:
+            _endpoint = self._acquire(_tried, stage)
+            _start = time.monotonic()
+            try:
+                _result = await send(_endpoint.connection)
+            except Exception as e:
+                if not self._release(
+                    _endpoint,
+                    _start,
+                    e,
+                    stage=stage,
+                ) or not self._can_failover(_endpoint, _tried):
+                    raise
+                continue
+            self._release(_endpoint, _start, None, stage=stage)
+            return _result
+
+    def stream(
+        self,
+        send: Callable[["OpenAIConnection"], Iterator[T]],
+        *,
+        stage: str = "request",
+    ) -> Iterator[T]:
+        """Yield from `send` on the best endpoint.
+
+        A stream is not failed over, as part of it may have been shown
+        already. Its duration is not counted as latency of `stage`.
+
+        """
+
+        _endpoint = self._acquire(set(), stage)
+        _start = time.monotonic()
+        _error: Exception | None = None
+        try:
+            yield from send(_endpoint.connection)
+        except Exception as e:
+            _error = e
+            raise
+        finally:
+            self._release(_endpoint, _start, _error)
+
+    def _acquire(self, tried: set[int], stage: str | None) -> _Endpoint:
+        """Pick an endpoint for a request of `stage` and count it against it."""
+
+        _now = time.monotonic()
+        with self._lock:
+            _candidates = [
+                _e
+                for _e in self._endpoints
+                if id(_e) not in tried and self._is_available(_e, _now)
+            ]
+            if not _candidates:
+                # Everything is ejected: try the one that has been out the
+                # longest rather than fail outright.
+                _candidates = [
+                    min(
+                        (_e for _e in self._endpoints if id(_e) not in tried),
+                        key=lambda _e: _e.ejected_until or 0.0,
+                    ),
+                ]
+            _prior = self._prior_latency(stage)
+            _endpoint = min(
+                _candidates,
+                key=lambda _e: self._score(_e, stage, _prior),
+            )
+            _endpoint.outstanding += 1
+            _endpoint.requests += 1
+            return _endpoint
+
+    def _prior_latency(self, stage: str | None) -> float | None:
+        """Return the mean latency of the endpoints sampled for `stage`."""
+
+        _latencies = [
+            _e.ewma_latency[stage]
+            for _e in self._endpoints
+            if stage in _e.ewma_latency
+        ]
+        if not _latencies:
+            return None
+        return sum(_latencies) / len(_latencies)
+
+    def _score(
+        self,
+        endpoint: _Endpoint,
+        stage: str | None,
+        prior: float | None,
+    ) -> tuple:
+        """Return the sort key of an endpoint; the lowest is routed to.
+
+        With "ewma", an endpoint without a sample for `stage` counts as
+        having the `prior` latency; without a prior, the requests in flight
+        decide, as for "least_outstanding".
+
+        """
+
+        if self.strategy == "ewma" and stage is not None and prior is not None:
+            _latency = endpoint.ewma_latency.get(stage, prior)
+            return (_latency * (endpoint.outstanding + 1), endpoint.requests)
+        return (endpoint.outstanding, endpoint.requests)
+
+    def _is_available(self, endpoint: _Endpoint, now: float) -> bool:
+        """Return True if the endpoint may be routed to, starting its check."""
+
+        if endpoint.ejected_until is None:
+            return True
+
+        if now >= endpoint.ejected_until and not endpoint.probing:
+            endpoint.probing = True
+            threading.Thread(
+                target=self._health_check,
+                args=(endpoint,),
+                name="endpoint-health-check",
+                daemon=True,
+            ).start()
+        return False
+
+    def _health_check(self, endpoint: _Endpoint) -> None:
+        """Probe an ejected endpoint and restore it if it answers."""
+
+        _healthy = endpoint.connection.warm_up()
+        with self._lock:
+            endpoint.probing = False
+            if _healthy:
+                endpoint.ejected_until = None
+                endpoint.consecutive_failures = 0
+                _msg = f"Endpoint {endpoint.connection.endpoint_url} is healthy again."
+                log.info(_msg)
+            else:
+                self._eject(endpoint, time.monotonic())
+
+    def _release(
+        self,
+        endpoint: _Endpoint,
+        start: float,
+        error: BaseException | None,
+        *,
+        stage: str | None = None,
+    ) -> bool:
+        """Record the outcome of a request, and its latency under `stage`.
+
+        Returns
+        -------
+        bool
+            True if the request failed because of the endpoint.
+
+        """
+
+        _now = time.monotonic()
+        _failed = error is not None and is_endpoint_failure(error)
+        with self._lock:
+            endpoint.outstanding -= 1
+            if _failed:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.max_failures:
+                    self._eject(endpoint, _now)
+            elif error is None:
+                endpoint.consecutive_failures = 0
+                if stage is not None:
+                    _latency = _now - start
+                    _previous = endpoint.ewma_latency.get(stage)
+                    endpoint.ewma_latency[stage] = (
+                        _latency
+                        if _previous is None
+                        else self.ewma_alpha * _latency
+                        + (1 - self.ewma_alpha) * _previous
+                    )
+        return _failed
+
+    def _eject(self, endpoint: _Endpoint, now: float) -> None:
+        """Take an endpoint out of rotation. Call with the lock held."""
+
+        if endpoint.ejected_until is None:
+            endpoint.ejections += 1
+        endpoint.ejected_until = now + self.eject_seconds
+        _msg = (
+            f"Ejected endpoint {endpoint.connection.endpoint_url}"
+            f" for {self.eject_seconds}s."
+        )
+        log.warning(_msg)
+
+    def _can_failover(self, endpoint: _Endpoint, tried: set[int]) -> bool:
+        """Mark an endpoint as tried; return True if another one is left."""
+
+        tried.add(id(endpoint))
+        if not self.failover or len(tried) >= len(self._endpoints):
+            return False
+
+        _msg = f"Failing over from {endpoint.connection.endpoint_url}"
+        log.warning(_msg)
+        return True
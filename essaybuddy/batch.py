@@ -0,0 +1,462 @@
+r"""Evaluate a directory or manifest of essays from the command line.
+
+Usage::
+
+    OPENAI_API_KEY=<your api key> python batch.py essays/ \
+        --author "College student" --audience "General audience" \
+        --essay-type "an English essay" --tone Formal \
+        --output results.jsonl --workers 8
+
+Each result is written to the output file as one JSON line as soon as it
+completes. Re-running with the same output file skips the essays that
+already succeeded, so an interrupted run can be resumed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from balancer import EndpointPool
+from cache import ResponseCache
+from config import (
+    get_cassette,
+    get_chunk_settings,
+    get_config,
+    get_endpoint_pool,
+    get_model_router,
+    get_prechecker,
+    get_response_budget,
+    get_retry_policy,
+    get_scheduler,
+    get_settings,
+    validate_options,
+)
+from essaylib import EssayOptions, run_request
+from llmlib import DEFAULT_ENDPOINT_URL, OpenAIConnection, TokenUsage, get_connection
+from metrics import COALESCED, snapshot, to_prometheus
+
+log = logging.getLogger(__name__)
+
+ESSAY_SUFFIXES = (".md", ".txt")
+
+
+@dataclass
+class BatchItem:
+    """One essay to evaluate."""
+
+    item_id: str
+    essay_text: str
+    essay_options: EssayOptions
+
+
+def load_items(source: Path, defaults: dict) -> Iterator[BatchItem]:
+    """Load the essays to evaluate.
+
+    Parameters
+    ----------
+    source : pathlib.Path
+        Either a directory, whose .md and .txt files are evaluated in name
+        order, or a JSONL manifest. Each manifest line has an "id" (optional,
+        defaults to the path), a "path" relative to the manifest or an inline
+        "text", and optionally "author", "audience", "essay_type" and "tone"
+        overriding the defaults.
+    defaults : dict
+        The essay options used when the manifest does not set them.
+
+    Yields
+    ------
+    BatchItem
+        The essays in input order.
+
+    Raises
+    ------
+    ValueError
+        If a manifest line has neither "path" nor "text".
+
+    """
+
+    if source.is_dir():
+        for _path in sorted(source.iterdir()):
+            if _path.suffix not in ESSAY_SUFFIXES or not _path.is_file():
+                continue
+            yield BatchItem(
+                item_id=_path.name,
+                essay_text=_path.read_text(),
+                essay_options=EssayOptions(**defaults),
+            )
+        return
+
+    with source.open() as _manifest:
+        for _line_no, _line in enumerate(_manifest, start=1):
+            if not _line.strip():
+                continue
+            _entry = json.loads(_line)
+
+            if "text" in _entry:
+                _text = _entry["text"]
+            elif "path" in _entry:
+                _text = (source.parent / _entry["path"]).read_text()
+            else:
+                _msg = f"{source}:{_line_no}: entry needs a 'path' or 'text'"
+                log.error(_msg)
+                raise ValueError(_msg)
+
+            _options = {
+                _key: _entry.get(_key, defaults.get(_key))
+                for _key in ("author", "audience", "essay_type", "tone")
+            }
+            yield BatchItem(
+                item_id=str(_entry.get("id", _entry.get("path", _line_no))),
+                essay_text=_text,
+                essay_options=EssayOptions(**_options),
+            )
+
+
+def completed_ids(output: Path) -> set[str]:
+    """Return the ids that already succeeded in a previous run."""
+
+    if not output.is_file():
+        return set()
+
+    _done = set()
+    with output.open() as _results:
+        for _line in _results:
+            try:
+                _result = json.loads(_line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run.
+                continue
+            if _result.get("status") == "ok":
+                _done.add(_result["id"])
+    return _done
+
+
+def trim_partial_line(output: Path) -> None:
+    """Cut a line left unfinished by an interrupted run off the output.
+
+    Results are appended, so without this the first new result would be
+    written onto the end of the fragment and both would be unreadable.
+
+    """
+
+    if not output.is_file():
+        return
+
+    with output.open("rb+") as _results:
+        _end = _results.seek(0, os.SEEK_END)
+        _pos = _end
+        while _pos > 0:
+            _block = min(_pos, 4096)
+            _pos -= _block
+            _results.seek(_pos)
+            _newline = _results.read(_block).rfind(b"\n")
+            if _newline != -1:
+                _pos += _newline + 1
+                break
+        if _pos != _end:
+            _msg = f"{output}: dropping {_end - _pos} bytes of an unfinished line"
+            log.warning(_msg)
+            _results.truncate(_pos)
+
+
+def evaluate_item(
+    item: BatchItem,
+    oaiconn: OpenAIConnection | EndpointPool,
+    model: str,
+    **run_options: object,
+) -> dict:
+    """Evaluate one essay and return its JSONL record.
+
+    `run_options`, such as `cache` or `chunking`, are passed to run_request.
+
+    """
+
+    _usage = TokenUsage()
+    _start = time.perf_counter()
+    try:
+        _content = run_request(
+            item.essay_text,
+            essay_options=item.essay_options,
+            open_ai_key=oaiconn.api_key,
+            model=model,
+            oaiconn=oaiconn,
+            usage=_usage,
+            **run_options,
+        )
+    except Exception as e:  # noqa: BLE001
+        _msg = f"{item.item_id}: {e}"
+        log.error(_msg)  # noqa: TRY400
+        _status, _content, _error = "error", None, str(e)
+    else:
+        _status, _error = "ok", None
+
+    return {
+        "id": item.item_id,
+        "status": _status,
+        "options": dict(item.essay_options),
+        "model": model,
+        "evaluation": _content,
+        "error": _error,
+        "request_tokens": _usage.request_tokens,
+        "response_tokens": _usage.response_tokens,
+        "cached_tokens": _usage.cached_tokens,
+        "seconds": round(time.perf_counter() - _start, 3),
+    }
+
+
+def run_batch(
+    items: list[BatchItem],
+    output: Path,
+    oaiconn: OpenAIConnection | EndpointPool,
+    model: str,
+    workers: int,
+    **run_options: object,
+) -> dict:
+    """Evaluate items on a bounded worker pool, appending results to output.
+
+    `run_options`, such as `cache` or `chunking`, are passed to run_request.
+
+    Returns
+    -------
+    dict
+        Summary counts and throughput: essays per minute and tokens per
+        second over the wall time of the run.
+
+    """
+
+    _start = time.perf_counter()
+    _ok = _failed = _tokens = 0
+
+    trim_partial_line(output)
+    with ThreadPoolExecutor(max_workers=workers) as _pool, output.open(
+        "a",
+    ) as _results:
+        _futures: list[Future] = [
+            _pool.submit(evaluate_item, _item, oaiconn, model, **run_options)
+            for _item in items
+        ]
+        for _done, _future in enumerate(as_completed(_futures), start=1):
+            _result = _future.result()
+            _results.write(json.dumps(_result) + "\n")
+            _results.flush()
+
+            _tokens += _result["request_tokens"] + _result["response_tokens"]
+            if _result["status"] == "ok":
+                _ok += 1
+            else:
+                _failed += 1
+
+            _elapsed = time.perf_counter() - _start
+            _msg = (
+                f"[{_done}/{len(items)}] {_result['id']}: {_result['status']}"
+                f" ({_done / _elapsed * 60:.1f} essays/min)"
+            )
+            log.info(_msg)
+
+    _elapsed = time.perf_counter() - _start
+    return {
+        "ok": _ok,
+        "failed": _failed,
+        "seconds": round(_elapsed, 3),
+        "essays_per_minute": round((_ok + _failed) / _elapsed * 60, 2)
+        if _elapsed
+        else 0.0,
+        "tokens_per_second": round(_tokens / _elapsed, 2) if _elapsed else 0.0,
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command-line arguments."""
+
+    _parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _parser.add_argument(
+        "source",
+        type=Path,
+        help="a directory of .md/.txt essays or a JSONL manifest",
+    )
+    _parser.add_argument("--output", type=Path, default=Path("results.jsonl"))
+    _parser.add_argument("--author")
+    _parser.add_argument("--audience")
+    _parser.add_argument("--essay-type", dest="essay_type")
+    _parser.add_argument("--tone")
+    _parser.add_argument("--model", default="gpt-4o")
+    _parser.add_argument("--workers", type=int, default=8)
+    _parser.add_argument("--config", default="essaybuddy.toml")
+    _parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="evaluate every essay, even those already in the output",
+    )
+    _parser.add_argument("--no-cache", dest="use_cache", action="store_false")
+    _parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="ask for short reviews with the [budget.quick] token budget",
+    )
+    _parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="write stage metrics here: Prometheus text for .prom, else JSON",
+    )
+    return _parser.parse_args(argv)
+
+
+def load_valid_items(args: argparse.Namespace) -> list[BatchItem] | None:
+    """Load the essays to evaluate, or return None if any has bad options.
+
+    With `args.resume`, the essays that already succeeded in the output are
+    left out.
+
+    """
+
+    _config = get_config(args.config)
+    _defaults = {
+        "author": args.author,
+        "audience": args.audience,
+        "essay_type": args.essay_type,
+        "tone": args.tone,
+    }
+
+    _items = []
+    for _item in load_items(args.source, _defaults):
+        if None in _item.essay_options.values() or not validate_options(
+            _config,
+            _item.essay_options,
+        ):
+            _msg = f"{_item.item_id}: invalid options {dict(_item.essay_options)}"
+            log.error(_msg)
+            return None
+        _items.append(_item)
+
+    if args.resume:
+        _done = completed_ids(args.output)
+        _items = [_item for _item in _items if _item.item_id not in _done]
+        _msg = f"Resuming: {len(_done)} already done, {len(_items)} to go."
+        log.info(_msg)
+    return _items
+
+
+def connect(
+    args: argparse.Namespace,
+    open_ai_key: str,
+) -> OpenAIConnection | EndpointPool:
+    """Return the endpoint pool or connection configured for the run."""
+
+    _settings = get_settings("openai", args.config)
+    _settings.pop("warm_up", None)
+    _endpoint_url = _settings.pop("endpoint_url", DEFAULT_ENDPOINT_URL)
+    _settings["max_connections"] = max(
+        _settings.get("max_connections", 0),
+        args.workers,
+    )
+    return get_endpoint_pool(args.config) or get_connection(
+        open_ai_key,
+        _endpoint_url,
+        scheduler=get_scheduler(args.config),
+        retry=get_retry_policy(args.config),
+        cassette=get_cassette(args.config),
+        **_settings,
+    )
+
+
+def connection_summary(oaiconn: OpenAIConnection | EndpointPool) -> dict:
+    """Return the token counts and per-endpoint or per-model statistics."""
+
+    _summary: dict = {
+        "request_tokens": oaiconn.request_tokens,
+        "response_tokens": oaiconn.response_tokens,
+        "cached_tokens": oaiconn.cached_tokens,
+        "truncated": oaiconn.truncated,
+        # Essays identical to one being evaluated share its result.
+        "coalesced": COALESCED.value(role="joined"),
+    }
+    if isinstance(oaiconn, EndpointPool):
+        _summary["endpoints"] = oaiconn.stats()
+        return _summary
+
+    _summary["models"] = {
+        _model: _stats.summary() for _model, _stats in oaiconn.model_stats.items()
+    }
+    if oaiconn.scheduler is not None:
+        _summary["rate_limit_max_wait"] = round(oaiconn.scheduler.stats.max_wait, 3)
+    if oaiconn.retry is not None:
+        _summary["retries"] = oaiconn.retry.stats.retries
+        _summary["hedges_won"] = oaiconn.retry.stats.hedges_won
+    if oaiconn.cassette is not None:
+        _summary["cassette"] = asdict(oaiconn.cassette.stats)
+    return _summary
+
+
+def write_metrics(path: Path) -> None:
+    """Write the stage metrics: Prometheus text for .prom, else JSON."""
+
+    if path.suffix == ".prom":
+        path.write_text(to_prometheus())
+    else:
+        path.write_text(json.dumps(snapshot(), indent=2))
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the batch evaluation and return the process exit code."""
+
+    logging.basicConfig(level=logging.INFO)
+    for _logger_name in ("httpcore", "httpx", "openai"):
+        logging.getLogger(_logger_name).setLevel(logging.WARNING)
+
+    _args = parse_args(argv)
+
+    open_ai_key = os.getenv("OPENAI_API_KEY")
+    if open_ai_key is None:
+        _msg = "OPENAI_API_KEY environment variable not set"
+        log.error(_msg)
+        return 2
+
+    _items = load_valid_items(_args)
+    if _items is None:
+        return 2
+
+    _oaiconn = connect(_args, open_ai_key)
+
+    _cache = None
+    _cache_settings = get_settings("cache", _args.config)
+    if _args.use_cache and _cache_settings.pop("enabled", False):
+        _cache = ResponseCache(**_cache_settings)
+
+    _prechecker = get_prechecker(_args.config)
+    _router = get_model_router(_args.config)
+
+    _summary = run_batch(
+        _items,
+        _args.output,
+        _oaiconn,
+        _args.model,
+        _args.workers,
+        cache=_cache,
+        chunking=get_chunk_settings(_args.config),
+        prechecker=_prechecker,
+        budget=get_response_budget(_args.config, quick=_args.quick),
+        router=_router,
+    )
+    _summary.update(connection_summary(_oaiconn))
+    if _router is not None:
+        _summary["routing"] = _router.stats()
+    if _prechecker is not None:
+        _summary["llm_check_skip_rate"] = round(_prechecker.stats.skip_rate, 3)
+    print(json.dumps(_summary))  # noqa: T201
+
+    if _args.metrics is not None:
+        write_metrics(_args.metrics)
+
+    return 0 if _summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
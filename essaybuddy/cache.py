@@ -0,0 +1,330 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+    """Hit and miss counters for a ResponseCache."""
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        """Return the total number of hits across both tiers."""
+
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        """Return the fraction of lookups that were hits."""
+
+        _lookups = self.hits + self.misses
+        if _lookups == 0:
+            return 0.0
+        return self.hits / _lookups
+
+
+def make_key(
+    messages: list,
+    model: str,
+    prompt_version: str,
+    max_tokens: int | None = None,
+) -> str:
+    """Return the content address of a request.
+
+    Parameters
+    ----------
+    messages : list of dict
+        The rendered system and user messages.
+    model : str
+        The name of the model.
+    prompt_version : str
+        The version of the prompt templates, so a prompt change does not
+        serve stale evaluations.
+    max_tokens : int, optional
+        The reply limit, so a short reply is not served where a longer one
+        was allowed. Default is none.
+
+    Returns
+    -------
+    str
+        A hex SHA-256 digest.
+
+    """
+
+    _payload = json.dumps(
+        {
+            "messages": messages,
+            "model": model,
+            "prompt_version": prompt_version,
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(_payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """A two-tier cache of accepted evaluations.
+
+    The first tier is an in-memory LRU. The optional second tier is an SQLite
+    database that survives restarts; values are zlib-compressed and the least
+    recently used rows are evicted once the stored size exceeds the cap.
+    Entries older than `ttl_seconds` are treated as misses in both tiers.
+
+    The cache is thread-safe and meant to be shared by every session.
+
+    Attributes
+    ----------
+    stats : CacheStats
+        Hit, miss and eviction counters.
+
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        max_entries: int = 256,
+        db_path: str | None = None,
+        max_db_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: float = 7 * 24 * 3600,
+        compress_level: int = 6,
+    ) -> None:
+        """Initialize the ResponseCache class.
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            The number of entries kept in memory. Default is 256.
+        db_path : str, optional
+            The path to the SQLite database. Default is None, memory only.
+        max_db_bytes : int, optional
+            The cap on the compressed size of the stored values.
+        ttl_seconds : float, optional
+            How long an entry stays valid. Default is one week.
+        compress_level : int, optional
+            The zlib compression level for the SQLite tier. Default is 6.
+
+        """
+
+        self.max_entries = max_entries
+        self.max_db_bytes = max_db_bytes
+        self.ttl_seconds = ttl_seconds
+        self.compress_level = compress_level
+        self.stats = CacheStats()
+
+        self._memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+        if db_path is not None:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL)",
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed"
+                " ON responses (accessed)",
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> str | None:
+        """Return the cached value for `key`, or None on a miss."""
+
+        _now = time.time()
+        with self._lock:
+            _entry = self._memory.get(key)
+            if _entry is not None:
+                _created, _value = _entry
+                if _now - _created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    return _value
+                del self._memory[key]
+
+            _value = self._db_get(key, _now)
+            if _value is None:
+                self.stats.misses += 1
+                return None
+
+            self.stats.disk_hits += 1
+            self._memory_put(key, _value, _now)
+            return _value
+
+    def put(self, key: str, value: str) -> None:
+        """Store `value` under `key` in both tiers."""
+
+        _now = time.time()
+        with self._lock:
+            self.stats.stores += 1
+            self._memory_put(key, value, _now)
+            self._db_put(key, value, _now)
+
+    def clear(self) -> None:
+        """Remove every entry from both tiers."""
+
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def _memory_put(self, key: str, value: str, now: float) -> None:
+        """Insert into the LRU, evicting the oldest entries over the cap."""
+
+        self._memory[key] = (now, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    def _db_get(self, key: str, now: float) -> str | None:
+        """Read a value from the SQLite tier."""
+
+        if self._db is None:
+            return None
+
+        _row = self._db.execute(
+            "SELECT value, created FROM responses WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if _row is None:
+            return None
+
+        _blob, _created = _row
+        if now - _created > self.ttl_seconds:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+
+        self._db.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?",
+            (now, key),
+        )
+        self._db.commit()
+        return zlib.decompress(_blob).decode("utf-8")
+
+    def _db_put(self, key: str, value: str, now: float) -> None:
+        """Write a value to the SQLite tier and enforce the size cap."""
+
+        if self._db is None:
+            return
+
+        _blob = zlib.compress(value.encode("utf-8"), self.compress_level)
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses"
+            " (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, _blob, len(_blob), now, now),
+        )
+
+        _total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses",
+        ).fetchone()[0]
+        while _total > self.max_db_bytes:
+            _row = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 1",
+            ).fetchone()
+            if _row is None:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (_row[0],))
+            _total -= _row[1]
+            self.stats.evictions += 1
+
+        self._db.commit()
+
+
+class SessionResults:
+    """The latest evaluations of one session, bounded by count and size.
+
+    Kept in a Streamlit session's `st.session_state`, so reruns, such as a
+    click on Save, show the evaluations again without a request, and they
+    are freed with the session. The least recently shown are evicted once
+    there are more than `max_entries`, or their text is over `max_bytes`.
+    Only one session's script thread uses it, so it takes no lock.
+
+    """
+
+    def __init__(self, max_entries: int = 8, max_bytes: int = 1024 * 1024) -> None:
+        """Initialize the SessionResults class.
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            The number of evaluations kept. Default is 8.
+        max_bytes : int, optional
+            The cap on the UTF-8 size of the evaluations kept. Default is
+            1 MiB.
+
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._results: OrderedDict[str, str] = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        """Return the number of evaluations kept."""
+
+        return len(self._results)
+
+    @property
+    def size(self) -> int:
+        """Return the UTF-8 size of the evaluations kept."""
+
+        return self._bytes
+
+    def get(self, key: str) -> str | None:
+        """Return the evaluation for `key`, or None if it is not kept."""
+
+        _value = self._results.get(key)
+        if _value is not None:
+            self._results.move_to_end(key)
+        return _value
+
+    def put(self, key: str, value: str) -> None:
+        """Keep `value` under `key`, evicting the least recently shown."""
+
+        self.discard(key)
+        self._results[key] = value
+        self._bytes += len(value.encode("utf-8"))
+        # The newest one is kept even if it is over the cap on its own.
+        while len(self._results) > 1 and (
+            len(self._results) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _key, _value = self._results.popitem(last=False)
+            self._bytes -= len(_value.encode("utf-8"))
+            self.evictions += 1
+
+    def discard(self, key: str) -> None:
+        """Forget the evaluation for `key`, if it is kept."""
+
+        _value = self._results.pop(key, None)
+        if _value is not None:
+            self._bytes -= len(_value.encode("utf-8"))
+
+    def clear(self) -> None:
+        """Forget every evaluation."""
+
+        self._results.clear()
+        self._bytes = 0
@@ -0,0 +1,483 @@
+r"""Record and replay the HTTP traffic of an OpenAIConnection.
+
+A cassette sits under the OpenAI client as its httpx transport. In record
+mode every exchange with the real endpoint is passed through and saved:
+status, headers, the time to the response headers, and every body chunk
+with its arrival time, so streamed completions and their usage chunk are
+kept as they came. In replay mode no request leaves the process; the
+recorded response is served with the original timing, scaled by
+`timing_scale`.
+
+The file is one line per exchange, ``<key>\t<json>``, where the key is a
+hash of the request. The body chunks are zlib-compressed. Opening a
+cassette only reads the keys and the offsets of their lines, so a lookup is
+one dict access and one seek however many exchanges are recorded.
+"""
+
+import asyncio
+import base64
+import contextlib
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+MODES = ("record", "replay")
+
+# The response headers worth keeping; the rest describe the original
+# connection, not the reply.
+_KEPT_HEADERS = (
+    "content-type",
+    "content-encoding",
+    "retry-after",
+    "retry-after-ms",
+)
+
+
+def request_key(request: httpx.Request) -> str:
+    """Return the hash that identifies a request in a cassette.
+
+    It covers the method, the path and the JSON body with its keys sorted,
+    so the model, the messages and options such as `stream` all count. The
+    host and the headers, including the API key, do not.
+
+    """
+
+    _body = request.read()
+    with contextlib.suppress(ValueError):
+        _body = json.dumps(json.loads(_body), sort_keys=True).encode()
+    _digest = hashlib.sha256()
+    _digest.update(request.method.encode())
+    _digest.update(b" ")
+    _digest.update(request.url.path.encode())
+    _digest.update(b"\n")
+    _digest.update(_body)
+    return _digest.hexdigest()
+
+
+@dataclass
+class Recording:
+    """One recorded exchange."""
+
+    status: int
+    headers: dict[str, str]
+    ttfb: float
+    chunks: list[bytes] = field(default_factory=list)
+    offsets: list[float] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        """Return the recording as one compact line of JSON."""
+
+        return json.dumps(
+            {
+                "status": self.status,
+                "headers": self.headers,
+                "ttfb": round(self.ttfb, 4),
+                "offsets": [round(_offset, 4) for _offset in self.offsets],
+                "sizes": [len(_chunk) for _chunk in self.chunks],
+                "body": base64.b64encode(zlib.compress(b"".join(self.chunks))).decode(),
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, line: str) -> "Recording":
+        """Rebuild a recording from its line of JSON."""
+
+        _data = json.loads(line)
+        _body = zlib.decompress(base64.b64decode(_data["body"]))
+        _chunks = []
+        _start = 0
+        for _size in _data["sizes"]:
+            _chunks.append(_body[_start : _start + _size])
+            _start += _size
+        return cls(
+            status=_data["status"],
+            headers=_data["headers"],
+            ttfb=_data["ttfb"],
+            chunks=_chunks,
+            offsets=_data["offsets"],
+        )
+
+
+@dataclass
+class CassetteStats:
+    """Counts of recorded and replayed exchanges."""
+
+    recorded: int = 0
+    replayed: int = 0
+    misses: int = 0
+
+
+class Cassette:
+    """A file of recorded exchanges, and the transports that use it.
+
+    Attributes
+    ----------
+    stats : CassetteStats
+        How many exchanges were recorded, replayed and not found.
+
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        mode: str = "replay",
+        timing_scale: float = 1.0,
+    ) -> None:
+        """Initialize the Cassette class.
+
+        Parameters
+        ----------
+        path : str or pathlib.Path
+            The cassette file. Record mode appends to it.
+        mode : str, optional
+            "record" or "replay". Default is "replay".
+        timing_scale : float, optional
+            Multiplies the recorded delays when replaying: 1 is the original
+            timing, 0.5 twice as fast, 0 no delay. Default is 1.
+
+        Raises
+        ------
+        ValueError
+            If the mode is unknown, or replay mode has no file to read.
+
+        """
+
+        if mode not in MODES:
+            _msg = f"Unknown cassette mode {mode!r}, expected one of {MODES}"
+            log.error(_msg)
+            raise ValueError(_msg)
+
+        self.path = Path(path)
+        self.mode = mode
+        self.timing_scale = timing_scale
+        self.stats = CassetteStats()
+        self._index: dict[str, list[int]] = {}
+        self._turns: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        if mode == "replay" and not self.path.is_file():
+            _msg = f"Cassette {self.path} not found"
+            log.error(_msg)
+            raise ValueError(_msg)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch()
+        self._build_index()
+
+    def __len__(self) -> int:
+        """Return the number of recorded exchanges."""
+
+        with self._lock:
+            return sum(len(_offsets) for _offsets in self._index.values())
+
+    def _build_index(self) -> None:
+        """Read the key and offset of every line."""
+
+        with self.path.open("rb") as _file:
+            _offset = 0
+            for _line in _file:
+                _key, _, _ = _line.partition(b"\t")
+                self._index.setdefault(_key.decode(), []).append(_offset)
+                _offset += len(_line)
+
+    def transport(self, limits: httpx.Limits | None = None) -> httpx.BaseTransport:
+        """Return a transport for a sync client.
+
+        In record mode it wraps a real transport with these pool `limits`.
+
+        """
+
+        if self.mode == "record":
+            return _RecordingTransport(
+                self,
+                httpx.HTTPTransport(limits=limits or httpx.Limits()),
+            )
+        return _ReplayTransport(self)
+
+    def async_transport(
+        self,
+        limits: httpx.Limits | None = None,
+    ) -> httpx.AsyncBaseTransport:
+        """Return a transport for an async client; see `transport`."""
+
+        if self.mode == "record":
+            return _AsyncRecordingTransport(
+                self,
+                httpx.AsyncHTTPTransport(limits=limits or httpx.Limits()),
+            )
+        return _AsyncReplayTransport(self)
+
+    def save(self, key: str, recording: Recording) -> None:
+        """Append a recording to the file and the index."""
+
+        _line = f"{key}\t{recording.to_json()}\n".encode()
+        with self._lock, self.path.open("ab") as _file:
+            _offset = _file.tell()
+            _file.write(_line)
+            self._index.setdefault(key, []).append(_offset)
+            self.stats.recorded += 1
+
+    def find(self, key: str) -> Recording | None:
+        """Return a recording of the request with this key, if any.
+
+        When a request was recorded more than once, the recordings are
+        served in turn.
+
+        """
+
+        with self._lock:
+            _offsets = self._index.get(key)
+            if not _offsets:
+                self.stats.misses += 1
+                return None
+            _turn = self._turns.get(key, 0)
+            self._turns[key] = _turn + 1
+            _offset = _offsets[_turn % len(_offsets)]
+            self.stats.replayed += 1
+
+        with self.path.open("rb") as _file:
+            _file.seek(_offset)
+            _line = _file.readline()
+        return Recording.from_json(_line.decode().partition("\t")[2])
+
+    def miss_response(self, request: httpx.Request) -> httpx.Response:
+        """Return the response for a request that was not recorded."""
+
+        _msg = f"No recording of {request.method} {request.url.path} in {self.path}"
+        log.error(_msg)
+        return httpx.Response(
+            404,
+            json={"error": {"message": _msg, "type": "cassette_miss"}},
+            request=request,
+        )
+
+
+def _kept_headers(response: httpx.Response) -> dict[str, str]:
+    """Return the headers to save from a response."""
+
+    return {
+        _name: response.headers[_name]
+        for _name in _KEPT_HEADERS
+        if _name in response.headers
+    }
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    """Pass a response body through, saving it once it has been read."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        cassette: Cassette,
+        key: str,
+        response: httpx.Response,
+        recording: Recording,
+        start: float,
+    ) -> None:
+        self._cassette = cassette
+        self._key = key
+        self._response = response
+        self._recording = recording
+        self._start = start
+
+    def __iter__(self) -> Iterator[bytes]:
+        for _chunk in self._response.stream:
+            self._recording.chunks.append(_chunk)
+            self._recording.offsets.append(time.monotonic() - self._start)
+            yield _chunk
+        self._cassette.save(self._key, self._recording)
+
+    def close(self) -> None:
+        self._response.close()
+
+
+class _RecordingTransport(httpx.BaseTransport):
+    """Send requests to the endpoint and record the exchanges."""
+
+    def __init__(self, cassette: Cassette, transport: httpx.BaseTransport) -> None:
+        self._cassette = cassette
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        _key = request_key(request)
+        _start = time.monotonic()
+        _response = self._transport.handle_request(request)
+        _recording = Recording(
+            status=_response.status_code,
+            headers=_kept_headers(_response),
+            ttfb=time.monotonic() - _start,
+        )
+        return httpx.Response(
+            status_code=_response.status_code,
+            headers=_response.headers,
+            stream=_RecordingStream(
+                self._cassette,
+                _key,
+                _response,
+                _recording,
+                _start,
+            ),
+            extensions=_response.extensions,
+        )
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    """Yield recorded chunks at their recorded times."""
+
+    def __init__(self, recording: Recording, start: float, scale: float) -> None:
+        self._recording = recording
+        self._start = start
+        self._scale = scale
+
+    def __iter__(self) -> Iterator[bytes]:
+        for _chunk, _offset in zip(
+            self._recording.chunks,
+            self._recording.offsets,
+            strict=True,
+        ):
+            _wait = self._start + _offset * self._scale - time.monotonic()
+            if _wait > 0:
+                time.sleep(_wait)
+            yield _chunk
+
+
+class _ReplayTransport(httpx.BaseTransport):
+    """Answer requests from the cassette."""
+
+    def __init__(self, cassette: Cassette) -> None:
+        self._cassette = cassette
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        _start = time.monotonic()
+        _recording = self._cassette.find(request_key(request))
+        if _recording is None:
+            return self._cassette.miss_response(request)
+
+        _scale = self._cassette.timing_scale
+        time.sleep(_recording.ttfb * _scale)
+        return httpx.Response(
+            status_code=_recording.status,
+            headers=_recording.headers,
+            stream=_ReplayStream(_recording, _start, _scale),
+            request=request,
+        )
+
+
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    """The async `_RecordingStream`."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        cassette: Cassette,
+        key: str,
+        response: httpx.Response,
+        recording: Recording,
+        start: float,
+    ) -> None:
+        self._cassette = cassette
+        self._key = key
+        self._response = response
+        self._recording = recording
+        self._start = start
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for _chunk in self._response.stream:
+            self._recording.chunks.append(_chunk)
+            self._recording.offsets.append(time.monotonic() - self._start)
+            yield _chunk
+        self._cassette.save(self._key, self._recording)
+
+    async def aclose(self) -> None:
+        await self._response.aclose()
+
+
+class _AsyncRecordingTransport(httpx.AsyncBaseTransport):
+    """The async `_RecordingTransport`."""
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        transport: httpx.AsyncBaseTransport,
+    ) -> None:
+        self._cassette = cassette
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        _key = request_key(request)
+        _start = time.monotonic()
+        _response = await self._transport.handle_async_request(request)
+        _recording = Recording(
+            status=_response.status_code,
+            headers=_kept_headers(_response),
+            ttfb=time.monotonic() - _start,
+        )
+        return httpx.Response(
+            status_code=_response.status_code,
+            headers=_response.headers,
+            stream=_AsyncRecordingStream(
+                self._cassette,
+                _key,
+                _response,
+                _recording,
+                _start,
+            ),
+            extensions=_response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    """The async `_ReplayStream`."""
+
+    def __init__(self, recording: Recording, start: float, scale: float) -> None:
+        self._recording = recording
+        self._start = start
+        self._scale = scale
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for _chunk, _offset in zip(
+            self._recording.chunks,
+            self._recording.offsets,
+            strict=True,
+        ):
+            _wait = self._start + _offset * self._scale - time.monotonic()
+            if _wait > 0:
+                await asyncio.sleep(_wait)
+            yield _chunk
+
+
+class _AsyncReplayTransport(httpx.AsyncBaseTransport):
+    """The async `_ReplayTransport`."""
+
+    def __init__(self, cassette: Cassette) -> None:
+        self._cassette = cassette
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        _start = time.monotonic()
+        _recording = self._cassette.find(request_key(request))
+        if _recording is None:
+            return self._cassette.miss_response(request)
+
+        _scale = self._cassette.timing_scale
+        await asyncio.sleep(_recording.ttfb * _scale)
+        return httpx.Response(
+            status_code=_recording.status,
+            headers=_recording.headers,
+            stream=_AsyncReplayStream(_recording, _start, _scale),
+            request=request,
+        )
@@ -0,0 +1,408 @@
+import copy
+import functools
+import logging
+import os
+
+import tomlkit
+from balancer import EndpointPool
+from cassette import Cassette
+from essaylib import ChunkSettings, EssayOptions, ResponseBudget
+from jobs import JobRunner
+from llmlib import get_connection
+from metrics import timed
+from precheck import Prechecker
+from retry import RetryPolicy
+from routing import STAGES, ModelRouter, Route
+from scheduler import RequestScheduler
+from store import EssayStore, StoreWriter, get_store
+
+log = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_config(config_file: str) -> dict:
+    """Parse a TOML file once, as plain Python values.
+
+    Every getter reads the file, so later calls reuse the first parse; an
+    edit takes effect on restart. The getters return copies, since callers
+    change them, e.g. pop "enabled".
+
+    """
+    with open(config_file) as _toml:
+        return tomlkit.load(_toml).unwrap()
+
+
+@timed("get_config")
+def get_config(config_file: str = "essaybuddy.toml") -> dict:
+    """Load and validate the configuration from a TOML file.
+
+    Parameters
+    ----------
+    config_file : str, optional
+        The path to the TOML configuration file. Default is "essaybuddy.toml".
+
+    Returns
+    -------
+    dict
+        A dictionary containing the validated configuration options.
+
+    Raises
+    ------
+    ValueError
+        If the required configuration options are not found in the TOML file.
+
+    Notes
+    -----
+    This function performs the following steps:
+    1. Load the configuration from the specified TOML file, parsed once.
+    2. Check if the "prompt_options" section exists in the configuration.
+    3. Validate and extract the "authors", "audiences", "essay_types", and "essay_tones"
+    4. Return a dictionary containing the validated configuration options.
+
+    """
+    _config = _load_config(config_file)
+
+    if not _config.get("prompt", {}).get("options"):
+        _msg = f"[prompt.options] not found in {config_file}"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+    _prompt_options = _config["prompt"]["options"]
+
+    # "I am a..."
+    if not _prompt_options.get("authors"):
+        _msg = f"authors not found in {config_file}"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+    _author_options = _prompt_options["authors"]
+
+    # "I am writing for..."
+    if not _prompt_options.get("audiences"):
+        _msg = f"audiences not found in {config_file}"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+    _audience_options = _prompt_options["audiences"]
+
+    # "I am writing..."
+    if not _prompt_options.get("essay_types"):
+        _msg = f"essay_types not found in {config_file}"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+    _type_options = _prompt_options["essay_types"]
+
+    # "The tone should be..."
+    if not _prompt_options.get("essay_tones"):
+        _msg = f"essay_tones not found in {config_file}"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+    _tone_options = _prompt_options["essay_tones"]
+
+    return copy.deepcopy(
+        {
+            "author_options": _author_options,
+            "audience_options": _audience_options,
+            "type_options": _type_options,
+            "tone_options": _tone_options,
+        },
+    )
+
+
+def get_settings(section: str, config_file: str = "essaybuddy.toml") -> dict:
+    """Load an optional settings table from a TOML file.
+
+    Parameters
+    ----------
+    section : str
+        The name of the top-level table, e.g. "openai".
+    config_file : str, optional
+        The path to the TOML configuration file. Default is "essaybuddy.toml".
+
+    Returns
+    -------
+    dict
+        A copy of the table as plain Python values, or an empty dict if it is
+        missing.
+
+    """
+    _section = _load_config(config_file).get(section)
+    if _section is None:
+        return {}
+
+    return copy.deepcopy(_section)
+
+
+def validate_options(config_options: dict, essay_options: EssayOptions) -> bool:
+    """Validate the essay options.
+
+    The reason for the dropdowns is to limit opportunities for injection.
+    This won't work very well if they bypass the dropdown via curl, or something.
+    1. Check that the author is in the list of valid authors.
+    2. Check that the audience is in the list of valid audiences.
+    3. Check that the essay type is in the list of valid essay types.
+    4. Check that the tone is in the list of valid tones.
+
+    """
+
+    # Check that the author is in the list of valid authors.
+    if essay_options["author"] not in config_options["author_options"]:
+        return False
+
+    # Check that the audience is in the list of valid audiences.
+    if essay_options["audience"] not in config_options["audience_options"]:
+        return False
+
+    # Check that the essay type is in the list of valid essay types.
+    if essay_options["essay_type"] not in config_options["type_options"]:
+        return False
+
+    # Check that the tone is in the list of valid tones.
+    if essay_options["tone"] not in config_options["tone_options"]:
+        return False
+
+    return True
+
+
+def get_chunk_settings(config_file: str = "essaybuddy.toml") -> ChunkSettings | None:
+    """Return the settings for evaluating long essays in parts.
+
+    Configured by the [chunking] table; returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("chunking", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    return ChunkSettings(**_settings)
+
+
+def get_incremental_settings(
+    config_file: str = "essaybuddy.toml",
+) -> ChunkSettings | None:
+    """Return the part settings for incremental re-evaluation.
+
+    Configured by the [incremental] table, which takes the same keys as
+    [chunking] but usually smaller parts. Returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("incremental", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    return ChunkSettings(**_settings)
+
+
+def get_response_budget(
+    config_file: str = "essaybuddy.toml",
+    *,
+    quick: bool = False,
+) -> ResponseBudget | None:
+    """Return the reply token budget for evaluations.
+
+    Configured by the [budget] table; returns None if it is disabled. With
+    `quick`, the keys of [budget.quick] override the others for a quick
+    review.
+
+    """
+
+    _settings = get_settings("budget", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    _quick = _settings.pop("quick", {})
+    if quick:
+        _settings.update(_quick, quick=True)
+
+    return ResponseBudget(**_settings)
+
+
+def get_model_router(config_file: str = "essaybuddy.toml") -> ModelRouter | None:
+    """Return the router that picks the model for each stage of a request.
+
+    Configured by the [routing] table and its [[routing.evaluate]] and
+    [[routing.check]] routes; returns None if it is disabled, and every
+    request goes to the app's model.
+
+    """
+
+    _settings = get_settings("routing", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    _routes = {
+        _stage: [Route(**_route) for _route in _settings.pop(_stage, [])]
+        for _stage in STAGES
+    }
+    return ModelRouter(_routes, **_settings)
+
+
+def get_prechecker(config_file: str = "essaybuddy.toml") -> Prechecker | None:
+    """Return the local pre-check for evaluations.
+
+    Configured by the [precheck] table; returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("precheck", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    return Prechecker(**_settings)
+
+
+def get_scheduler(config_file: str = "essaybuddy.toml") -> RequestScheduler | None:
+    """Return a rate-limit scheduler for the endpoint.
+
+    Configured by the [ratelimit] table; returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("ratelimit", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    return RequestScheduler(**_settings)
+
+
+def get_retry_policy(config_file: str = "essaybuddy.toml") -> RetryPolicy | None:
+    """Return the retry and hedging policy for requests to the endpoint.
+
+    Configured by the [retry] table; returns None if it is disabled, and the
+    OpenAI client's own retries are used instead.
+
+    """
+
+    _settings = get_settings("retry", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    if "retry_statuses" in _settings:
+        _settings["retry_statuses"] = tuple(_settings["retry_statuses"])
+
+    return RetryPolicy(**_settings)
+
+
+def get_endpoint_pool(config_file: str = "essaybuddy.toml") -> EndpointPool | None:
+    """Return a pool of endpoints to spread requests over.
+
+    Configured by the [balancer] table and its [[balancer.endpoints]]; returns
+    None if it is disabled. Each endpoint has an `endpoint_url` and the
+    `api_key_env` variable holding its key, and may override the [openai]
+    pool options and the [ratelimit] limits for itself.
+
+    Raises
+    ------
+    ValueError
+        If the pool has no endpoints, or an endpoint's key is not set.
+
+    """
+
+    _settings = get_settings("balancer", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    _endpoints = _settings.pop("endpoints", [])
+    if not _endpoints:
+        _msg = f"[[balancer.endpoints]] not found in {config_file}"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+    _pool_options = get_settings("openai", config_file)
+    _pool_options.pop("warm_up", None)
+    _pool_options.pop("endpoint_url", None)
+    _ratelimit = get_settings("ratelimit", config_file)
+    _ratelimit_enabled = _ratelimit.pop("enabled", False)
+    _retry = get_retry_policy(config_file)
+    _cassette = get_cassette(config_file)
+
+    _connections = []
+    for _endpoint in _endpoints:
+        _options = dict(_endpoint)
+        _endpoint_url = _options.pop("endpoint_url")
+        _api_key_env = _options.pop("api_key_env", "OPENAI_API_KEY")
+        _api_key = os.getenv(_api_key_env)
+        if _api_key is None:
+            _msg = f"{_api_key_env} not set for endpoint {_endpoint_url}"
+            log.error(_msg)
+            raise ValueError(_msg)
+
+        # Each key has its own limits, so each endpoint gets its own queue.
+        _limits = {
+            _name: _options.pop(_name)
+            for _name in ("requests_per_minute", "tokens_per_minute")
+            if _name in _options
+        }
+        _scheduler = None
+        if _ratelimit_enabled or _limits:
+            _scheduler = RequestScheduler(**{**_ratelimit, **_limits})
+
+        _connections.append(
+            get_connection(
+                _api_key,
+                _endpoint_url,
+                scheduler=_scheduler,
+                retry=_retry,
+                cassette=_cassette,
+                **{**_pool_options, **_options},
+            ),
+        )
+
+    return EndpointPool(_connections, **_settings)
+
+
+def get_cassette(config_file: str = "essaybuddy.toml") -> Cassette | None:
+    """Return the cassette that records or replays the endpoint traffic.
+
+    Configured by the [cassette] table; returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("cassette", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    return Cassette(**_settings)
+
+
+def get_essay_store(config_file: str = "essaybuddy.toml") -> EssayStore:
+    """Return the store that keeps every user's essays and their history.
+
+    Configured by the [store] table.
+
+    """
+
+    return get_store(**get_settings("store", config_file))
+
+
+def get_store_writer(
+    store: EssayStore,
+    config_file: str = "essaybuddy.toml",
+) -> StoreWriter | None:
+    """Return the background writer for essay saves.
+
+    Configured by the [autosave] table; returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("autosave", config_file)
+    if not _settings.pop("enabled", False):
+        return None
+
+    return StoreWriter(store, **_settings)
+
+
+def get_job_runner(config_file: str = "essaybuddy.toml") -> JobRunner:
+    """Return the worker pool that runs evaluations in the background.
+
+    Configured by the [jobs] table.
+
+    """
+
+    _settings = get_settings("jobs", config_file)
+    _settings.pop("poll_seconds", None)
+    return JobRunner(**_settings)
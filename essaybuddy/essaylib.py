@@ -1,13 +1,52 @@
+import asyncio
+import contextvars
+import itertools
+import json
 import logging
+import threading
+from collections.abc import Awaitable, Callable, Iterator
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    ThreadPoolExecutor,
+)
+from dataclasses import dataclass, field
 from pathlib import Path
 from string import Template
-from typing import TypedDict
+from typing import TypedDict, TypeVar
 
-from llmlib import OpenAIConnection, check_completion, request_completion
-from prompts.essay import prompt_msg, system_msg
+from balancer import EndpointPool
+from cache import ResponseCache, make_key
+from llmlib import (
+    DEFAULT_ENDPOINT_URL,
+    OpenAIConnection,
+    TokenUsage,
+    check_completion,
+    check_completion_async,
+    get_connection,
+    request_completion,
+    request_completion_async,
+)
+from message_parser import (
+    estimate_tokens,
+    paragraph_hash,
+    split_essay,
+    split_paragraphs,
+)
+from metrics import CACHE_LOOKUPS, CHECKS, COALESCED, timed
+from precheck import Prechecker, Verdict
+from prompts.chunked import map_prompt_msg, reduce_prompt_msg
+from prompts.essay import prompt_msg, prompt_version, quick_msg, system_msg
+from routing import ModelRouter
+from store import EssayStore, Revision, StoreWriter, get_store
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# The owner of the essay kept in ./data before each user had their own.
+DEFAULT_OWNER = "default"
+
 
 class EssayOptions(TypedDict):
     """Required essay options."""
@@ -18,87 +57,440 @@ class EssayOptions(TypedDict):
     tone: str
 
 
+@dataclass
+class ChunkSettings:
+    """When and how to evaluate long essays in parts.
+
+    Essays estimated above `token_threshold` tokens are split into chunks of
+    about `chunk_tokens`. The chunks are reviewed in parallel on up to
+    `max_workers` threads (map), and one more request merges the reviews
+    into a single evaluation (reduce).
+    """
+
+    token_threshold: int = 6000
+    chunk_tokens: int = 2000
+    max_workers: int = 4
+
+    def applies(self, essay_text: str) -> bool:
+        """Return True if the essay should be evaluated in parts."""
+
+        return estimate_tokens(essay_text) > self.token_threshold
+
+
+def revision_chunking(
+    essay_text: str,
+    chunking: ChunkSettings | None,
+    incremental: ChunkSettings | None,
+) -> ChunkSettings | None:
+    """Return the part settings for an evaluation that keeps part reviews.
+
+    The smaller `incremental` parts replace the `chunking` ones only for an
+    essay that `chunking` splits anyway. An essay that fits in one request
+    still takes one request, on its first evaluation and after each edit;
+    a longer one is reviewed in parts whose reviews later edits can reuse.
+
+    """
+
+    if incremental is None or chunking is None or not chunking.applies(essay_text):
+        return chunking
+    return incremental
+
+
+@dataclass
+class ResponseBudget:
+    """How many tokens an evaluation may use, by essay length and type.
+
+    The budget is `base_tokens` plus `per_essay_token` for each token of the
+    essay, times the factor for the essay type in `type_factors` (1 if it is
+    not listed), kept between `min_tokens` and `max_tokens`. If
+    `target_seconds` is set, the budget is also capped to what the endpoint
+    can generate in that time at `tokens_per_second`.
+
+    With `quick`, the prompt asks for a short review, so a tight budget
+    ends the reply instead of cutting it off mid-sentence.
+    """
+
+    base_tokens: int = 300
+    per_essay_token: float = 0.4
+    min_tokens: int = 250
+    max_tokens: int = 1200
+    type_factors: dict[str, float] = field(default_factory=dict)
+    target_seconds: float | None = None
+    tokens_per_second: float = 50.0
+    quick: bool = False
+
+    def tokens_for(self, essay_text: str, essay_type: str) -> int:
+        """Return the `max_tokens` for a reply about this essay text."""
+
+        _budget = self.base_tokens + self.per_essay_token * estimate_tokens(essay_text)
+        _budget *= self.type_factors.get(essay_type, 1.0)
+        _cap = self.max_tokens
+        if self.target_seconds is not None:
+            _cap = min(_cap, int(self.target_seconds * self.tokens_per_second))
+        return max(self.min_tokens, min(_cap, int(_budget)))
+
+
 class Essay:
     """A class used to represent and manipulate an essay document.
 
+    Every save is kept as a revision in an `EssayStore`, under the owner and
+    the document name, so each user has their own essay and its history.
+
     Attributes
     ----------
-    path : pathlib.Path
-        The path to the essay document.
+    owner : str
+        The user or session the essay belongs to.
+    doc : str
+        The name of the document.
+    store : EssayStore
+        Where the revisions and reviews are saved.
+    writer : StoreWriter or None
+        If set, saves are written by it in the background.
 
     Methods
     -------
-    load()
-        Loads the content of the essay document from a file.
+    load(revision=None)
+        Loads the latest or a past revision of the essay.
     save(content)
-        Saves the provided content to the essay document file.
+        Saves the provided content as a new revision.
+    history(limit=50)
+        Lists the saved revisions, newest first.
+    load_reviews()
+        Loads the part reviews of the last evaluated version.
+    save_reviews(content, reviews)
+        Saves the part reviews and paragraph hashes of an evaluated version.
+    changed_paragraphs(content)
+        Lists the paragraphs that changed since the last evaluation.
 
     """
 
     def __init__(
         self,
         doc_path: str = "current.md",
+        owner: str = DEFAULT_OWNER,
+        store: EssayStore | None = None,
+        writer: StoreWriter | None = None,
     ) -> None:
         """Initialize the Essay class.
 
         Parameters
         ----------
-        essay_options : EssayOptions
-            The options for the essay.
-
         doc_path : str, optional
-            The path to the document file relative to the ./data directory.
-            Default is "current.md".
+            The name of the document. Default is "current.md".
+        owner : str, optional
+            The user or session the essay belongs to. Default is "default",
+            whose essay is imported from its file in ./data if the store has
+            none.
+        store : EssayStore, optional
+            Where to keep the essay. Default is the store in
+            ./data/essays.sqlite3.
+        writer : StoreWriter, optional
+            Hand saves to this writer instead of waiting for them. Its store
+            is used. Default is to save at once.
 
         """
 
-        self.path = Path(f"./data/{doc_path}")
+        self.doc = doc_path
+        self.owner = owner
+        self.writer = writer
+        if writer is not None:
+            self.store = writer.store
+        else:
+            self.store = store if store is not None else get_store()
 
-    def load(self) -> str:
-        """Load the content of the essay document from a file.
+    def load(self, revision: int | None = None) -> str:
+        """Load the latest or a past revision of the essay.
 
-        Checks if the file exists. If not, an empty string is returned.
+        Parameters
+        ----------
+        revision : int, optional
+            The revision to load. Default is the latest.
 
         Returns
         -------
         str
-            The content of the essay document if it exists and is a text file;
-            otherwise, an empty string.
+            The content of the essay if it was saved; otherwise, an empty
+            string.
 
         """
 
-        # Check if the file exists
-        if not self.path.is_file():
-            _msg = f"File not found: {self.path.as_posix()}"
+        _content = None
+        if revision is None and self.writer is not None:
+            _content = self.writer.pending(self.owner, self.doc)
+        if _content is None:
+            _content = self.store.load(self.owner, self.doc, revision)
+        if _content is None and revision is None:
+            _content = self._import_file()
+        if _content is None:
+            _msg = f"No saved essay: {self.owner}/{self.doc} revision {revision}"
             log.info(_msg)
             return ""
 
-        # Load the file
-        with self.path.open() as _file:
-            _content = _file.read()
+        return _content
+
+    def _import_file(self) -> str | None:
+        """Import the essay saved as a file before the store was used.
+
+        The default owner's essay was kept in ./data under the document
+        name, with its reviews next to it in a `.reviews.json` file. If the
+        store has no revision of it yet, the file becomes revision 1.
+
+        """
+
+        if self.owner != DEFAULT_OWNER:
+            return None
+        _path = Path(f"./data/{self.doc}")
+        if not _path.is_file():
+            return None
+
+        _content = _path.read_text()
+        self.store.save(self.owner, self.doc, _content)
+        _reviews_path = _path.with_name(f"{_path.name}.reviews.json")
+        if _reviews_path.is_file():
+            self.store.set_meta(
+                self.owner,
+                self.doc,
+                "evaluation",
+                _reviews_path.read_text(),
+            )
+        _msg = f"Imported {_path.as_posix()} into the essay store"
+        log.info(_msg)
 
         return _content
 
-    def save(self, content: str) -> None:
-        """Save the provided content to the essay document file.
+    @timed("essay_save")
+    def save(self, content: str) -> int | None:
+        """Save the provided content as a new revision.
+
+        Nothing is written if the content did not change. With a writer,
+        the save is queued and this returns at once.
+
+        Parameters
+        ----------
+        content : str
+            The content to be saved.
+
+        Returns
+        -------
+        int or None
+            The number of the latest revision, or None if the save was
+            queued.
+
+        """
+
+        if self.writer is not None:
+            self.writer.submit(self.owner, self.doc, content)
+            return None
+
+        return self.store.save(self.owner, self.doc, content)
+
+    def history(self, limit: int = 50) -> list[Revision]:
+        """List the saved revisions of the essay, newest first."""
+
+        return self.store.history(self.owner, self.doc, limit=limit)
+
+    def _load_evaluation(self) -> dict:
+        """Load the record of the last evaluated version."""
+
+        _value = self.store.get_meta(self.owner, self.doc, "evaluation")
+        if _value is None:
+            return {}
+
+        try:
+            return json.loads(_value)
+        except json.JSONDecodeError:
+            _msg = f"Ignoring unreadable reviews: {self.owner}/{self.doc}"
+            log.warning(_msg)
+            return {}
+
+    def load_reviews(self) -> dict[str, str]:
+        """Load the part reviews of the last evaluated version.
+
+        Returns
+        -------
+        dict
+            The reviews keyed by part, to pass to `run_request` as `reviews`.
+            Empty if the essay has not been evaluated.
+
+        """
+
+        return self._load_evaluation().get("reviews", {})
+
+    def save_reviews(self, content: str, reviews: dict[str, str]) -> None:
+        """Save the part reviews of an evaluated version.
 
         Parameters
         ----------
         content : str
-            The content to be saved to the essay document file.
+            The essay text that was evaluated.
+        reviews : dict
+            The part reviews, as updated by `run_request`.
+
+        """
+
+        _evaluation = {
+            "paragraphs": [
+                paragraph_hash(_para) for _para in split_paragraphs(content)
+            ],
+            "reviews": reviews,
+        }
+        self.store.set_meta(self.owner, self.doc, "evaluation", json.dumps(_evaluation))
+
+    def changed_paragraphs(self, content: str) -> list[int]:
+        """List the paragraphs that changed since the last evaluation.
+
+        Parameters
+        ----------
+        content : str
+            The current essay text.
+
+        Returns
+        -------
+        list of int
+            The indexes of the paragraphs of `content` that were not in the
+            last evaluated version.
+
+        """
+
+        _previous = set(self._load_evaluation().get("paragraphs", []))
+        return [
+            _index
+            for _index, _para in enumerate(split_paragraphs(content))
+            if paragraph_hash(_para) not in _previous
+        ]
+
+
+class RequestCoalescer:
+    """Share one upstream call among concurrent identical requests.
+
+    The first request for a key (the leader) makes the call; requests for
+    the same key that arrive while it is in flight wait for it and get its
+    result, or its error. If the leader is cancelled or abandoned instead,
+    the waiting requests try again, and one of them becomes the leader.
+    Callers may be threads or coroutines, in any mix.
+
+    """
+
+    def __init__(self) -> None:
+        """Initialize the RequestCoalescer class."""
+
+        self._calls: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self) -> int:
+        """Return the number of distinct calls in flight."""
+
+        with self._lock:
+            return len(self._calls)
+
+    def call(self, key: str, func: Callable[[], T]) -> T:
+        """Return `func()`, or the result of the identical call in flight."""
+
+        while True:
+            _future, _leader = self.begin(key)
+            if not _leader:
+                try:
+                    return _future.result()
+                except CancelledError:
+                    continue
+
+            try:
+                _result = func()
+            except BaseException as e:
+                self.finish(key, _future, error=e)
+                raise
+            self.finish(key, _future, _result)
+            return _result
+
+    async def call_async(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        """Await `func()`, or the result of the identical call in flight."""
+
+        while True:
+            _future, _leader = self.begin(key)
+            if not _leader:
+                try:
+                    return await asyncio.wrap_future(_future)
+                except CancelledError:
+                    # The leader was cancelled; ours was not, unless the
+                    # event loop is cancelling this task too.
+                    if _future.cancelled():
+                        continue
+                    raise
+
+            try:
+                _result = await func()
+            except BaseException as e:
+                self.finish(key, _future, error=e)
+                raise
+            self.finish(key, _future, _result)
+            return _result
+
+    def begin(self, key: str) -> tuple[Future, bool]:
+        """Join the call in flight for `key`, or lead a new one.
+
+        Returns
+        -------
+        tuple
+            The future that gets the call's result, and whether the caller
+            is the leader, which must make the call and `finish` it.
+
+        """
+
+        with self._lock:
+            _future = self._calls.get(key)
+            _leader = _future is None
+            if _leader:
+                _future = self._calls[key] = Future()
+
+        COALESCED.inc(role="leader" if _leader else "joined")
+        if not _leader:
+            _msg = f"Joining the request in flight for {key[:12]}"
+            log.debug(_msg)
+        return _future, _leader
+
+    def finish(
+        self,
+        key: str,
+        future: Future,
+        result: object = None,
+        error: BaseException | None = None,
+    ) -> None:
+        """End the call for `key`, passing its outcome to those who joined.
+
+        Errors other than Exceptions, such as a cancelled task or a closed
+        stream, are not the request's fault, so the others retry instead.
 
         """
 
-        # Save the file
-        with self.path.open("w") as _file:
-            _file.write(content)
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            future.cancel()
+
 
+# Shared by every evaluation in the process.
+_COALESCER = RequestCoalescer()
 
-def run_request(
+
+def run_request(  # noqa: PLR0913
     essay_text: str,
     essay_options: EssayOptions,
     open_ai_key: str,
     model: str,
+    oaiconn: OpenAIConnection | EndpointPool | None = None,
+    cache: ResponseCache | None = None,
+    usage: TokenUsage | None = None,
+    chunking: ChunkSettings | None = None,
+    reviews: dict[str, str] | None = None,
+    prechecker: Prechecker | None = None,
+    budget: ResponseBudget | None = None,
+    router: ModelRouter | None = None,
 ) -> str:
     """Process a given essay text using a language model.
 
@@ -120,6 +512,44 @@ def run_request(
     model : str
         The name of the language model to be used for processing the essay.
 
+    oaiconn : OpenAIConnection or EndpointPool, optional
+        The connection, or pool of connections, to use. Default is the
+        process-wide connection to the OpenAI API for `open_ai_key`, so its
+        pooled client is reused.
+
+    cache : ResponseCache, optional
+        If given, an accepted evaluation with the same `request_key` is
+        returned from it without contacting the endpoint, and new accepted
+        evaluations are stored in it.
+
+    usage : TokenUsage, optional
+        If given, the tokens used by this evaluation are added to it. A cache
+        hit uses no tokens.
+
+    chunking : ChunkSettings, optional
+        If given, essays over its token threshold are reviewed in parts in
+        parallel, and the reviews are merged by one more request.
+
+    reviews : dict, optional
+        Reviews of essay parts from the previous evaluation, keyed by part.
+        Used with `chunking` for revision loops: only the parts that changed
+        are sent to the model, and the dict is updated with the reviews of
+        the current parts. See `Essay.load_reviews`.
+
+    prechecker : Prechecker, optional
+        If given, clear-cut evaluations are accepted or rejected locally,
+        and check_completion is only called when the pre-check is unsure.
+
+    budget : ResponseBudget, optional
+        If given, each reply is limited to the `max_tokens` it allows for
+        the essay (or part) length and type. A quick budget also asks for a
+        short review.
+
+    router : ModelRouter, optional
+        If given, it picks the model for the evaluation and for the check
+        of each request, falling back to other models on endpoint errors;
+        `model` is the last resort.
+
     Returns
     -------
     str
@@ -129,12 +559,158 @@ def run_request(
     -----
     This function performs the following steps:
 
-    1. Sets the system message for the language model.
-    2. Substitutes the essay text into the user message template.
-    3. Constructs a list of messages containing the system and user messages.
-    4. Initializes an OpenAIConnection object with the provided API key.
-    5. Calls the request_completion function to generate a response from
-       the language model.
+    1. Builds the system and user messages with `build_messages`, and
+       returns early on a cache hit.
+    2. Gets the shared OpenAIConnection for the provided API key, unless
+       one was passed in.
+    3. Calls the request_completion function to generate a response from
+       the language model. Long essays are first reviewed in parts, and the
+       request asks the model to merge those reviews.
+    4. Checks the response with the prechecker, then check_completion if
+       it is unsure, and caches it if it was accepted.
+
+    Identical requests (same `request_key`) made while one is in flight
+    wait for it and share its result or error, using no tokens.
+
+    """
+    _quick = budget is not None and budget.quick
+    messages = build_messages(essay_text, essay_options, quick=_quick)
+
+    _key = request_key(messages, essay_text, essay_options, model, budget, router)
+    _cached = _cache_lookup(cache, _key)
+    if _cached is not None:
+        return _cached
+
+    def _evaluate() -> str:
+        _messages = messages
+        _oaiconn = oaiconn or get_connection(open_ai_key, DEFAULT_ENDPOINT_URL)
+
+        if chunking is not None and chunking.applies(essay_text):
+            _messages = _map_reduce_messages(
+                essay_text,
+                essay_options,
+                _oaiconn,
+                model,
+                chunking,
+                usage,
+                reviews,
+                budget,
+                router,
+            )
+
+        _content = _routed(
+            router,
+            "evaluate",
+            essay_text,
+            essay_options,
+            model,
+            lambda _model: request_completion(
+                oaiconn=_oaiconn,
+                messages=_messages,
+                model=_model,
+                usage=usage,
+                max_tokens=_max_tokens(budget, essay_text, essay_options),
+            ),
+        )
+
+        assert isinstance(_content, str), "_content should be a string"
+
+        _raise_if_rejected(
+            _passes_check(
+                _oaiconn,
+                _content,
+                essay_text,
+                essay_options,
+                model,
+                usage,
+                prechecker,
+                router,
+            ),
+        )
+
+        if cache is not None:
+            cache.put(_key, _content)
+        return _content
+
+    return _COALESCER.call(_key, _evaluate)
+
+
+def request_key(  # noqa: PLR0913
+    messages: list[dict],
+    essay_text: str,
+    essay_options: EssayOptions,
+    model: str,
+    budget: ResponseBudget | None = None,
+    router: ModelRouter | None = None,
+) -> str:
+    """Return the key of an evaluation in the cache and among requests in flight.
+
+    It covers the rendered `messages`, the model the router would try first
+    (or `model`), the prompt version and the reply limit of the budget, so
+    evaluations are only shared between requests that would send the same
+    request.
+
+    """
+
+    if router is not None:
+        model = router.candidates(
+            "evaluate",
+            essay_text,
+            essay_options["essay_type"],
+            model,
+        )[0]
+    return make_key(
+        messages,
+        model,
+        prompt_version,
+        _max_tokens(budget, essay_text, essay_options),
+    )
+
+
+def option_variants(
+    essay_options: EssayOptions,
+    **choices: list[str],
+) -> list[EssayOptions]:
+    """Return the essay options for every combination of the choices.
+
+    For example, `option_variants(options, audience=["Experts", "Children"],
+    tone=["Formal"])` returns two copies of `options`, one for each audience,
+    both with the formal tone.
+
+    `run_request` evaluates one set of options; to compare several, run one
+    request per variant, e.g. as jobs on a `jobs.JobRunner` as the app does.
+
+    """
+
+    _names = list(choices)
+    return [
+        EssayOptions(**{**essay_options, **dict(zip(_names, _values, strict=True))})
+        for _values in itertools.product(*choices.values())
+    ]
+
+
+@timed("render")
+def build_messages(
+    essay_text: str,
+    essay_options: EssayOptions,
+    *,
+    quick: bool = False,
+) -> list[dict]:
+    """Render the system and user messages for an essay evaluation.
+
+    Parameters
+    ----------
+    essay_text : str
+        The essay to be evaluated.
+    essay_options : EssayOptions
+        The author, audience, essay type and tone for the evaluation.
+    quick : bool, optional
+        Ask for a short review of the most important points.
+
+    Returns
+    -------
+    list of dict
+        The system message followed by the user message.
 
     """
     assert isinstance(essay_text, str), "essay_text should be a string"
@@ -145,8 +721,9 @@ def run_request(
     assert "tone" in essay_options, "essay_options should contain 'tone'"
 
     _system_msg = system_msg  # this will be a template later.
-    _essay = essay_text  # this seems superflous, TODO: remove?
-    _user_msg = Template(prompt_msg).substitute(essay_txt=_essay, **essay_options)
+    _user_msg = Template(prompt_msg).substitute(essay_txt=essay_text, **essay_options)
+    if quick:
+        _user_msg += quick_msg
     messages = [
         {
             "role": "system",
@@ -158,25 +735,610 @@ def run_request(
         },
     ]
 
-    _oaiconn = OpenAIConnection(
-        endpoint_url="https://api.openai.com/v1/",
-        api_key=open_ai_key,
+    return messages
+
+
+def run_request_stream(  # noqa: PLR0913
+    essay_text: str,
+    essay_options: EssayOptions,
+    open_ai_key: str,
+    model: str,
+    oaiconn: OpenAIConnection | EndpointPool | None = None,
+    cache: ResponseCache | None = None,
+    usage: TokenUsage | None = None,
+    chunking: ChunkSettings | None = None,
+    reviews: dict[str, str] | None = None,
+    prechecker: Prechecker | None = None,
+    budget: ResponseBudget | None = None,
+    router: ModelRouter | None = None,
+) -> Iterator[str]:
+    """Process a given essay text, yielding the evaluation as it streams in.
+
+    Takes the same parameters as `run_request`. The completion check still
+    gates the result: it runs once the last chunk has been yielded, and a
+    rejected evaluation raises ValueError at the end of the iteration, so
+    the caller should discard what it has rendered so far. A cache hit, or
+    the result of an identical request in flight, is yielded as a single
+    chunk.
+
+    Yields
+    ------
+    str
+        Chunks of the evaluation text.
+
+    Raises
+    ------
+    ValueError
+        If the completion check rejects the evaluation.
+
+    """
+    _quick = budget is not None and budget.quick
+    messages = build_messages(essay_text, essay_options, quick=_quick)
+
+    _key = request_key(messages, essay_text, essay_options, model, budget, router)
+    _cached = _cache_lookup(cache, _key)
+    if _cached is not None:
+        yield _cached
+        return
+
+    _future, _leader = _COALESCER.begin(_key)
+    while not _leader:
+        try:
+            _result = _future.result()
+        except CancelledError:
+            _future, _leader = _COALESCER.begin(_key)
+            continue
+        yield _result
+        return
+
+    try:
+        _oaiconn = oaiconn or get_connection(open_ai_key, DEFAULT_ENDPOINT_URL)
+
+        if chunking is not None and chunking.applies(essay_text):
+            # The parts are reviewed without streaming; only the merge streams.
+            messages = _map_reduce_messages(
+                essay_text,
+                essay_options,
+                _oaiconn,
+                model,
+                chunking,
+                usage,
+                reviews,
+                budget,
+                router,
+            )
+
+        _chunks = []
+        for _chunk in _routed_stream(
+            router,
+            essay_text,
+            essay_options,
+            model,
+            lambda _model: request_completion(
+                oaiconn=_oaiconn,
+                messages=messages,
+                model=_model,
+                stream=True,
+                usage=usage,
+                max_tokens=_max_tokens(budget, essay_text, essay_options),
+            ),
+        ):
+            _chunks.append(_chunk)
+            yield _chunk
+
+        _content = "".join(_chunks)
+        _raise_if_rejected(
+            _passes_check(
+                _oaiconn,
+                _content,
+                essay_text,
+                essay_options,
+                model,
+                usage,
+                prechecker,
+                router,
+            ),
+        )
+    except BaseException as e:
+        _COALESCER.finish(_key, _future, error=e)
+        raise
+
+    if cache is not None:
+        cache.put(_key, _content)
+    _COALESCER.finish(_key, _future, _content)
+
+
+async def run_request_async(  # noqa: PLR0913
+    essay_text: str,
+    essay_options: EssayOptions,
+    open_ai_key: str,
+    model: str,
+    oaiconn: OpenAIConnection | EndpointPool | None = None,
+    cache: ResponseCache | None = None,
+    usage: TokenUsage | None = None,
+    chunking: ChunkSettings | None = None,
+    reviews: dict[str, str] | None = None,
+    prechecker: Prechecker | None = None,
+    budget: ResponseBudget | None = None,
+    router: ModelRouter | None = None,
+) -> str:
+    """Process a given essay text without blocking a thread.
+
+    Takes the same parameters as `run_request`. Many evaluations can be
+    gathered on one event loop; they share the connection's async client,
+    and at most `oaiconn.max_concurrency` requests are in flight at once.
+
+    Returns
+    -------
+    str
+        The output response generated by the language model.
+
+    Raises
+    ------
+    ValueError
+        If the completion check rejects the evaluation.
+
+    """
+    _quick = budget is not None and budget.quick
+    messages = build_messages(essay_text, essay_options, quick=_quick)
+
+    _key = request_key(messages, essay_text, essay_options, model, budget, router)
+    _cached = _cache_lookup(cache, _key)
+    if _cached is not None:
+        return _cached
+
+    async def _evaluate() -> str:
+        _messages = messages
+        _oaiconn = oaiconn or get_connection(open_ai_key, DEFAULT_ENDPOINT_URL)
+
+        if chunking is not None and chunking.applies(essay_text):
+            _messages = await _map_reduce_messages_async(
+                essay_text,
+                essay_options,
+                _oaiconn,
+                model,
+                chunking,
+                usage,
+                reviews,
+                budget,
+                router,
+            )
+
+        _content = await _routed_async(
+            router,
+            "evaluate",
+            essay_text,
+            essay_options,
+            model,
+            lambda _model: request_completion_async(
+                oaiconn=_oaiconn,
+                messages=_messages,
+                model=_model,
+                usage=usage,
+                max_tokens=_max_tokens(budget, essay_text, essay_options),
+            ),
+        )
+
+        _raise_if_rejected(
+            await _passes_check_async(
+                _oaiconn,
+                _content,
+                essay_text,
+                essay_options,
+                model,
+                usage,
+                prechecker,
+                router,
+            ),
+        )
+
+        if cache is not None:
+            cache.put(_key, _content)
+        return _content
+
+    return await _COALESCER.call_async(_key, _evaluate)
+
+
+@timed("render")
+def build_map_messages(
+    chunks: list[str],
+    essay_options: EssayOptions,
+) -> list[list[dict]]:
+    """Render the messages that review each part of a long essay."""
+
+    return [
+        [
+            {
+                "role": "system",
+                "content": system_msg,
+            },
+            {
+                "role": "user",
+                "content": Template(map_prompt_msg).substitute(
+                    chunk_txt=_chunk,
+                    part=_part,
+                    parts=len(chunks),
+                    **essay_options,
+                ),
+            },
+        ]
+        for _part, _chunk in enumerate(chunks, start=1)
+    ]
+
+
+@timed("render")
+def build_reduce_messages(
+    reviews: list[str],
+    essay_options: EssayOptions,
+) -> list[dict]:
+    """Render the messages that merge the reviews of each part."""
+
+    _reviews = "\n\n".join(
+        f"Review of part {_part}:\n\n{_review}"
+        for _part, _review in enumerate(reviews, start=1)
+    )
+    return [
+        {
+            "role": "system",
+            "content": system_msg,
+        },
+        {
+            "role": "user",
+            "content": Template(reduce_prompt_msg).substitute(
+                reviews=_reviews,
+                parts=len(reviews),
+                **essay_options,
+            ),
+        },
+    ]
+
+
+def _map_reduce_messages(  # noqa: PLR0913
+    essay_text: str,
+    essay_options: EssayOptions,
+    oaiconn: OpenAIConnection | EndpointPool,
+    model: str,
+    chunking: ChunkSettings,
+    usage: TokenUsage | None,
+    reviews: dict[str, str] | None = None,
+    budget: ResponseBudget | None = None,
+    router: ModelRouter | None = None,
+) -> list[dict]:
+    """Review the parts of a long essay in parallel threads.
+
+    Returns the reduce messages, or the plain essay messages if the essay
+    could not be split. Parts that already have a review in `reviews` are
+    not sent again.
+
+    """
+
+    _plan = _plan_parts(essay_text, essay_options, model, chunking, reviews)
+    if _plan is None:
+        return build_messages(
+            essay_text,
+            essay_options,
+            quick=budget is not None and budget.quick,
+        )
+
+    _keys, _map_messages, _todo = _plan
+    # Run each part in a copy of the caller's context, so the parts wait in
+    # the caller's rate-limit queue (see scheduler.request_context).
+    _context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=chunking.max_workers) as _pool:
+        _new_reviews = list(
+            _pool.map(
+                lambda _index: _context.copy().run(
+                    _routed,
+                    router,
+                    "evaluate",
+                    _map_messages[_index][1]["content"],
+                    essay_options,
+                    model,
+                    lambda _model: request_completion(
+                        oaiconn=oaiconn,
+                        messages=_map_messages[_index],
+                        model=_model,
+                        usage=usage,
+                        max_tokens=_max_tokens(
+                            budget,
+                            _map_messages[_index][1]["content"],
+                            essay_options,
+                        ),
+                    ),
+                ),
+                _todo,
+            ),
+        )
+
+    return _reduce_parts(
+        essay_options,
+        _keys,
+        dict(zip(_todo, _new_reviews, strict=True)),
+        reviews,
+    )
+
+
+async def _map_reduce_messages_async(  # noqa: PLR0913
+    essay_text: str,
+    essay_options: EssayOptions,
+    oaiconn: OpenAIConnection | EndpointPool,
+    model: str,
+    chunking: ChunkSettings,
+    usage: TokenUsage | None,
+    reviews: dict[str, str] | None = None,
+    budget: ResponseBudget | None = None,
+    router: ModelRouter | None = None,
+) -> list[dict]:
+    """Review the parts of a long essay concurrently on the event loop."""
+
+    _plan = _plan_parts(essay_text, essay_options, model, chunking, reviews)
+    if _plan is None:
+        return build_messages(
+            essay_text,
+            essay_options,
+            quick=budget is not None and budget.quick,
+        )
+
+    _keys, _map_messages, _todo = _plan
+    _new_reviews = await asyncio.gather(
+        *(
+            _routed_async(
+                router,
+                "evaluate",
+                _map_messages[_index][1]["content"],
+                essay_options,
+                model,
+                lambda _model, _index=_index: request_completion_async(
+                    oaiconn=oaiconn,
+                    messages=_map_messages[_index],
+                    model=_model,
+                    usage=usage,
+                    max_tokens=_max_tokens(
+                        budget,
+                        _map_messages[_index][1]["content"],
+                        essay_options,
+                    ),
+                ),
+            )
+            for _index in _todo
+        ),
+    )
+
+    return _reduce_parts(
+        essay_options,
+        _keys,
+        dict(zip(_todo, _new_reviews, strict=True)),
+        reviews,
+    )
+
+
+def _routed(  # noqa: PLR0913
+    router: ModelRouter | None,
+    stage: str,
+    text: str,
+    essay_options: EssayOptions,
+    model: str,
+    func: Callable[[str], T],
+) -> T:
+    """Call `func` with the model the router picks, or with `model`."""
+
+    if router is None:
+        return func(model)
+    return router.call(stage, text, essay_options["essay_type"], model, func)
+
+
+async def _routed_async(  # noqa: PLR0913
+    router: ModelRouter | None,
+    stage: str,
+    text: str,
+    essay_options: EssayOptions,
+    model: str,
+    func: Callable[[str], Awaitable[T]],
+) -> T:
+    """Await `func` with the model the router picks, or with `model`."""
+
+    if router is None:
+        return await func(model)
+    return await router.call_async(
+        stage,
+        text,
+        essay_options["essay_type"],
+        model,
+        func,
+    )
+
+
+def _routed_stream(
+    router: ModelRouter | None,
+    text: str,
+    essay_options: EssayOptions,
+    model: str,
+    func: Callable[[str], Iterator[str]],
+) -> Iterator[str]:
+    """Stream an evaluation from the model the router picks, or `model`."""
+
+    if router is None:
+        return func(model)
+    return router.stream("evaluate", text, essay_options["essay_type"], model, func)
+
+
+def _max_tokens(
+    budget: ResponseBudget | None,
+    essay_text: str,
+    essay_options: EssayOptions,
+) -> int | None:
+    """Return the reply limit a budget allows for an essay, if any."""
+
+    if budget is None:
+        return None
+    return budget.tokens_for(essay_text, essay_options["essay_type"])
+
+
+def _plan_parts(
+    essay_text: str,
+    essay_options: EssayOptions,
+    model: str,
+    chunking: ChunkSettings,
+    reviews: dict[str, str] | None,
+) -> tuple[list[str], list[list[dict]], list[int]] | None:
+    """Split an essay into parts and find the parts that need a review.
+
+    Returns the key of each part, the map messages of each part and the
+    indexes of the parts without a review in `reviews`, or None if the essay
+    is a single part. With `reviews`, the split uses content-defined
+    boundaries so unchanged paragraphs keep their keys across edits.
+
+    """
+
+    _chunks = split_essay(
+        essay_text,
+        chunking.chunk_tokens,
+        stable=reviews is not None,
+    )
+    if len(_chunks) < 2:  # noqa: PLR2004
+        return None
+
+    # The key leaves out the part number, so an edit that adds or removes
+    # a part does not invalidate the reviews of the parts after it.
+    _keys = [
+        make_key(
+            [{"chunk": _chunk, "options": dict(essay_options)}],
+            model,
+            prompt_version,
+        )
+        for _chunk in _chunks
+    ]
+    _reviews = reviews or {}
+    _todo = [_index for _index, _key in enumerate(_keys) if _key not in _reviews]
+
+    _msg = (
+        f"Reviewing the essay in {len(_chunks)} parts,"
+        f" {len(_chunks) - len(_todo)} reused."
+    )
+    log.info(_msg)
+
+    return _keys, build_map_messages(_chunks, essay_options), _todo
+
+
+def _reduce_parts(
+    essay_options: EssayOptions,
+    keys: list[str],
+    new_reviews: dict[int, str],
+    reviews: dict[str, str] | None,
+) -> list[dict]:
+    """Combine new and reused part reviews into the reduce messages.
+
+    `reviews` is updated in place to hold exactly the reviews of the current
+    parts, so reviews of paragraphs that no longer exist are dropped.
+
+    """
+
+    _reviews = reviews or {}
+    _part_reviews = [
+        new_reviews[_index] if _index in new_reviews else _reviews[_key]
+        for _index, _key in enumerate(keys)
+    ]
+
+    if reviews is not None:
+        reviews.clear()
+        reviews.update(zip(keys, _part_reviews, strict=True))
+
+    return build_reduce_messages(_part_reviews, essay_options)
+
+
+def _passes_check(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
+    content: str,
+    essay_text: str,
+    essay_options: EssayOptions,
+    model: str,
+    usage: TokenUsage | None,
+    prechecker: Prechecker | None,
+    router: ModelRouter | None = None,
+) -> bool:
+    """Check an evaluation locally if possible, otherwise with the LLM."""
+
+    if prechecker is not None:
+        _verdict = prechecker.check(content, essay_text)
+        if _verdict is not Verdict.UNCERTAIN:
+            return _count_check("local", _verdict is Verdict.ACCEPT)
+
+    _passed = _routed(
+        router,
+        "check",
+        content,
+        essay_options,
+        model,
+        lambda _model: check_completion(
+            oaiconn=oaiconn,
+            completion_text=content,
+            model=_model,
+            usage=usage,
+            fast=True,
+        ),
     )
+    return _count_check("llm", _passed)
+
+
+async def _passes_check_async(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
+    content: str,
+    essay_text: str,
+    essay_options: EssayOptions,
+    model: str,
+    usage: TokenUsage | None,
+    prechecker: Prechecker | None,
+    router: ModelRouter | None = None,
+) -> bool:
+    """Check an evaluation locally if possible, otherwise with the LLM."""
 
-    _content = request_completion(
-        oaiconn=_oaiconn,
-        messages=messages,
-        model=model,
+    if prechecker is not None:
+        _verdict = prechecker.check(content, essay_text)
+        if _verdict is not Verdict.UNCERTAIN:
+            return _count_check("local", _verdict is Verdict.ACCEPT)
+
+    _passed = await _routed_async(
+        router,
+        "check",
+        content,
+        essay_options,
+        model,
+        lambda _model: check_completion_async(
+            oaiconn=oaiconn,
+            completion_text=content,
+            model=_model,
+            usage=usage,
+            fast=True,
+        ),
     )
+    return _count_check("llm", _passed)
+
 
-    assert isinstance(_content, str), "_content should be a string"
+def _raise_if_rejected(passed: bool) -> None:  # noqa: FBT001
+    """Raise ValueError if the completion check rejected an evaluation."""
 
-    if not check_completion(
-        oaiconn=_oaiconn,
-        completion_text=_content,
-        model=model,
-    ):
+    if not passed:
         _msg = "Completion check failed"
         log.error(_msg)
         raise ValueError(_msg)
-    return _content
+
+
+def _count_check(checker: str, passed: bool) -> bool:  # noqa: FBT001
+    """Count a completion check in the metrics and return its result."""
+
+    CHECKS.inc(checker=checker, verdict="accepted" if passed else "rejected")
+    return passed
+
+
+def _cache_lookup(cache: ResponseCache | None, key: str) -> str | None:
+    """Return the cached evaluation for a request key, if any."""
+
+    if cache is None:
+        return None
+
+    _cached = cache.get(key)
+    if _cached is not None:
+        _msg = f"Cache hit for {key[:12]}"
+        log.debug(_msg)
+    CACHE_LOOKUPS.inc(result="miss" if _cached is None else "hit")
+    return _cached
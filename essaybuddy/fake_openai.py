@@ -0,0 +1,444 @@
+"""A local, OpenAI-compatible stub server for tests and benchmarks.
+
+It answers /v1/chat/completions (plain and streamed) and /v1/models, with
+configurable latency, streaming speed and injected errors. Run it on its own
+to point the app at it::
+
+    python fake_openai.py --port 8765 --latency 0.5
+
+and set `endpoint_url = "http://127.0.0.1:8765/v1/"` in essaybuddy.toml.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from message_parser import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CRITIQUE = """### Evaluation
+
+1. **Clarity, Coherence, and Organization:** The essay is clear and the ideas
+   follow each other in a sensible order.
+2. **Use of Appropriate Language and Style:** The language suits the audience.
+3. **Communicating the Main Idea:** The main idea is stated early.
+4. **Audience and Tone:** The tone matches what was asked for.
+
+### Suggestions
+
+- Add a short conclusion that restates the main idea.
+- Use transitions between the paragraphs, so the reader can follow the
+  argument from one point to the next.
+- Support the second claim with an example or a source.
+"""
+
+DEFAULT_VERDICT = "Accepted\nThe response is a constructive critique."
+
+
+def default_reply(messages: list[dict]) -> str:
+    """Return a canned critique, or a verdict for the completion check."""
+
+    _system = str(messages[0].get("content", "")) if messages else ""
+    if "critical supervisor" in _system:
+        return DEFAULT_VERDICT
+    return DEFAULT_CRITIQUE
+
+
+def _logprobs(words: list[str]) -> dict:
+    """Return logprobs that make every reply token certain, one per word."""
+
+    return {
+        "content": [
+            {
+                "token": _token,
+                "logprob": 0.0,
+                "bytes": None,
+                "top_logprobs": [{"token": _token, "logprob": 0.0, "bytes": None}],
+            }
+            for _token in (
+                _word if _index == 0 else f" {_word}"
+                for _index, _word in enumerate(words)
+            )
+        ],
+    }
+
+
+class _QuietServer(ThreadingHTTPServer):
+    """A server that does not print clients hanging up, e.g. a lost hedge."""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request: object, client_address: tuple) -> None:
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            _msg = f"Client {client_address} went away"
+            log.debug(_msg)
+            return
+        super().handle_error(request, client_address)
+
+
+class FakeOpenAIServer:
+    """An in-process OpenAI-compatible server on a free local port.
+
+    Attributes
+    ----------
+    url : str
+        The base URL to use as `OpenAIConnection.endpoint_url`.
+    requests : int
+        The number of chat completion requests received.
+    latency : float
+        Seconds to wait before answering, unless a delay is queued.
+    tokens_per_second : float
+        The pace of streamed chunks, one word per token. 0 means no pacing.
+    prompt_cache_min_tokens : int
+        Like OpenAI's prompt caching, the longest prefix a request shares
+        with a recent one is reported as `cached_tokens`, in steps of 128
+        tokens, once it is at least this long. 0 disables it.
+
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        latency: float = 0.0,
+        tokens_per_second: float = 0.0,
+        reply: Callable[[list[dict]], str] = default_reply,
+        port: int = 0,
+        prompt_cache_min_tokens: int = 1024,
+    ) -> None:
+        """Initialize the FakeOpenAIServer class.
+
+        Parameters
+        ----------
+        latency : float, optional
+            Seconds to wait before answering. Default is 0.
+        tokens_per_second : float, optional
+            The pace of streamed replies. Default is 0, no pacing.
+        reply : callable, optional
+            Maps the request messages to the reply text.
+        port : int, optional
+            The port to listen on. Default is 0, any free port.
+        prompt_cache_min_tokens : int, optional
+            The shortest prefix reported as cached. Default is 1024.
+
+        """
+
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply = reply
+        self.prompt_cache_min_tokens = prompt_cache_min_tokens
+        self.requests = 0
+        self._prompts: collections.deque[str] = collections.deque(maxlen=64)
+        self._delays: collections.deque[float] = collections.deque()
+        self._errors: collections.deque[tuple[int, float | None]] = (
+            collections.deque()
+        )
+        self._lock = threading.Lock()
+        self._server = _QuietServer(("127.0.0.1", port), self._handler())
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        """Return the base URL of the server."""
+
+        _host, _port = self._server.server_address[:2]
+        return f"http://{_host}:{_port}/v1/"
+
+    def delay_next(self, *delays: float) -> None:
+        """Use these latencies, in order, for the next requests."""
+
+        with self._lock:
+            self._delays.extend(delays)
+
+    def fail_next(
+        self,
+        status: int,
+        count: int = 1,
+        retry_after: float | None = None,
+    ) -> None:
+        """Answer the next `count` requests with an HTTP error.
+
+        Parameters
+        ----------
+        status : int
+            The HTTP status, e.g. 429 or 503.
+        count : int, optional
+            How many requests fail. Default is 1.
+        retry_after : float, optional
+            If given, sent as the Retry-After header, in seconds.
+
+        """
+
+        with self._lock:
+            self._errors.extend([(status, retry_after)] * count)
+
+    def start(self) -> "FakeOpenAIServer":
+        """Start serving on a background thread."""
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            name="fake-openai",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        """Start the server."""
+
+        return self.start()
+
+    def __exit__(self, *_exc: object) -> None:
+        """Stop the server."""
+
+        self.stop()
+
+    def _next_request(self) -> tuple[float, tuple[int, float | None] | None]:
+        """Count a request and return its latency and injected error."""
+
+        with self._lock:
+            self.requests += 1
+            _delay = self._delays.popleft() if self._delays else self.latency
+            _error = self._errors.popleft() if self._errors else None
+        return _delay, _error
+
+    def _cached_tokens(self, messages: list[dict]) -> int:
+        """Remember a prompt and return how much of it was cached."""
+
+        if not self.prompt_cache_min_tokens:
+            return 0
+
+        _prompt = "".join(
+            f"{_m.get('role')}\n{_m.get('content', '')}\n" for _m in messages
+        )
+        with self._lock:
+            _prefix = max(
+                (os.path.commonprefix([_prompt, _seen]) for _seen in self._prompts),
+                key=len,
+                default="",
+            )
+            self._prompts.append(_prompt)
+
+        _tokens = estimate_tokens(_prefix) // 128 * 128
+        return _tokens if _tokens >= self.prompt_cache_min_tokens else 0
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        """Build the request handler class bound to this server."""
+
+        return type("_BoundHandler", (_Handler,), {"fake": self})
+
+    def _complete(self, request: dict) -> tuple[list[str], dict, str]:
+        """Return the reply words, usage and finish reason for a request."""
+
+        _messages = request.get("messages", [])
+        _words = self.reply(_messages).split(" ")
+        _prompt_tokens = sum(
+            estimate_tokens(str(_m.get("content", ""))) for _m in _messages
+        )
+        _max_tokens = request.get("max_tokens")
+        _finish_reason = "stop"
+        if _max_tokens is not None and len(_words) > _max_tokens:
+            _words = _words[:_max_tokens]
+            _finish_reason = "length"
+        _usage = {
+            "prompt_tokens": _prompt_tokens,
+            "completion_tokens": len(_words),
+            "total_tokens": _prompt_tokens + len(_words),
+            "prompt_tokens_details": {
+                "cached_tokens": min(self._cached_tokens(_messages), _prompt_tokens),
+            },
+        }
+        return _words, _usage, _finish_reason
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer requests for the FakeOpenAIServer in `fake`."""
+
+    fake: FakeOpenAIServer
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, delayed
+    # ACKs add ~40 ms to every response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt: str, *args: object) -> None:
+        log.debug(fmt, *args)
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(
+                200,
+                {"object": "list", "data": [{"id": "fake", "object": "model"}]},
+            )
+            return
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self) -> None:  # noqa: N802
+        _length = int(self.headers.get("Content-Length", 0))
+        _request = json.loads(self.rfile.read(_length) or b"{}")
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        _delay, _error = self.fake._next_request()  # noqa: SLF001
+        if _delay:
+            time.sleep(_delay)
+
+        if _error is not None:
+            self._send_error(*_error)
+            return
+
+        _words, _usage, _finish_reason = self.fake._complete(_request)  # noqa: SLF001
+        if _request.get("stream"):
+            self._stream(_request, _words, _usage, _finish_reason)
+            return
+
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": _request.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": " ".join(_words)},
+                        "logprobs": _logprobs(_words)
+                        if _request.get("logprobs")
+                        else None,
+                        "finish_reason": _finish_reason,
+                    },
+                ],
+                "usage": _usage,
+            },
+        )
+
+    def _send_error(self, status: int, retry_after: float | None) -> None:
+        _headers = {}
+        if retry_after is not None:
+            _headers["Retry-After"] = str(retry_after)
+        self._send_json(
+            status,
+            {"error": {"message": f"injected {status}", "type": "fake"}},
+            _headers,
+        )
+
+    def _stream(
+        self,
+        request: dict,
+        words: list[str],
+        usage: dict,
+        finish_reason: str,
+    ) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        _base = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+        }
+        _pace = (
+            1.0 / self.fake.tokens_per_second if self.fake.tokens_per_second else 0.0
+        )
+        for _index, _word in enumerate(words):
+            _delta = _word if _index == 0 else f" {_word}"
+            self._send_event(
+                {
+                    **_base,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"content": _delta},
+                            "finish_reason": None,
+                        },
+                    ],
+                },
+            )
+            if _pace:
+                time.sleep(_pace)
+
+        self._send_event(
+            {
+                **_base,
+                "choices": [
+                    {"index": 0, "delta": {}, "finish_reason": finish_reason},
+                ],
+            },
+        )
+        _include_usage = request.get("stream_options", {}).get(
+            "include_usage",
+            False,
+        )
+        if _include_usage:
+            self._send_event({**_base, "choices": [], "usage": usage})
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+    def _send_event(self, payload: dict) -> None:
+        self._send_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+
+    def _send_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(
+        self,
+        status: int,
+        payload: dict,
+        headers: dict | None = None,
+    ) -> None:
+        _body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(_body)))
+        for _name, _value in (headers or {}).items():
+            self.send_header(_name, _value)
+        self.end_headers()
+        self.wfile.write(_body)
+
+
+def main() -> None:
+    """Run the stub server until interrupted."""
+
+    _parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    _parser.add_argument("--port", type=int, default=8765)
+    _parser.add_argument("--latency", type=float, default=0.0)
+    _parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    _args = _parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    _server = FakeOpenAIServer(
+        latency=_args.latency,
+        tokens_per_second=_args.tokens_per_second,
+        port=_args.port,
+    )
+    _msg = f"Serving a fake OpenAI API at {_server.url}"
+    log.info(_msg)
+    try:
+        _server.start()
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        _server.stop()
+
+
+if __name__ == "__main__":
+    main()
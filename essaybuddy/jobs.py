@@ -0,0 +1,229 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+from metrics import JOBS
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+@dataclass
+class Job:
+    """A call running in the background.
+
+    Attributes
+    ----------
+    id : str
+        The job id, to keep in the session and look the job up again.
+    status : str
+        One of "queued", "running", "done", "failed" or "cancelled".
+    result : Any
+        What the call returned, once it is done. For a streamed job, the
+        chunks joined together.
+    error : BaseException or None
+        What the call raised, if it failed.
+    chunks : list of str
+        The chunks of a streamed job received so far.
+    stream : bool
+        Whether the call yields text chunks rather than returning a result.
+
+    """
+
+    id: str
+    stream: bool = False
+    status: str = QUEUED
+    result: Any = None
+    error: BaseException | None = None
+    chunks: list[str] = field(default_factory=list)
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    _future: Future | None = field(default=None, repr=False)
+    # The call with its arguments, dropped once it has run.
+    _call: Callable[[], Any] | None = field(default=None, repr=False)
+
+    @property
+    def done(self) -> bool:
+        """Whether the job has finished, one way or another."""
+
+        return self.status in FINISHED
+
+    @property
+    def partial(self) -> str:
+        """The chunks of a streamed job received so far, joined."""
+
+        return "".join(self.chunks)
+
+
+class JobRunner:
+    """Run calls on a fixed pool of threads and track them by job id.
+
+    One runner is shared by every session, so the number of threads doing
+    evaluations stays bounded however many sessions there are. A session
+    keeps the id `submit` returns and polls `get` for the outcome, instead
+    of blocking its script thread while the call runs.
+
+    Calls run in a copy of the submitter's context, so they keep its
+    rate-limit queue (see `scheduler.request_context`). Finished jobs are
+    forgotten `keep_seconds` after they finish.
+
+    """
+
+    def __init__(self, max_workers: int = 8, keep_seconds: float = 3600) -> None:
+        """Initialize the JobRunner class.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            The number of threads running jobs. Default is 8.
+        keep_seconds : float, optional
+            How long a finished job can still be looked up. Default is 3600.
+
+        """
+
+        self.max_workers = max_workers
+        self.keep_seconds = keep_seconds
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="job",
+        )
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        func: Callable[..., Any],
+        *args: object,
+        **kwargs: object,
+    ) -> str:
+        """Run `func(*args, **kwargs)` in the background and return the job id."""
+
+        return self._submit(func, args, kwargs, stream=False)
+
+    def submit_stream(
+        self,
+        func: Callable[..., Iterator[str]],
+        *args: object,
+        **kwargs: object,
+    ) -> str:
+        """Run a generator of text chunks in the background.
+
+        The chunks are collected in the job's `chunks` as they arrive, so
+        they can be shown before the job is done.
+
+        """
+
+        return self._submit(func, args, kwargs, stream=True)
+
+    def get(self, job_id: str) -> Job | None:
+        """Return the job with this id, or None if it is unknown or expired."""
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job that has not started yet.
+
+        Returns False if the job is unknown or already running.
+
+        """
+
+        _job = self.get(job_id)
+        if _job is None or _job._future is None or not _job._future.cancel():  # noqa: SLF001
+            return False
+
+        JOBS.dec(state=QUEUED)
+        self._finish(_job, CANCELLED)
+        return True
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of known jobs in each state."""
+
+        with self._lock:
+            _jobs = list(self._jobs.values())
+        return {
+            _status: sum(_job.status == _status for _job in _jobs)
+            for _status in (QUEUED, RUNNING, *FINISHED)
+        }
+
+    def shutdown(self, *, wait: bool = True) -> None:
+        """Stop the threads, cancelling the jobs that have not started."""
+
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+    def _submit(
+        self,
+        func: Callable[..., Any],
+        args: tuple,
+        kwargs: dict,
+        *,
+        stream: bool,
+    ) -> str:
+        _job = Job(
+            id=uuid.uuid4().hex,
+            stream=stream,
+            _call=functools.partial(func, *args, **kwargs),
+        )
+        with self._lock:
+            self._expire()
+            self._jobs[_job.id] = _job
+
+        JOBS.inc(state=QUEUED)
+        _context = contextvars.copy_context()
+        _job._future = self._pool.submit(_context.run, self._run, _job)  # noqa: SLF001
+        return _job.id
+
+    def _run(self, job: Job) -> None:
+        JOBS.dec(state=QUEUED)
+        JOBS.inc(state=RUNNING)
+        job.started = time.time()
+        job.status = RUNNING
+        _call = job._call  # noqa: SLF001
+        assert _call is not None, "a job runs once"
+        try:
+            if job.stream:
+                for _chunk in _call():
+                    job.chunks.append(_chunk)
+                job.result = job.partial
+            else:
+                job.result = _call()
+        except Exception as e:  # noqa: BLE001
+            _msg = f"Job {job.id} failed: {e!r}"
+            log.warning(_msg)
+            job.error = e
+            self._finish(job, FAILED)
+        else:
+            self._finish(job, DONE)
+        finally:
+            JOBS.dec(state=RUNNING)
+
+    def _finish(self, job: Job, status: str) -> None:
+        job.finished = time.time()
+        job.status = status
+        job._call = None  # noqa: SLF001
+
+    def _expire(self) -> None:
+        """Forget the jobs that finished more than `keep_seconds` ago."""
+
+        _cutoff = time.time() - self.keep_seconds
+        for _id in [
+            _id
+            for _id, _job in self._jobs.items()
+            if _job.finished is not None and _job.finished < _cutoff
+        ]:
+            del self._jobs[_id]
@@ -1,56 +1,489 @@
+import asyncio
 import logging
-from dataclasses import dataclass
+import math
+import re
+import threading
+import time
+import weakref
+from collections.abc import Iterator
+from dataclasses import dataclass, field
 from string import Template
+from typing import TypedDict, Unpack
 
-from message_parser import message_words
-from openai import OpenAI
-from openai.types.chat import ChatCompletion
+import httpx
+from balancer import EndpointPool
+from cassette import Cassette
+from message_parser import estimate_tokens
+from metrics import CHECK_CONFIDENCE, COMPLETIONS, STAGE_SECONDS, TOKENS, stage, timed
+from openai import DEFAULT_MAX_RETRIES, NOT_GIVEN, AsyncOpenAI, OpenAI, OpenAIError
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 from prompts import completion_check
+from retry import (
+    LatencyTracker,
+    RetryPolicy,
+    call_with_retries,
+    call_with_retries_async,
+)
+from scheduler import RequestScheduler
 
 log = logging.getLogger(__name__)
 
+DEFAULT_ENDPOINT_URL = "https://api.openai.com/v1/"
+# The completion check only needs its first word; the reason that follows
+# is logged, so a short one is enough.
+CHECK_MAX_TOKENS = 100
+# In the single-token verdict mode, the alternatives to the verdict token
+# that are returned to tell how sure the model was.
+VERDICT_TOP_LOGPROBS = 5
+# The fewest letters of "Accepted" or "Rejected" a verdict token must hold;
+# "A" or "Re" could start any other word.
+VERDICT_MIN_PREFIX = 3
+
+# The first word of a completion check reply, ignoring leading punctuation.
+_FIRST_WORD = re.compile(r"[\W_]*(\w+)")
+
+
+@dataclass
+class TokenUsage:
+    """Token counts for a single evaluation or batch item."""
+
+    request_tokens: int = 0
+    response_tokens: int = 0
+    # The part of request_tokens served from the endpoint's prompt cache.
+    cached_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        """Return the sum of request and response tokens."""
+
+        return self.request_tokens + self.response_tokens
+
+
+@dataclass
+class ModelStats:
+    """Requests, failures, tokens and latencies of one model on a connection."""
+
+    requests: int = 0
+    failures: int = 0
+    request_tokens: int = 0
+    response_tokens: int = 0
+    latency: LatencyTracker = field(default_factory=LatencyTracker, repr=False)
+
+    def summary(self) -> dict:
+        """Return the counts and latency percentiles as plain values."""
+
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "request_tokens": self.request_tokens,
+            "response_tokens": self.response_tokens,
+            "p50_seconds": self.latency.quantile(0.5),
+            "p95_seconds": self.latency.quantile(0.95),
+        }
+
 
 @dataclass
 class OpenAIConnection:
-    """Hold credentials and stats for an OAI-compaitible endpoint."""
+    """Hold credentials, a pooled client and stats for an OAI-compaitible endpoint.
+
+    The `OpenAI` client is created on first use and reused for every request
+    made through the connection, so keep-alive sockets are shared by all
+    callers. The client is thread-safe; the stats are updated under a lock.
+
+    If a `scheduler` is set, every request waits for room under the
+    endpoint's rate limits before it is sent. If a `retry` policy is set, it
+    replaces the client's built-in retries, and may hedge slow requests
+    based on the latency of recent ones of the same kind, see `latency`. If
+    a `cassette` is set, the clients record their traffic to it or replay it
+    instead of sending.
+    """
 
     api_key: str
     endpoint_url: str
     request_tokens: int = 0
     response_tokens: int = 0
+    cached_tokens: int = 0
+    completions: int = 0
+    truncated: int = 0
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 60.0
+    timeout: float = 120.0
+    max_concurrency: int = 16
+    scheduler: RequestScheduler | None = None
+    retry: RetryPolicy | None = None
+    cassette: Cassette | None = None
+    latencies: dict[tuple[str, str], LatencyTracker] = field(
+        default_factory=dict,
+        repr=False,
+        compare=False,
+    )
+    model_stats: dict[str, ModelStats] = field(
+        default_factory=dict,
+        repr=False,
+        compare=False,
+    )
+    _client: OpenAI | None = field(
+        default=None,
+        init=False,
+        repr=False,
+        compare=False,
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock,
+        init=False,
+        repr=False,
+        compare=False,
+    )
+    _async_state: weakref.WeakKeyDictionary = field(
+        default_factory=weakref.WeakKeyDictionary,
+        init=False,
+        repr=False,
+        compare=False,
+    )
 
-    def update_stats(self, chat_completion: ChatCompletion) -> None:
-        """Update request and response token counts."""
+    @property
+    def _max_retries(self) -> int:
+        """Return the client's own retries, off when a policy is set."""
 
-        self.request_tokens += chat_completion.usage.prompt_tokens
-        self.response_tokens += chat_completion.usage.completion_tokens
+        return DEFAULT_MAX_RETRIES if self.retry is None else 0
 
+    def _limits(self) -> httpx.Limits:
+        """Return the connection pool limits for the HTTP clients."""
 
-def request_completion(
-    oaiconn: OpenAIConnection,
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def client(self) -> OpenAI:
+        """Return the pooled client, creating it on first use."""
+
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = OpenAI(
+                        api_key=self.api_key,
+                        base_url=self.endpoint_url,
+                        max_retries=self._max_retries,
+                        http_client=httpx.Client(
+                            limits=self._limits(),
+                            timeout=self.timeout,
+                            transport=None
+                            if self.cassette is None
+                            else self.cassette.transport(self._limits()),
+                        ),
+                    )
+        return self._client
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """Return the pooled async client for the running event loop.
+
+        An async client can only be used on the loop that created it, so one
+        is kept per loop. Every coroutine on that loop shares it.
+
+        """
+
+        return self._loop_state()[0]
+
+    @property
+    def async_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore that limits concurrent async requests."""
+
+        return self._loop_state()[1]
+
+    def _loop_state(self) -> tuple[AsyncOpenAI, asyncio.Semaphore]:
+        """Return the async client and semaphore for the running loop."""
+
+        _loop = asyncio.get_running_loop()
+        with self._lock:
+            if _loop not in self._async_state:
+                _client = AsyncOpenAI(
+                    api_key=self.api_key,
+                    base_url=self.endpoint_url,
+                    max_retries=self._max_retries,
+                    http_client=httpx.AsyncClient(
+                        limits=self._limits(),
+                        timeout=self.timeout,
+                        transport=None
+                        if self.cassette is None
+                        else self.cassette.async_transport(self._limits()),
+                    ),
+                )
+                self._async_state[_loop] = (
+                    _client,
+                    asyncio.Semaphore(self.max_concurrency),
+                )
+            return self._async_state[_loop]
+
+    def warm_up(self) -> bool:
+        """Open a connection to the endpoint before the first real request.
+
+        Returns
+        -------
+        bool
+            True if the endpoint answered, False otherwise. A failed warm-up
+            is logged and is not fatal; the first request will retry.
+
+        """
+
+        try:
+            self.client.models.list()
+        except OpenAIError as e:
+            _msg = f"Warm-up of {self.endpoint_url} failed: {e}"
+            log.warning(_msg)
+            return False
+
+        return True
+
+    def close(self) -> None:
+        """Close the pooled client and its sockets."""
+
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def reserve(self, messages: list) -> float:
+        """Wait for room under the rate limits for a request.
+
+        Returns
+        -------
+        float
+            The tokens reserved, to be passed to `settle` once the real
+            usage is known. 0 if there is no scheduler.
+
+        """
+
+        if self.scheduler is None:
+            return 0.0
+
+        _estimate = self.scheduler.expected_response_tokens + sum(
+            estimate_tokens(str(_message.get("content", "")))
+            for _message in messages
+        )
+        self.scheduler.acquire(_estimate)
+        return _estimate
+
+    def settle(
+        self,
+        estimate: float,
+        chat_completion: ChatCompletion | ChatCompletionChunk,
+    ) -> None:
+        """Correct a reservation with the real usage of a request."""
+
+        if self.scheduler is None or chat_completion.usage is None:
+            return
+
+        self.scheduler.settle(estimate, chat_completion.usage.total_tokens)
+
+    def update_stats(
+        self,
+        chat_completion: ChatCompletion | ChatCompletionChunk,
+        usage: TokenUsage | None = None,
+    ) -> None:
+        """Update request, response and cached token counts.
+
+        If `usage` is given, the counts are also added to it, so callers can
+        attribute tokens to one evaluation on a shared connection. A reply
+        without usage, which some compatible servers send, is not counted.
+
+        """
+
+        if chat_completion.usage is None:
+            _msg = f"No usage in the reply from {self.endpoint_url}"
+            log.warning(_msg)
+            return
+
+        _prompt_tokens = chat_completion.usage.prompt_tokens
+        _completion_tokens = chat_completion.usage.completion_tokens
+        _cached_tokens = cached_tokens(chat_completion.usage)
+        with self._lock:
+            self.request_tokens += _prompt_tokens
+            self.response_tokens += _completion_tokens
+            self.cached_tokens += _cached_tokens
+            if usage is not None:
+                usage.request_tokens += _prompt_tokens
+                usage.response_tokens += _completion_tokens
+                usage.cached_tokens += _cached_tokens
+        TOKENS.inc(_prompt_tokens, endpoint=self.endpoint_url, kind="request")
+        TOKENS.inc(_completion_tokens, endpoint=self.endpoint_url, kind="response")
+        TOKENS.inc(_cached_tokens, endpoint=self.endpoint_url, kind="cached")
+
+    def latency(self, kind: str, model: str) -> LatencyTracker:
+        """Return the latencies of recent `kind` requests to `model`.
+
+        A one-token verdict and a full evaluation take very different
+        times, so each kind of request, such as "completion" or "verdict",
+        and each model has its own hedge delay.
+
+        """
+
+        with self._lock:
+            return self.latencies.setdefault((kind, model), LatencyTracker())
+
+    def record_model(
+        self,
+        model: str,
+        seconds: float,
+        completion: ChatCompletion | ChatCompletionChunk | None,
+    ) -> None:
+        """Record a request to `model`; `completion` is None if it failed.
+
+        For a stream, `completion` is its last chunk, which has the usage.
+
+        """
+
+        with self._lock:
+            _stats = self.model_stats.setdefault(model, ModelStats())
+            _stats.requests += 1
+            if completion is None:
+                _stats.failures += 1
+                return
+            if completion.usage is not None:
+                _stats.request_tokens += completion.usage.prompt_tokens
+                _stats.response_tokens += completion.usage.completion_tokens
+        _stats.latency.record(seconds)
+
+    def record_finish(self, finish_reason: str | None) -> None:
+        """Count a finished completion, and whether it hit `max_tokens`."""
+
+        with self._lock:
+            self.completions += 1
+            if finish_reason == "length":
+                self.truncated += 1
+        COMPLETIONS.inc(endpoint=self.endpoint_url, finish_reason=str(finish_reason))
+
+    @property
+    def truncation_rate(self) -> float:
+        """Return the share of completions cut off by `max_tokens`."""
+
+        with self._lock:
+            if not self.completions:
+                return 0.0
+            return self.truncated / self.completions
+
+    @property
+    def prompt_cache_hit_rate(self) -> float:
+        """Return the share of request tokens served from the prompt cache."""
+
+        with self._lock:
+            if not self.request_tokens:
+                return 0.0
+            return self.cached_tokens / self.request_tokens
+
+
+def cached_tokens(usage: CompletionUsage) -> int:
+    """Return the prompt tokens the endpoint served from its prompt cache.
+
+    Read from `usage.prompt_tokens_details.cached_tokens`, which not every
+    endpoint or client version reports; 0 if it is missing.
+
+    """
+
+    _details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(_details, dict):
+        _cached = _details.get("cached_tokens")
+    else:
+        _cached = getattr(_details, "cached_tokens", None)
+    return _cached if isinstance(_cached, int) else 0
+
+
+class PoolOptions(TypedDict, total=False):
+    """Optional settings of a new OpenAIConnection, see `get_connection`."""
+
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    timeout: float
+    max_concurrency: int
+    scheduler: RequestScheduler | None
+    retry: RetryPolicy | None
+    cassette: Cassette | None
+
+
+_connections: dict[tuple[str, str], OpenAIConnection] = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(
+    api_key: str,
+    endpoint_url: str = DEFAULT_ENDPOINT_URL,
+    **pool_options: Unpack[PoolOptions],
+) -> OpenAIConnection:
+    """Return the process-wide connection for an endpoint and key.
+
+    Parameters
+    ----------
+    api_key : str
+        The API key for the endpoint.
+    endpoint_url : str, optional
+        The base URL of the OAI-compatible endpoint.
+    **pool_options
+        Passed to `OpenAIConnection` when the connection is first created,
+        e.g. `max_connections`, `timeout` or `scheduler`. Ignored afterwards.
+
+    Returns
+    -------
+    OpenAIConnection
+        The shared connection. Every caller in the process (every Streamlit
+        session, every worker thread) gets the same instance.
+
+    """
+
+    _key = (endpoint_url, api_key)
+    with _connections_lock:
+        if _key not in _connections:
+            _connections[_key] = OpenAIConnection(
+                api_key=api_key,
+                endpoint_url=endpoint_url,
+                **pool_options,
+            )
+        return _connections[_key]
+
+
+def request_completion(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
     messages: list,
     model: str = "gpt-4o",
-) -> str:
+    *,
+    stream: bool = False,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = None,
+) -> str | Iterator[str]:
     """Request a completion from the OpenAI API.
 
     Parameters
     ----------
-    oaiconn : OpenAIConnection
-        An instance of the OpenAIConnection class.
+    oaiconn : OpenAIConnection or EndpointPool
+        The connection to use, or a pool that picks one for the request.
     messages : list of dict
         A list of dictionaries representing the messages to send to the API.
     model : str, optional
         The name of the model to use for the completion. Default is 'gpt-4o'.
+    stream : bool, optional
+        If True, return an iterator over the content chunks as they arrive
+        instead of waiting for the whole reply. Default is False.
+    usage : TokenUsage, optional
+        If given, the tokens used by this request are added to it.
+    max_tokens : int, optional
+        The most tokens the reply may have. A reply cut off at this limit is
+        counted in the connection's `truncated`. Default is no limit.
 
     Returns
     -------
-    str
-        The content of the completion message.
+    str or Iterator[str]
+        The content of the completion message, or an iterator over its
+        chunks when `stream` is True.
 
     Raises
     ------
     AssertionError
-        If `oaiconn` is not an instance of OpenAIConnection, or if any element
+        If `oaiconn` is not a connection or a pool, or if any element
         in `messages` is not a dictionary.
     ValueError
         If `messages` fails sanitization, if there is no usage information in
@@ -64,8 +497,7 @@ def request_completion(
     1. Asserts that `oaiconn` is an instance of OpenAIConnection and that all
        elements in `messages` are dictionaries.
     2. Sanitizes the messages.
-    3. Creates an OpenAI client using the API key and endpoint URL from
-       `oaiconn`.
+    3. Gets the pooled OpenAI client from `oaiconn`.
     4. Calls the OpenAI API to create a completion using the specified model
        and messages.
     5. Updates the stats of `oaiconn` using the completion response.
@@ -74,6 +506,173 @@ def request_completion(
 
     """
 
+    if isinstance(oaiconn, EndpointPool):
+        if stream:
+            return oaiconn.stream(
+                lambda _conn: request_completion(
+                    _conn,
+                    messages,
+                    model,
+                    stream=True,
+                    usage=usage,
+                    max_tokens=max_tokens,
+                ),
+                stage="completion",
+            )
+        return oaiconn.call(
+            lambda _conn: request_completion(
+                _conn,
+                messages,
+                model,
+                usage=usage,
+                max_tokens=max_tokens,
+            ),
+            stage="completion",
+        )
+
+    _prepare_messages(oaiconn, messages)
+
+    if stream:
+        return _stream_completion(oaiconn, messages, model, usage, max_tokens)
+
+    with stage("request_completion"):
+        _completion = _create_completion(oaiconn, model, messages, max_tokens)
+
+        return _completion_content(oaiconn, _completion, usage)
+
+
+async def request_completion_async(
+    oaiconn: OpenAIConnection | EndpointPool,
+    messages: list,
+    model: str = "gpt-4o",
+    *,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = None,
+) -> str:
+    """Request a completion from the OpenAI API without blocking a thread.
+
+    The async counterpart of `request_completion`. It uses the connection's
+    shared `AsyncOpenAI` client for the running event loop, and waits for a
+    slot under the connection's `max_concurrency` limit before sending.
+
+    Raises
+    ------
+    AssertionError, ValueError
+        As for `request_completion`.
+
+    """
+
+    if isinstance(oaiconn, EndpointPool):
+        return await oaiconn.call_async(
+            lambda _conn: request_completion_async(
+                _conn,
+                messages,
+                model,
+                usage=usage,
+                max_tokens=max_tokens,
+            ),
+            stage="completion",
+        )
+
+    _prepare_messages(oaiconn, messages)
+
+    with stage("request_completion"):
+        _completion = await _create_completion_async(
+            oaiconn,
+            model,
+            messages,
+            max_tokens,
+        )
+
+        return _completion_content(oaiconn, _completion, usage)
+
+
+def _create_completion(  # noqa: PLR0913
+    oaiconn: OpenAIConnection,
+    model: str,
+    messages: list,
+    max_tokens: int | None = None,
+    top_logprobs: int | None = None,
+    *,
+    kind: str = "completion",
+) -> ChatCompletion:
+    """Send a chat completion request once the rate limits allow it.
+
+    `kind` names the request for its latencies, see
+    `OpenAIConnection.latency`.
+
+    """
+
+    _estimate = oaiconn.reserve(messages)
+    _start = time.perf_counter()
+    try:
+        _completion = call_with_retries(
+            lambda _timeout: oaiconn.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=NOT_GIVEN if max_tokens is None else max_tokens,
+                logprobs=NOT_GIVEN if top_logprobs is None else True,
+                top_logprobs=NOT_GIVEN if top_logprobs is None else top_logprobs,
+                timeout=NOT_GIVEN if _timeout is None else _timeout,
+            ),
+            oaiconn.retry,
+            oaiconn.latency(kind, model),
+            on_discard=oaiconn.update_stats,
+        )
+    except Exception:
+        oaiconn.record_model(model, time.perf_counter() - _start, None)
+        raise
+    oaiconn.record_model(model, time.perf_counter() - _start, _completion)
+    oaiconn.settle(_estimate, _completion)
+    return _completion
+
+
+async def _create_completion_async(  # noqa: PLR0913
+    oaiconn: OpenAIConnection,
+    model: str,
+    messages: list,
+    max_tokens: int | None = None,
+    top_logprobs: int | None = None,
+    *,
+    kind: str = "completion",
+) -> ChatCompletion:
+    """Send a chat completion request without blocking the event loop.
+
+    The rate-limit wait runs in a worker thread, so async callers share the
+    same fair queue as threaded ones.
+
+    """
+
+    async with oaiconn.async_semaphore:
+        _estimate = 0.0
+        if oaiconn.scheduler is not None:
+            _estimate = await asyncio.to_thread(oaiconn.reserve, messages)
+        _start = time.perf_counter()
+        try:
+            _completion = await call_with_retries_async(
+                lambda _timeout: oaiconn.async_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=NOT_GIVEN if max_tokens is None else max_tokens,
+                    logprobs=NOT_GIVEN if top_logprobs is None else True,
+                    top_logprobs=NOT_GIVEN if top_logprobs is None else top_logprobs,
+                    timeout=NOT_GIVEN if _timeout is None else _timeout,
+                ),
+                oaiconn.retry,
+                oaiconn.latency(kind, model),
+                on_discard=oaiconn.update_stats,
+            )
+        except Exception:
+            oaiconn.record_model(model, time.perf_counter() - _start, None)
+            raise
+        oaiconn.record_model(model, time.perf_counter() - _start, _completion)
+    oaiconn.settle(_estimate, _completion)
+    return _completion
+
+
+def _prepare_messages(oaiconn: OpenAIConnection, messages: list) -> None:
+    """Validate the arguments of a completion request."""
+
     assert isinstance(
         oaiconn,
         OpenAIConnection,
@@ -88,27 +687,32 @@ def request_completion(
         log.error(_msg)
         raise ValueError(_msg)
 
-    _client = OpenAI(
-        api_key=oaiconn.api_key,
-        base_url=oaiconn.endpoint_url,
-    )
 
-    _completion = _client.chat.completions.create(
-        model=model,
-        messages=messages,
-    )
+def _completion_content(
+    oaiconn: OpenAIConnection,
+    completion: ChatCompletion,
+    usage: TokenUsage | None = None,
+    *,
+    record_finish: bool = True,
+) -> str:
+    """Record the usage of a completion and return its message content.
 
-    oaiconn.update_stats(_completion)
+    Single-token verdicts always stop at `max_tokens`, so they pass
+    `record_finish=False` to stay out of the truncation rate.
 
-    _msg = f"Received reply of {len(str(_completion.choices[0].message))} length."
+    """
 
-    _usage = _completion.usage
+    _usage = completion.usage
     if _usage is None:
         _msg = "No usage information in completion response"
         log.error(_msg)
         raise ValueError(_msg)
 
-    _completion_message = _completion.choices[0].message
+    oaiconn.update_stats(completion, usage)
+    if record_finish:
+        oaiconn.record_finish(completion.choices[0].finish_reason)
+
+    _completion_message = completion.choices[0].message
 
     if _completion_message is None:
         _msg = "No message in completion response"
@@ -120,9 +724,96 @@ def request_completion(
         log.error(_msg)
         raise ValueError(_msg)
 
+    _msg = f"Received reply of {len(_completion_message.content)} length."
+    log.debug(_msg)
+
     return _completion_message.content
 
 
+def _stream_completion(
+    oaiconn: OpenAIConnection,
+    messages: list,
+    model: str,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = None,
+) -> Iterator[str]:
+    """Yield the content of a streamed completion chunk by chunk.
+
+    Usage is requested with `stream_options` and arrives on the final chunk,
+    which has no choices. It is recorded in the `oaiconn` stats.
+
+    """
+
+    with stage("request_completion_stream"):
+        yield from _stream_chunks(oaiconn, messages, model, usage, max_tokens)
+
+
+def _stream_chunks(
+    oaiconn: OpenAIConnection,
+    messages: list,
+    model: str,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = None,
+) -> Iterator[str]:
+    """Open the stream and yield its content deltas."""
+
+    # Only opening the stream is retried; it is never hedged, and a stream
+    # that fails part-way raises to the caller.
+    _start = time.perf_counter()
+    _estimate = oaiconn.reserve(messages)
+    _last_chunk = None
+    try:
+        _stream = call_with_retries(
+            lambda _timeout: oaiconn.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                max_tokens=NOT_GIVEN if max_tokens is None else max_tokens,
+                timeout=NOT_GIVEN if _timeout is None else _timeout,
+            ),
+            oaiconn.retry,
+        )
+
+        _has_content = False
+        _has_usage = False
+        for _chunk in _stream:
+            _last_chunk = _chunk
+            if _chunk.usage is not None:
+                oaiconn.update_stats(_chunk, usage)
+                oaiconn.settle(_estimate, _chunk)
+                _has_usage = True
+
+            if not _chunk.choices:
+                continue
+
+            if _chunk.choices[0].finish_reason is not None:
+                oaiconn.record_finish(_chunk.choices[0].finish_reason)
+
+            _delta = _chunk.choices[0].delta.content
+            if _delta:
+                if not _has_content:
+                    STAGE_SECONDS.observe(
+                        time.perf_counter() - _start,
+                        stage="first_token",
+                    )
+                _has_content = True
+                yield _delta
+    except Exception:
+        oaiconn.record_model(model, time.perf_counter() - _start, None)
+        raise
+    oaiconn.record_model(model, time.perf_counter() - _start, _last_chunk)
+
+    if not _has_usage:
+        _msg = "No usage information in streamed completion"
+        log.warning(_msg)
+
+    if not _has_content:
+        _msg = "No content in completion message"
+        log.error(_msg)
+        raise ValueError(_msg)
+
+
 def sanitize_messages(messages: list) -> bool:
     """Sanitize messages for prompt injections.
 
@@ -158,62 +849,380 @@ def sanitize_messages(messages: list) -> bool:
     return True
 
 
-def check_completion(
-    oaiconn: OpenAIConnection,
+def check_completion(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
     completion_text: str,
     model: str = "gpt-4o",
+    *,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = CHECK_MAX_TOKENS,
+    fast: bool = False,
 ) -> bool:
-    """Check if the completion text is valid."""
+    """Check if the completion text is valid.
 
-    _system_msg = completion_check.system_msg
-    _prompt_msg = Template(completion_check.prompt_msg).substitute(
-        response=completion_text,
-    )
+    The model replies with the verdict and its reason in one go, within
+    `max_tokens`. With `fast`, the reply is a single-token verdict instead,
+    see check_verdict.
 
-    _messages = [
+    """
+
+    if fast:
+        _verdict = check_verdict(
+            oaiconn,
+            completion_text,
+            model,
+            usage=usage,
+            max_tokens=max_tokens,
+        )
+        return _verdict.accepted
+
+    if isinstance(oaiconn, EndpointPool):
+        return oaiconn.call(
+            lambda _conn: check_completion(
+                _conn,
+                completion_text,
+                model,
+                usage=usage,
+                max_tokens=max_tokens,
+                fast=False,
+            ),
+            stage="check",
+        )
+
+    _messages = _check_messages(completion_text)
+
+    with stage("check_completion"):
+        _completion = _create_completion(
+            oaiconn,
+            model,
+            _messages,
+            max_tokens,
+            kind="check",
+        )
+        _content = _completion_content(oaiconn, _completion, usage)
+
+    return _parse_verdict(_content)
+
+
+async def check_completion_async(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
+    completion_text: str,
+    model: str = "gpt-4o",
+    *,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = CHECK_MAX_TOKENS,
+    fast: bool = False,
+) -> bool:
+    """Check if the completion text is valid, without blocking a thread.
+
+    The model replies with the verdict and its reason in one go, within
+    `max_tokens`. With `fast`, the reply is a single-token verdict instead,
+    see check_verdict_async.
+
+    """
+
+    if fast:
+        _verdict = await check_verdict_async(
+            oaiconn,
+            completion_text,
+            model,
+            usage=usage,
+            max_tokens=max_tokens,
+        )
+        return _verdict.accepted
+
+    if isinstance(oaiconn, EndpointPool):
+        return await oaiconn.call_async(
+            lambda _conn: check_completion_async(
+                _conn,
+                completion_text,
+                model,
+                usage=usage,
+                max_tokens=max_tokens,
+                fast=False,
+            ),
+            stage="check",
+        )
+
+    _messages = _check_messages(completion_text)
+
+    with stage("check_completion"):
+        _completion = await _create_completion_async(
+            oaiconn,
+            model,
+            _messages,
+            max_tokens,
+            kind="check",
+        )
+        _content = _completion_content(oaiconn, _completion, usage)
+
+    return _parse_verdict(_content)
+
+
+@dataclass
+class Verdict:
+    """The outcome of a completion check.
+
+    `confidence` is the probability the model gave the verdict, against the
+    other one, or None if the endpoint returned no logprobs. `explanation`
+    is only asked for when the response is rejected.
+
+    """
+
+    accepted: bool
+    confidence: float | None = None
+    explanation: str | None = None
+
+
+def check_verdict(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
+    completion_text: str,
+    model: str = "gpt-4o",
+    *,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = CHECK_MAX_TOKENS,
+    explain: bool = True,
+) -> Verdict:
+    """Check the completion text with a single-token verdict.
+
+    The reply is limited to one token, and the verdict read from it with
+    its logprobs, so the check costs about one token of generation. Only if
+    the response is rejected, and `explain` is set, a follow-up asks why, in
+    at most `max_tokens`; it shares the check's prompt, so the endpoint can
+    serve it from its prompt cache.
+
+    Raises
+    ------
+    ValueError
+        If the reply is neither "Accepted" nor "Rejected".
+
+    """
+
+    if isinstance(oaiconn, EndpointPool):
+        return oaiconn.call(
+            lambda _conn: check_verdict(
+                _conn,
+                completion_text,
+                model,
+                usage=usage,
+                max_tokens=max_tokens,
+                explain=explain,
+            ),
+            stage="verdict",
+        )
+
+    _messages = _verdict_messages(completion_text)
+
+    with stage("check_completion"):
+        _completion = _create_completion(
+            oaiconn,
+            model,
+            _messages,
+            1,
+            VERDICT_TOP_LOGPROBS,
+            kind="verdict",
+        )
+        _content = _completion_content(
+            oaiconn,
+            _completion,
+            usage,
+            record_finish=False,
+        )
+    _verdict = _read_verdict(_content, _completion)
+
+    if not _verdict.accepted and explain:
+        with stage("explain_verdict"):
+            _completion = _create_completion(
+                oaiconn,
+                model,
+                _explain_messages(_messages, _content),
+                max_tokens,
+                kind="explain",
+            )
+            _verdict.explanation = _completion_content(oaiconn, _completion, usage)
+        _msg = f"Completion check rejected: {_verdict.explanation}"
+        log.error(_msg)
+
+    return _verdict
+
+
+async def check_verdict_async(  # noqa: PLR0913
+    oaiconn: OpenAIConnection | EndpointPool,
+    completion_text: str,
+    model: str = "gpt-4o",
+    *,
+    usage: TokenUsage | None = None,
+    max_tokens: int | None = CHECK_MAX_TOKENS,
+    explain: bool = True,
+) -> Verdict:
+    """Check the completion text with a single-token verdict, asynchronously.
+
+    See check_verdict.
+
+    """
+
+    if isinstance(oaiconn, EndpointPool):
+        return await oaiconn.call_async(
+            lambda _conn: check_verdict_async(
+                _conn,
+                completion_text,
+                model,
+                usage=usage,
+                max_tokens=max_tokens,
+                explain=explain,
+            ),
+            stage="verdict",
+        )
+
+    _messages = _verdict_messages(completion_text)
+
+    with stage("check_completion"):
+        _completion = await _create_completion_async(
+            oaiconn,
+            model,
+            _messages,
+            1,
+            VERDICT_TOP_LOGPROBS,
+            kind="verdict",
+        )
+        _content = _completion_content(
+            oaiconn,
+            _completion,
+            usage,
+            record_finish=False,
+        )
+    _verdict = _read_verdict(_content, _completion)
+
+    if not _verdict.accepted and explain:
+        with stage("explain_verdict"):
+            _completion = await _create_completion_async(
+                oaiconn,
+                model,
+                _explain_messages(_messages, _content),
+                max_tokens,
+                kind="explain",
+            )
+            _verdict.explanation = _completion_content(oaiconn, _completion, usage)
+        _msg = f"Completion check rejected: {_verdict.explanation}"
+        log.error(_msg)
+
+    return _verdict
+
+
+@timed("render")
+def _verdict_messages(completion_text: str) -> list[dict]:
+    """Render the messages for the single-token completion check."""
+
+    return [
         {
             "role": "system",
-            "content": _system_msg,
+            "content": completion_check.verdict_system_msg,
         },
         {
             "role": "user",
-            "content": _prompt_msg,
+            "content": Template(completion_check.verdict_prompt_msg).substitute(
+                response=completion_text,
+            ),
         },
     ]
 
-    _client = OpenAI(
-        api_key=oaiconn.api_key,
-        base_url=oaiconn.endpoint_url,
-    )
 
-    _completion = _client.chat.completions.create(
-        model=model,
-        messages=_messages,
-    )
+def _explain_messages(messages: list[dict], verdict: str) -> list[dict]:
+    """Return the messages that ask why the response was rejected."""
 
-    _msg = f"Received reply of {len(str(_completion.choices[0].message))} length."
+    return [
+        *messages,
+        {"role": "assistant", "content": verdict},
+        {"role": "user", "content": completion_check.explain_msg},
+    ]
 
-    _usage = _completion.usage
-    if _usage is None:
-        _msg = "No usage information in completion response"
-        log.error(_msg)
-        raise ValueError(_msg)
 
-    oaiconn.update_stats(_completion)
+def _verdict_of(token: str) -> bool | None:
+    """Return True for the start of "Accepted", False for "Rejected".
 
-    _completion_message = _completion.choices[0].message
+    A single token may hold only part of the word, e.g. "Rej" or "Accept",
+    but at least its first VERDICT_MIN_PREFIX letters; shorter tokens, such
+    as "A" or "Re", are ambiguous and return None.
 
-    if _completion_message is None:
-        _msg = "No message in completion response"
-        log.error(_msg)
-        raise ValueError(_msg)
+    """
 
-    if _completion_message.content is None:
-        _msg = "No content in completion message"
+    _match = _FIRST_WORD.match(token)
+    if _match is None:
+        return None
+    _word = _match.group(1).lower()
+    for _verdict, _stem, _expected in (
+        (True, "accept", "accepted"),
+        (False, "reject", "rejected"),
+    ):
+        if _word.startswith(_stem):
+            return _verdict
+        if len(_word) >= VERDICT_MIN_PREFIX and _expected.startswith(_word):
+            return _verdict
+    return None
+
+
+@timed("parse_verdict")
+def _read_verdict(content: str, completion: ChatCompletion) -> Verdict:
+    """Read a single-token verdict and its confidence from the logprobs."""
+
+    _accepted = _verdict_of(content)
+    if _accepted is None:
+        _msg = f"Invalid response from completion check: {content}"
         log.error(_msg)
         raise ValueError(_msg)
 
-    _first_word = message_words(_completion_message.content)[0].lower()
+    _confidence = None
+    _logprobs = completion.choices[0].logprobs
+    if _logprobs is not None and _logprobs.content:
+        _first = _logprobs.content[0]
+        _candidates = [
+            (_top.token, _top.logprob) for _top in _first.top_logprobs
+        ] or [(_first.token, _first.logprob)]
+        _probability = {True: 0.0, False: 0.0}
+        for _token, _logprob in _candidates:
+            _candidate_verdict = _verdict_of(_token)
+            if _candidate_verdict is not None:
+                _probability[_candidate_verdict] += math.exp(_logprob)
+        _total = _probability[True] + _probability[False]
+        if _total > 0:
+            _confidence = _probability[_accepted] / _total
+            CHECK_CONFIDENCE.observe(
+                _confidence,
+                verdict="accepted" if _accepted else "rejected",
+            )
+
+    return Verdict(accepted=_accepted, confidence=_confidence)
+
+
+@timed("render")
+def _check_messages(completion_text: str) -> list[dict]:
+    """Render the messages for the completion check."""
+
+    _system_msg = completion_check.system_msg
+    _prompt_msg = Template(completion_check.prompt_msg).substitute(
+        response=completion_text,
+    )
+
+    _messages = [
+        {
+            "role": "system",
+            "content": _system_msg,
+        },
+        {
+            "role": "user",
+            "content": _prompt_msg,
+        },
+    ]
+
+    return _messages
+
+
+@timed("parse_verdict")
+def _parse_verdict(content: str) -> bool:
+    """Read "Accepted" or "Rejected" from the completion check reply."""
+
+    _match = _FIRST_WORD.match(content)
+    _first_word = _match.group(1).lower() if _match else ""
 
     if _first_word == "accepted":
         return True
@@ -221,10 +1230,10 @@ def check_completion(
     if _first_word == "rejected":
         _msg = "Completion check rejected."
         log.error(_msg)
-        _msg = f"Completion check rejected: {_completion_message.content}"
+        _msg = f"Completion check rejected: {content}"
         log.error(_msg)
         return False
 
-    _msg = f"Invalid response from completion check: {_completion_message.content}"
+    _msg = f"Invalid response from completion check: {content}"
     log.error(_msg)
     raise ValueError(_msg)
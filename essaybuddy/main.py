@@ -1,9 +1,54 @@
 import logging
 import os
+import threading
+import time
+import uuid
+from collections.abc import Iterator
 
 import streamlit as st
-import tomlkit
-from essaylib import Essay, EssayOptions, run_request
+from balancer import EndpointPool
+from cache import ResponseCache, SessionResults
+from config import (
+    get_cassette,
+    get_chunk_settings,
+    get_config,
+    get_endpoint_pool,
+    get_essay_store,
+    get_incremental_settings,
+    get_job_runner,
+    get_model_router,
+    get_prechecker,
+    get_response_budget,
+    get_retry_policy,
+    get_scheduler,
+    get_settings,
+    get_store_writer,
+    validate_options,
+)
+from essaylib import (
+    Essay,
+    EssayOptions,
+    build_messages,
+    option_variants,
+    request_key,
+    revision_chunking,
+    run_request,
+    run_request_stream,
+)
+from jobs import DONE, QUEUED, RUNNING, JobRunner
+from llmlib import (
+    DEFAULT_ENDPOINT_URL,
+    OpenAIConnection,
+    TokenUsage,
+    get_connection,
+)
+from message_parser import warm_up
+from metrics import snapshot, stage, start_http_server, to_prometheus
+from precheck import Prechecker
+from routing import ModelRouter
+from scheduler import request_context
+from store import EssayStore, StoreWriter
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -28,127 +73,480 @@ if open_ai_key is None:
     raise ValueError(_msg)
 
 
-def get_config(config_file: str = "essaybuddy.toml") -> dict:
-    """Load and validate the configuration from a TOML file.
+@st.cache_resource
+def get_oaiconn() -> OpenAIConnection | EndpointPool:
+    """Return the connection shared by every session in this server process.
 
-    Parameters
-    ----------
-    config_file : str, optional
-        The path to the TOML configuration file. Default is "essaybuddy.toml".
+    The pool size and timeouts come from the [openai] table. If the
+    [balancer] table is enabled, a pool of its endpoints is returned instead.
+    If `warm_up` is set, a connection to each endpoint is opened here, at
+    startup, rather than on the first submit.
 
-    Returns
-    -------
-    dict
-        A dictionary containing the validated configuration options.
+    """
+
+    _settings = get_settings("openai")
+    _warm_up = _settings.pop("warm_up", False)
+    _endpoint_url = _settings.pop("endpoint_url", DEFAULT_ENDPOINT_URL)
+
+    _oaiconn = get_endpoint_pool() or get_connection(
+        api_key=open_ai_key,
+        endpoint_url=_endpoint_url,
+        scheduler=get_scheduler(),
+        retry=get_retry_policy(),
+        cassette=get_cassette(),
+        **_settings,
+    )
+
+    if _warm_up:
+        _oaiconn.warm_up()
+
+    return _oaiconn
+
+
+@st.cache_resource
+def get_cache() -> ResponseCache | None:
+    """Return the response cache shared by every session.
+
+    Configured by the [cache] table; returns None if it is disabled.
+
+    """
+
+    _settings = get_settings("cache")
+    if not _settings.pop("enabled", False):
+        return None
+
+    return ResponseCache(**_settings)
+
+
+@st.cache_resource
+def start_metrics_server() -> None:
+    """Serve the metrics for Prometheus, once per server process.
+
+    Configured by the [metrics] table; does nothing if `port` is not set.
+
+    """
+
+    _port = get_settings("metrics").get("port")
+    if _port:
+        start_http_server(_port)
+
+
+@st.cache_resource
+def preload_tokenizer() -> None:
+    """Load nltk and its models on a background thread, once per process.
+
+    Configured by `preload_tokenizer` in the [app] table. The first page
+    does not wait for it; the first long essay split into sentences does
+    not have to load them.
+
+    """
+
+    if get_settings("app").get("preload_tokenizer", False):
+        threading.Thread(target=warm_up, name="preload-tokenizer", daemon=True).start()
+
+
+@st.cache_resource
+def get_essay_writer(_store: EssayStore) -> StoreWriter | None:
+    """Return the background writer for essay saves, shared by every session.
+
+    Configured by the [autosave] table; None saves each essay at once.
+
+    """
+
+    return get_store_writer(_store)
+
+
+@st.cache_resource
+def get_shared_prechecker() -> Prechecker | None:
+    """Return the pre-check shared by every session, so its counts do too.
+
+    Configured by the [precheck] table; None if it is disabled.
+
+    """
+
+    return get_prechecker()
+
+
+@st.cache_resource
+def get_shared_router() -> ModelRouter | None:
+    """Return the model router shared by every session.
+
+    Every session learns from it which models are slow or failing.
+    Configured by the [routing] table; None if it is disabled.
+
+    """
+
+    return get_model_router()
 
-    Raises
-    ------
-    ValueError
-        If the required configuration options are not found in the TOML file.
 
-    Notes
-    -----
-    This function performs the following steps:
-    1. Load the configuration from the specified TOML file.
-    2. Check if the "prompt_options" section exists in the configuration.
-    3. Validate and extract the "authors", "audiences", "essay_types", and "essay_tones"
-    4. Return a dictionary containing the validated configuration options.
+@st.cache_resource
+def get_shared_job_runner() -> JobRunner:
+    """Return the worker pool that runs every session's evaluations.
+
+    Configured by the [jobs] table.
+
+    """
+
+    return get_job_runner()
+
+
+@st.cache_resource
+def get_shared_essay_store() -> EssayStore:
+    """Return the essay store shared by every session.
+
+    Each user's essays are kept under their id. Configured by the [store]
+    table.
 
     """
-    with open(config_file) as _toml:
-        _config = tomlkit.load(_toml)
 
-    if not _config.get("prompt", {}).get("options"):
-        _msg = f"[prompt.options] not found in {config_file}"
-        log.error(_msg)
-        raise ValueError(_msg)
+    return get_essay_store()
+
+
+def show_metrics() -> None:
+    """Show the stage latencies and rates in the sidebar."""
+
+    _snapshot = snapshot()
+    with st.sidebar.expander("Metrics"):
+        st.caption(
+            f"Cache hit rate {_snapshot['rates']['cache_hit_rate']:.0%},"
+            f" prompt cache {_snapshot['rates']['prompt_cache_hit_rate']:.0%},"
+            f" rejection rate {_snapshot['rates']['rejection_rate']:.0%},"
+            f" truncation rate {_snapshot['rates']['truncation_rate']:.0%},"
+            f" coalesced {_snapshot['rates']['coalesce_rate']:.0%}",
+        )
+        st.table(
+            {
+                _value["labels"]["stage"]: {
+                    "count": _value["count"],
+                    "mean": _value["mean"],
+                    "p95": _value["p95"],
+                }
+                for _value in _snapshot["essaybuddy_stage_seconds"]["values"]
+            },
+        )
+        st.download_button(
+            "Download (Prometheus)",
+            to_prometheus(),
+            file_name="essaybuddy.prom",
+        )
+
 
-    _prompt_options = _config["prompt"]["options"]
+def get_owner() -> str:
+    """Return the id of the user whose essays this session shows.
 
-    # "I am a..."
-    if not _prompt_options.get("authors"):
-        _msg = f"authors not found in {config_file}"
-        log.error(_msg)
-        raise ValueError(_msg)
+    The id is kept in the `user` query parameter, so bookmarking the page
+    brings a user back to their own essay. A new id is made if there is none.
 
-    _author_options = _prompt_options["authors"]
+    """
 
-    # "I am writing for..."
-    if not _prompt_options.get("audiences"):
-        _msg = f"audiences not found in {config_file}"
-        log.error(_msg)
-        raise ValueError(_msg)
+    if "user" not in st.query_params:
+        st.query_params["user"] = uuid.uuid4().hex
+    return st.query_params["user"]
 
-    _audience_options = _prompt_options["audiences"]
 
-    # "I am writing..."
-    if not _prompt_options.get("essay_types"):
-        _msg = f"essay_types not found in {config_file}"
-        log.error(_msg)
-        raise ValueError(_msg)
+def show_history(essay: Essay) -> int | None:
+    """Show the saved revisions in the sidebar and return the chosen one.
 
-    _type_options = _prompt_options["essay_types"]
+    Returns None for the latest revision.
 
-    # "The tone should be..."
-    if not _prompt_options.get("essay_tones"):
-        _msg = f"essay_tones not found in {config_file}"
-        log.error(_msg)
-        raise ValueError(_msg)
+    """
 
-    _tone_options = _prompt_options["essay_tones"]
+    _revisions = essay.history()
+    if len(_revisions) < 2:  # noqa: PLR2004
+        return None
 
-    return {
-        "author_options": _author_options,
-        "audience_options": _audience_options,
-        "type_options": _type_options,
-        "tone_options": _tone_options,
+    _labels = {
+        _revision.rev: f"#{_revision.rev}"
+        f" {time.strftime('%Y-%m-%d %H:%M', time.localtime(_revision.created))}"
+        f" ({_revision.size} chars)"
+        for _revision in _revisions
     }
+    _rev = st.sidebar.selectbox(
+        "History",
+        list(_labels),
+        format_func=lambda _rev: _labels[_rev],
+    )
+    return None if _rev == _revisions[0].rev else _rev
+
+
+def evaluate_essay(
+    essay: Essay,
+    essay_txt: str,
+    reviews: dict[str, str] | None,
+    **options: object,
+) -> str:
+    """Evaluate an essay and save its part reviews; run as a background job.
+
+    `options` are passed to `run_request`. The reviews are only saved if
+    the model was asked, not for an evaluation from the cache.
+
+    """
+
+    _usage = TokenUsage()
+    with stage("submit"):
+        _content = run_request(essay_txt, reviews=reviews, usage=_usage, **options)
+    # A cached evaluation, or one shared with an identical request, did not
+    # review this text's parts.
+    if reviews is not None and _usage.total_tokens > 0:
+        essay.save_reviews(essay_txt, reviews)
+    return _content
+
+
+def evaluate_essay_stream(
+    essay: Essay,
+    essay_txt: str,
+    reviews: dict[str, str] | None,
+    **options: object,
+) -> Iterator[str]:
+    """Stream the evaluation of an essay, like `evaluate_essay`.
+
+    The completion check runs after the last chunk and can still reject the
+    critique.
+
+    """
+
+    _usage = TokenUsage()
+    with stage("submit"):
+        yield from run_request_stream(
+            essay_txt,
+            reviews=reviews,
+            usage=_usage,
+            **options,
+        )
+    if reviews is not None and _usage.total_tokens > 0:
+        essay.save_reviews(essay_txt, reviews)
+
+
+def get_session_results() -> SessionResults:
+    """Return this session's latest evaluations.
+
+    They are kept in `st.session_state`, so they survive reruns and go away
+    with the session. The [app] table caps them with `results_per_session`
+    and `results_max_bytes`.
+
+    """
+
+    if "results" not in st.session_state:
+        _settings = get_settings("app")
+        st.session_state["results"] = SessionResults(
+            max_entries=_settings.get("results_per_session", 8),
+            max_bytes=_settings.get("results_max_bytes", 1024 * 1024),
+        )
+    return st.session_state["results"]
+
+
+def show_job_progress(jobs: JobRunner, job_id: str) -> None:
+    """Show a running evaluation; rerun the page once it has finished."""
+
+    _job = jobs.get(job_id)
+    if _job is None or _job.done:
+        st.rerun()
+
+    _elapsed = time.time() - _job.created
+    st.caption(f"Working on it... {_job.status} for {_elapsed:.0f}s")
+    if _job.chunks:
+        # The completion check runs once the stream ends, so this is only a
+        # draft until then; show_job replaces it with the outcome.
+        st.caption("Draft, not yet checked:")
+        with st.container(border=True):
+            st.write(_job.partial)
 
 
-def validate_options(config_options: dict, essay_options: EssayOptions) -> bool:
-    """Validate the essay options.
+def show_evaluation(
+    jobs: JobRunner,
+    results: SessionResults,
+    poll_seconds: float,
+) -> None:
+    """Show the outcome of this session's evaluations, one tab for each.
 
-    The reason for the dropdowns is to limit opportunities for injection.
-    This won't work very well if they bypass the dropdown via curl, or something.
-    1. Check that the author is in the list of valid authors.
-    2. Check that the audience is in the list of valid audiences.
-    3. Check that the essay type is in the list of valid essay types.
-    4. Check that the tone is in the list of valid tones.
+    While they run, only a fragment of the page is rerun to check on each,
+    so the essay can still be edited.
 
     """
 
-    # Check that the author is in the list of valid authors.
-    if essay_options["author"] not in config_options["author_options"]:
-        return False
+    _submitted = st.session_state.get("jobs", [])
+    if not _submitted:
+        st.write("### Results will show here after you submit the essay.")
+        return
+    if len(_submitted) == 1:
+        show_job(jobs, results, *_submitted[0][1:], poll_seconds)
+        return
 
-    # Check that the audience is in the list of valid audiences.
-    if essay_options["audience"] not in config_options["audience_options"]:
-        return False
+    _tabs = st.tabs([_label for _label, _key, _job_id in _submitted])
+    for _tab, (_label, _key, _job_id) in zip(_tabs, _submitted, strict=True):
+        with _tab:
+            show_job(jobs, results, _key, _job_id, poll_seconds)
 
-    # Check that the essay type is in the list of valid essay types.
-    if essay_options["essay_type"] not in config_options["type_options"]:
-        return False
 
-    # Check that the tone is in the list of valid tones.
-    if essay_options["tone"] not in config_options["tone_options"]:  # noqa: SIM103
-        return False
+def show_job(
+    jobs: JobRunner,
+    results: SessionResults,
+    key: str,
+    job_id: str | None,
+    poll_seconds: float,
+) -> None:
+    """Show the outcome of one evaluation, or its progress while it runs.
 
-    return True
+    A finished evaluation is kept in `results` under `key`, and shown from
+    there on later reruns.
+
+    """
+
+    _result = results.get(key)
+    if _result is not None:
+        st.write(_result)
+        return
+
+    _job = jobs.get(job_id) if job_id is not None else None
+    if _job is None:
+        st.write("### This evaluation has expired; please submit again.")
+    elif not _job.done:
+        st.experimental_fragment(run_every=poll_seconds)(show_job_progress)(
+            jobs,
+            job_id,
+        )
+    elif _job.status == DONE:
+        results.put(key, _job.result)
+        st.write(_job.result)
+    elif isinstance(_job.error, ValueError):
+        _msg = "The evaluation did not pass the completion check."
+        if _job.stream:
+            _msg += " The draft shown while it was written has been discarded."
+        st.error(_msg)
+    elif _job.error is not None:
+        st.error(f"The evaluation failed: {_job.error}")
+
+
+def submit_evaluations(
+    essay: Essay,
+    essay_txt: str,
+    variants: list[EssayOptions],
+    *,
+    quick: bool,
+) -> None:
+    """Save the essay and start evaluating it for each set of options.
+
+    Each set of options is its own job, so they run side by side on the
+    shared pool. An evaluation this session already has is shown again, and
+    one still running is kept; the others not started yet are replaced.
+    The jobs are kept in `st.session_state` for `show_evaluation`.
+
+    """
+
+    _config = get_config()
+    _app_settings = get_settings("app")
+    _max_variants = _app_settings.get("max_variants", 4)
+    if not variants or not all(
+        validate_options(_config, _options) for _options in variants
+    ):
+        st.error("Invalid options.")
+        return
+    if len(variants) > _max_variants:
+        st.error(
+            f"Choose at most {_max_variants} combinations of audience and tone.",
+        )
+        return
+
+    # In incremental mode, parts of the essay that did not change since the
+    # last evaluation reuse their reviews. They are kept for one set of
+    # options only.
+    _chunking = get_chunk_settings()
+    _incremental = get_incremental_settings()
+    _reviews = None
+    if _incremental is not None and len(variants) == 1:
+        _reviews = essay.load_reviews()
+        _chunking = revision_chunking(essay_txt, _chunking, _incremental)
+        _msg = f"Changed paragraphs: {essay.changed_paragraphs(essay_txt)}"
+        log.debug(_msg)
+
+    essay.save(essay_txt)
+
+    _jobs = get_shared_job_runner()
+    _results = get_session_results()
+    _model = _app_settings.get("model", "gpt-4o")
+    _budget = get_response_budget(quick=quick)
+    _previous = {
+        _key: _job_id for _label, _key, _job_id in st.session_state.get("jobs", [])
+    }
+    _submitted_jobs = []
+
+    # Requests wait in this session's queue under the rate limits.
+    _session_id = get_script_run_ctx().session_id
+    _stream = _app_settings.get("stream", False)
+    _submit = _jobs.submit_stream if _stream else _jobs.submit
+    with request_context(_session_id):
+        for _options in variants:
+            _key = request_key(
+                build_messages(essay_txt, _options, quick=quick),
+                essay_txt,
+                _options,
+                _model,
+                _budget,
+                get_shared_router(),
+            )
+            _job_id = _previous.pop(_key, None)
+            _job = _jobs.get(_job_id) if _job_id is not None else None
+            if _results.get(_key) is None and (
+                _job is None or _job.status not in (QUEUED, RUNNING, DONE)
+            ):
+                _job_id = _submit(
+                    evaluate_essay_stream if _stream else evaluate_essay,
+                    essay,
+                    essay_txt,
+                    reviews=_reviews,
+                    essay_options=_options,
+                    open_ai_key=open_ai_key,
+                    model=_model,
+                    oaiconn=get_oaiconn(),
+                    cache=get_cache(),
+                    chunking=_chunking,
+                    prechecker=get_shared_prechecker(),
+                    budget=_budget,
+                    router=get_shared_router(),
+                )
+            _label = f"{_options['audience']}, {_options['tone']}"
+            _submitted_jobs.append((_label, _key, _job_id))
+
+    for _job_id in _previous.values():
+        if _job_id is not None:
+            _jobs.cancel(_job_id)
+    st.session_state["jobs"] = _submitted_jobs
 
 
 def st_go() -> None:
     """Run the main Streamlit app."""
 
+    # Set the page title and icon. This must be the first Streamlit call.
+    st.set_page_config(page_title="Essay Buddy", page_icon=":pencil2:", layout="wide")
+
     _config: dict = get_config()
     assert isinstance(_config, dict), "_config should be a dictionary"
 
-    _essay = Essay()
-    _essay_txt = _essay.load()
-
-    # Set the page title and icon
-    st.set_page_config(page_title="Essay Buddy", page_icon=":pencil2:", layout="wide")
-
-    _content = "### Results will show here after you submit the essay."
+    _oaiconn = get_oaiconn()
+    _quick_budget = get_response_budget(quick=True)
+    start_metrics_server()
+    preload_tokenizer()
+    _jobs = get_shared_job_runner()
+    _jobs_settings = get_settings("jobs")
+    _results = get_session_results()
+
+    _store = get_shared_essay_store()
+    _writer = get_essay_writer(_store)
+    _essay = Essay(owner=get_owner(), store=_store, writer=_writer)
+    _essay_txt = _essay.load(show_history(_essay))
+
+    _connections = (
+        _oaiconn.connections if isinstance(_oaiconn, EndpointPool) else [_oaiconn]
+    )
+    for _connection in _connections:
+        if _connection.scheduler is None:
+            continue
+        _stats = _connection.scheduler.stats
+        st.sidebar.caption(
+            f"Queue: {_stats.queue_depth} waiting,"
+            f" mean wait {_stats.mean_wait:.1f}s, max {_stats.max_wait:.1f}s",
+        )
+    show_metrics()
 
     col1, col2 = st.columns(2)
     _submitted = False
@@ -156,10 +554,23 @@ def st_go() -> None:
     with col1, st.form("essay_form"):
         # build the selection boxes
         _author = st.selectbox("I am a...", _config["author_options"])
-        _audience = st.selectbox("I am writing for...", _config["audience_options"])
+        # Several audiences or tones are evaluated side by side.
+        _audiences = st.multiselect(
+            "I am writing for...",
+            _config["audience_options"],
+            default=[_config["audience_options"][0]],
+        )
         _essay_type = st.selectbox("I am writing...", _config["type_options"])
-        _tone = st.selectbox("The tone should be...", _config["tone_options"])
+        _tones = st.multiselect(
+            "The tone should be...",
+            _config["tone_options"],
+            default=[_config["tone_options"][0]],
+        )
         _essay_txt = st.text_area("Essay", value=_essay_txt, height=800)
+        _quick = _quick_budget is not None and st.checkbox(
+            "Quick review",
+            help="The three most important improvements, in a few seconds.",
+        )
 
         # Add a couple of buttons
         _button_col1, button_col2 = st.columns(2)
@@ -168,36 +579,20 @@ def st_go() -> None:
         with button_col2:
             _save = st.form_submit_button("Save")
 
-        _essay_options = EssayOptions(
-            {
-                "author": _author,
-                "audience": _audience,
-                "essay_type": _essay_type,
-                "tone": _tone,
-            },
+        _variants = option_variants(
+            EssayOptions(author=_author, essay_type=_essay_type),
+            audience=_audiences,
+            tone=_tones,
         )
 
     with col2:
         if _submitted:
-            if not validate_options(_config, _essay_options):
-                st.error("Invalid options.")
-                return
-
-            with st.spinner("Working on it..."):
-
-                _content = run_request(
-                    _essay_txt,
-                    essay_options=_essay_options,
-                    open_ai_key=open_ai_key,
-                    model="gpt-4o",
-                )
-
-                _essay.save(_essay_txt)
+            submit_evaluations(_essay, _essay_txt, _variants, quick=_quick)
 
         if _save:
             _essay.save(_essay_txt)
 
-        st.write(_content)
+        show_evaluation(_jobs, _results, _jobs_settings.get("poll_seconds", 1.0))
 
 
 if __name__ == "__main__":
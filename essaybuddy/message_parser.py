@@ -1,10 +1,164 @@
-from nltk.tokenize import word_tokenize
+import hashlib
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+# A Markdown ATX heading, e.g. "## Installation".
+_HEADING = re.compile(r"^#{1,6}\s")
+# The pattern of nltk's `wordpunct_tokenize`. nltk takes a fifth of a second
+# to import, so it is only imported by the functions that need its models.
+_WORDPUNCT = re.compile(r"\w+|[^\w\s]+")
+# A sentence end, used when nltk's punkt models are not installed.
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
 
 
 def message_words(message: str) -> list[str]:
     """Tokenize a message into words."""
 
+    from nltk.tokenize import NLTKWordTokenizer, word_tokenize
+
     # Tokenize the message into words
-    words = word_tokenize(message)
+    try:
+        words = word_tokenize(message)
+    except LookupError:
+        # word_tokenize needs punkt only to find the sentences.
+        _tokenizer = NLTKWordTokenizer()
+        words = [
+            _word
+            for _sentence in split_sentences(message)
+            for _word in _tokenizer.tokenize(_sentence)
+        ]
     # Return the list of words
     return words
+
+
+def split_sentences(text: str) -> list[str]:
+    """Split a text into sentences.
+
+    Uses nltk's `sent_tokenize`, or splits after ".", "!" and "?" if its
+    punkt models are not installed.
+
+    """
+
+    from nltk.tokenize import sent_tokenize
+
+    try:
+        return sent_tokenize(text)
+    except LookupError:
+        return [_sent for _sent in _SENTENCE_END.split(text.strip()) if _sent]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of model tokens in a text, locally.
+
+    Splits the text like nltk's regex-based `wordpunct_tokenize`, without
+    importing nltk, and counts long words as several tokens, as BPE
+    tokenizers do. It is an estimate for budgeting, not an exact count.
+
+    """
+
+    return sum(1 + len(_token) // 8 for _token in _WORDPUNCT.findall(text))
+
+
+def warm_up() -> bool:
+    """Import nltk and load its punkt models, so first use is not slow.
+
+    nltk loads the models lazily, on the first `word_tokenize` or
+    `sent_tokenize` of each process. Call this at startup, e.g. on a
+    background thread.
+
+    Returns
+    -------
+    bool
+        True if the models are installed. If they are not, a warning says
+        how to install them.
+
+    """
+
+    from nltk.tokenize import sent_tokenize, word_tokenize
+
+    try:
+        sent_tokenize("Warm up the models. Then split this.")
+        word_tokenize("Warm up the models.")
+    except LookupError:
+        _msg = (
+            "nltk's punkt models are not installed; run"
+            " `python -m nltk.downloader punkt` to split long paragraphs"
+        )
+        log.warning(_msg)
+        return False
+    return True
+
+
+def split_paragraphs(text: str) -> list[str]:
+    """Split a text into paragraphs at blank lines."""
+
+    return [_para.strip() for _para in re.split(r"\n\s*\n", text) if _para.strip()]
+
+
+def paragraph_hash(paragraph: str) -> str:
+    """Return a hash of a paragraph that ignores changes in whitespace."""
+
+    _normalized = " ".join(paragraph.split())
+    return hashlib.sha256(_normalized.encode("utf-8")).hexdigest()
+
+
+def split_essay(text: str, max_tokens: int, *, stable: bool = False) -> list[str]:
+    """Split an essay into chunks of at most about `max_tokens` tokens.
+
+    Chunks break at Markdown headings once they are at least half full, so
+    short sections are packed together, and otherwise at paragraph
+    boundaries. Paragraphs that are too long on their own are split into
+    sentences with `split_sentences`.
+
+    Parameters
+    ----------
+    text : str
+        The essay.
+    max_tokens : int
+        The target size of a chunk, as counted by `estimate_tokens`.
+    stable : bool, optional
+        If True, also end a chunk after any paragraph whose hash ends in 0-3,
+        about one paragraph in four. Boundaries then depend on the content
+        of the paragraphs rather than their positions, so editing one
+        paragraph usually changes only the chunk that contains it. Default is
+        False.
+
+    Returns
+    -------
+    list of str
+        The chunks in essay order. Joined with blank lines they contain the
+        whole essay.
+
+    """
+
+    _units = []
+    for _para in split_paragraphs(text):
+        if estimate_tokens(_para) <= max_tokens:
+            _units.append(_para)
+            continue
+        _units.extend(split_sentences(_para))
+
+    _chunks: list[str] = []
+    _current: list[str] = []
+    _current_tokens = 0
+    for _unit in _units:
+        _unit_tokens = estimate_tokens(_unit)
+        _starts_section = bool(_HEADING.match(_unit))
+        if _current and (
+            (_starts_section and _current_tokens >= max_tokens // 2)
+            or _current_tokens + _unit_tokens > max_tokens
+        ):
+            _chunks.append("\n\n".join(_current))
+            _current, _current_tokens = [], 0
+        _current.append(_unit)
+        _current_tokens += _unit_tokens
+        if stable and paragraph_hash(_unit)[-1] in "0123":
+            _chunks.append("\n\n".join(_current))
+            _current, _current_tokens = [], 0
+
+    if _current:
+        _chunks.append("\n\n".join(_current))
+
+    return _chunks
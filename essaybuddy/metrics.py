@@ -0,0 +1,505 @@
+import functools
+import logging
+import math
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, ParamSpec, TypeVar
+
+log = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+
+class _Metric:
+    """A named metric with one value per combination of label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        # A number, or a histogram's bucket counts, count and sum.
+        self._values: dict[tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        """Return the label values in declaration order."""
+
+        assert set(labels) == set(
+            self.labels,
+        ), f"{self.name} takes the labels {self.labels}, got {tuple(labels)}"
+        return tuple(str(labels[_name]) for _name in self.labels)
+
+    def _label_text(self, key: tuple[str, ...], extra: str = "") -> str:
+        """Return the Prometheus label set for a key."""
+
+        _pairs = [
+            f'{_name}="{_escape(_value)}"'
+            for _name, _value in zip(self.labels, key, strict=True)
+        ]
+        if extra:
+            _pairs.append(extra)
+        return "{" + ",".join(_pairs) + "}" if _pairs else ""
+
+    def items(self) -> list[tuple[tuple[str, ...], Any]]:
+        """Return a copy of the values by label key."""
+
+        with self._lock:
+            return [
+                (_key, _value.copy() if isinstance(_value, dict) else _value)
+                for _key, _value in self._values.items()
+            ]
+
+    def clear(self) -> None:
+        """Forget every value."""
+
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add `amount` to the counter for these labels."""
+
+        _key = self._key(labels)
+        with self._lock:
+            self._values[_key] = self._values.get(_key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Return the count for these labels."""
+
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down."""
+
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add `amount` to the gauge for these labels."""
+
+        _key = self._key(labels)
+        with self._lock:
+            self._values[_key] = self._values.get(_key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Subtract `amount` from the gauge for these labels."""
+
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        """Return the gauge for these labels."""
+
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Counts of observations in cumulative buckets, with their sum."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...],
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialize the Histogram class.
+
+        `buckets` are the upper bounds of the buckets, in any order; an
+        infinite bucket is always added on export.
+
+        """
+
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record one observation for these labels."""
+
+        _key = self._key(labels)
+        with self._lock:
+            _state = self._values.get(_key)
+            if _state is None:
+                _state = {
+                    "counts": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+                self._values[_key] = _state
+            for _index, _bound in enumerate(self.buckets):
+                if value <= _bound:
+                    _state["counts"][_index] += 1
+            _state["count"] += 1
+            _state["sum"] += value
+
+    def quantile(self, q: float, **labels: str) -> float | None:
+        """Estimate the `q` quantile from the buckets, or None if empty."""
+
+        with self._lock:
+            _state = self._values.get(self._key(labels))
+            if _state is None or _state["count"] == 0:
+                return None
+            _rank = q * _state["count"]
+            for _bound, _count in zip(self.buckets, _state["counts"], strict=True):
+                if _count >= _rank:
+                    return _bound
+        return math.inf
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class Registry:
+    """A named collection of metrics that can be exported together."""
+
+    def __init__(self) -> None:
+        """Initialize the Registry class."""
+
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: M) -> M:
+        """Add a metric, or return the one already registered by that name."""
+
+        with self._lock:
+            _existing = self._metrics.get(metric.name)
+            if _existing is not None:
+                if type(_existing) is not type(metric):
+                    _msg = f"Metric {metric.name} is already a {_existing.kind}"
+                    log.error(_msg)
+                    raise ValueError(_msg)
+                return _existing  # type: ignore[return-value]
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+    ) -> Counter:
+        """Return the counter called `name`, creating it if needed."""
+
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Gauge:
+        """Return the gauge called `name`, creating it if needed."""
+
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Return the histogram called `name`, creating it if needed."""
+
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def clear(self) -> None:
+        """Reset every metric to empty, keeping the registrations."""
+
+        with self._lock:
+            _metrics = list(self._metrics.values())
+        for _metric in _metrics:
+            _metric.clear()
+
+    def to_prometheus(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+
+        with self._lock:
+            _metrics = list(self._metrics.values())
+
+        _lines = []
+        for _metric in _metrics:
+            _lines.append(f"# HELP {_metric.name} {_metric.help_text}")
+            _lines.append(f"# TYPE {_metric.name} {_metric.kind}")
+            for _key, _value in sorted(_metric.items()):
+                if isinstance(_metric, Histogram):
+                    for _bound, _count in zip(
+                        _metric.buckets,
+                        _value["counts"],
+                        strict=True,
+                    ):
+                        _labels = _metric._label_text(_key, f'le="{_bound}"')  # noqa: SLF001
+                        _lines.append(f"{_metric.name}_bucket{_labels} {_count}")
+                    _labels = _metric._label_text(_key, 'le="+Inf"')  # noqa: SLF001
+                    _lines.append(f"{_metric.name}_bucket{_labels} {_value['count']}")
+                    _labels = _metric._label_text(_key)  # noqa: SLF001
+                    _lines.append(f"{_metric.name}_sum{_labels} {_value['sum']}")
+                    _lines.append(f"{_metric.name}_count{_labels} {_value['count']}")
+                else:
+                    _labels = _metric._label_text(_key)  # noqa: SLF001
+                    _lines.append(f"{_metric.name}{_labels} {_value}")
+        return "\n".join(_lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Return every metric as plain values, ready for `json.dumps`.
+
+        Histograms are summarised by their count, sum, mean and estimated
+        p50 and p95.
+
+        """
+
+        with self._lock:
+            _metrics = list(self._metrics.values())
+
+        _snapshot: dict = {}
+        for _metric in _metrics:
+            _values = []
+            for _key, _value in sorted(_metric.items()):
+                _labels = dict(zip(_metric.labels, _key, strict=True))
+                if isinstance(_metric, Histogram):
+                    _count = _value["count"]
+                    _values.append(
+                        {
+                            "labels": _labels,
+                            "count": _count,
+                            "sum": round(_value["sum"], 6),
+                            "mean": round(_value["sum"] / _count, 6) if _count else 0,
+                            "p50": _metric.quantile(0.5, **_labels),
+                            "p95": _metric.quantile(0.95, **_labels),
+                        },
+                    )
+                else:
+                    _values.append({"labels": _labels, "value": _value})
+            _snapshot[_metric.name] = {"type": _metric.kind, "values": _values}
+
+        return _snapshot
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _rate(part: float, total: float) -> float:
+    """Return part / total, or 0 when there is nothing to divide."""
+
+    return round(part / total, 4) if total else 0.0
+
+
+# The process-wide metrics. Every stage of a submit is timed into
+# STAGE_SECONDS, and the calls currently inside it are counted in IN_FLIGHT.
+# `start_http_server` serves them for scraping.
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "essaybuddy_stage_seconds",
+    "Seconds spent in each stage of an evaluation.",
+    ("stage",),
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "essaybuddy_stage_errors_total",
+    "Stages that ended with an exception.",
+    ("stage",),
+)
+IN_FLIGHT = REGISTRY.gauge(
+    "essaybuddy_in_flight",
+    "Calls currently inside each stage.",
+    ("stage",),
+)
+TOKENS = REGISTRY.counter(
+    "essaybuddy_tokens_total",
+    "Tokens used, by endpoint and kind; cached tokens are the request tokens"
+    " served from the endpoint's prompt cache.",
+    ("endpoint", "kind"),
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "essaybuddy_cache_lookups_total",
+    "Response cache lookups, by result.",
+    ("result",),
+)
+CHECKS = REGISTRY.counter(
+    "essaybuddy_completion_checks_total",
+    "Completion checks, by who decided and the verdict.",
+    ("checker", "verdict"),
+)
+CHECK_CONFIDENCE = REGISTRY.histogram(
+    "essaybuddy_check_confidence",
+    "Confidence of single-token completion check verdicts, from logprobs.",
+    ("verdict",),
+    (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0),
+)
+COALESCED = REGISTRY.counter(
+    "essaybuddy_coalesced_requests_total",
+    'Evaluations by role: "leader" called the endpoint, "joined" shared'
+    " the result of an identical one in flight.",
+    ("role",),
+)
+COMPLETIONS = REGISTRY.counter(
+    "essaybuddy_completions_total",
+    'Completions, by endpoint and finish reason; "length" hit max_tokens.',
+    ("endpoint", "finish_reason"),
+)
+MODEL_REQUESTS = REGISTRY.counter(
+    "essaybuddy_model_requests_total",
+    "Routed requests, by stage, model and outcome.",
+    ("stage", "model", "outcome"),
+)
+JOBS = REGISTRY.gauge(
+    "essaybuddy_jobs",
+    "Background jobs queued or running.",
+    ("state",),
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the enclosed block as one run of the stage `name`."""
+
+    IN_FLIGHT.inc(stage=name)
+    _start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - _start, stage=name)
+        IN_FLIGHT.dec(stage=name)
+
+
+def timed(name: str) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    """Time every call of the decorated function as the stage `name`."""
+
+    def _decorator(func: Callable[P, T]) -> Callable[P, T]:
+        @functools.wraps(func)
+        def _wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
+
+
+def to_prometheus() -> str:
+    """Return the process-wide registry in the Prometheus text format."""
+
+    return REGISTRY.to_prometheus()
+
+
+def snapshot() -> dict:
+    """Return the process-wide registry as plain values.
+
+    A "rates" entry adds the response cache hit rate, the share of request
+    tokens served from the endpoints' prompt caches, the completion check
+    rejection rate, the share of completions cut off by `max_tokens`, and
+    the share of evaluations that joined an identical one in flight.
+
+    """
+
+    _snapshot = REGISTRY.snapshot()
+    _hits = CACHE_LOOKUPS.value(result="hit")
+    _lookups = _hits + CACHE_LOOKUPS.value(result="miss")
+    _checks = dict(CHECKS.items())
+    _rejected = sum(
+        _count
+        for (_checker, _verdict), _count in _checks.items()
+        if _verdict == "rejected"
+    )
+    _tokens = dict(TOKENS.items())
+    _request_tokens = sum(
+        _count for (_endpoint, _kind), _count in _tokens.items() if _kind == "request"
+    )
+    _cached_tokens = sum(
+        _count for (_endpoint, _kind), _count in _tokens.items() if _kind == "cached"
+    )
+    _completions = COMPLETIONS.items()
+    _joined = COALESCED.value(role="joined")
+    _snapshot["rates"] = {
+        "cache_hit_rate": _rate(_hits, _lookups),
+        "coalesce_rate": _rate(_joined, _joined + COALESCED.value(role="leader")),
+        "prompt_cache_hit_rate": _rate(_cached_tokens, _request_tokens),
+        "rejection_rate": _rate(_rejected, sum(_checks.values())),
+        "truncation_rate": _rate(
+            sum(
+                _count
+                for (_endpoint, _reason), _count in _completions
+                if _reason == "length"
+            ),
+            sum(_count for _key, _count in _completions),
+        ),
+    }
+    return _snapshot
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the registry at /metrics on a background thread.
+
+    Parameters
+    ----------
+    port : int
+        The port to listen on.
+    host : str, optional
+        The address to bind. Default is localhost only.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The running server; call `shutdown` on it to stop.
+
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt: str, *args: object) -> None:
+            log.debug(fmt, *args)
+
+        def do_GET(self) -> None:  # noqa: N802
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            _body = to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+    _server = ThreadingHTTPServer((host, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(
+        target=_server.serve_forever,
+        name="metrics-server",
+        daemon=True,
+    ).start()
+
+    _msg = f"Serving metrics at http://{host}:{port}/metrics"
+    log.info(_msg)
+    return _server
@@ -0,0 +1,193 @@
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from enum import Enum
+
+log = logging.getLogger(__name__)
+
+# Kept short on purpose: it catches the clear-cut cases, and anything it
+# misses still goes to the LLM check when the other signals are unsure.
+DEFAULT_PROFANITY = (
+    "asshole",
+    "bastard",
+    "bitch",
+    "bullshit",
+    "crap",
+    "damn",
+    "dick",
+    "fuck",
+    "fucking",
+    "motherfucker",
+    "piss",
+    "shit",
+    "slut",
+    "whore",
+)
+
+_WORD = re.compile(r"\w+")
+
+# A numbered item, a bullet or a Markdown heading at the start of a line.
+_STRUCTURE = re.compile(r"^\s*(\d+\.|[-*]|#{1,6})\s", re.MULTILINE)
+
+
+class Verdict(Enum):
+    """The outcome of the local pre-check."""
+
+    ACCEPT = "accept"
+    REJECT = "reject"
+    UNCERTAIN = "uncertain"
+
+
+@dataclass
+class PrecheckStats:
+    """Counts of how evaluations were checked."""
+
+    local_accepts: int = 0
+    local_rejects: int = 0
+    llm_checks: int = 0
+
+    @property
+    def skip_rate(self) -> float:
+        """Return the fraction of checks decided without the LLM."""
+
+        _total = self.local_accepts + self.local_rejects + self.llm_checks
+        if _total == 0:
+            return 0.0
+        return (self.local_accepts + self.local_rejects) / _total
+
+
+class Prechecker:
+    """A fast, local stand-in for the completion check.
+
+    It decides the clear-cut cases and leaves the rest to the LLM:
+
+    - An evaluation that shares many word n-grams with the essay has
+      probably rewritten it, and is rejected. Short quotes are expected, so
+      only a high overlap counts.
+    - Profanity that is not in the essay itself is rejected.
+    - An evaluation that is long enough, has the expected structure of
+      numbered items, bullets or headings, and barely overlaps the essay is
+      accepted.
+
+    Attributes
+    ----------
+    stats : PrecheckStats
+        How many checks were decided locally and how many went to the LLM.
+
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        ngram_size: int = 8,
+        accept_overlap: float = 0.15,
+        reject_overlap: float = 0.5,
+        min_words: int = 80,
+        min_structure_lines: int = 3,
+        profanity: list[str] | None = None,
+    ) -> None:
+        """Initialize the Prechecker class.
+
+        Parameters
+        ----------
+        ngram_size : int, optional
+            The length of the word n-grams compared with the essay.
+        accept_overlap : float, optional
+            The highest share of the evaluation's n-grams found in the essay
+            for it to be accepted locally.
+        reject_overlap : float, optional
+            The share of n-grams found in the essay at which the evaluation
+            is rejected as a rewrite.
+        min_words : int, optional
+            The fewest words an evaluation needs to be accepted locally.
+        min_structure_lines : int, optional
+            The fewest numbered, bulleted or heading lines it needs.
+        profanity : list of str, optional
+            The words to reject. Default is `DEFAULT_PROFANITY`.
+
+        """
+
+        self.ngram_size = ngram_size
+        self.accept_overlap = accept_overlap
+        self.reject_overlap = reject_overlap
+        self.min_words = min_words
+        self.min_structure_lines = min_structure_lines
+        self.profanity = frozenset(
+            _word.lower() for _word in (profanity or DEFAULT_PROFANITY)
+        )
+        self.stats = PrecheckStats()
+        self._lock = threading.Lock()
+
+    def check(self, completion_text: str, essay_text: str) -> Verdict:
+        """Decide whether an evaluation is acceptable, if it is clear-cut.
+
+        Parameters
+        ----------
+        completion_text : str
+            The evaluation returned by the model.
+        essay_text : str
+            The essay that was evaluated.
+
+        Returns
+        -------
+        Verdict
+            ACCEPT or REJECT if the case is clear, otherwise UNCERTAIN, and
+            the caller should ask the LLM.
+
+        """
+
+        _verdict = self._verdict(completion_text, essay_text)
+
+        with self._lock:
+            if _verdict is Verdict.ACCEPT:
+                self.stats.local_accepts += 1
+            elif _verdict is Verdict.REJECT:
+                self.stats.local_rejects += 1
+            else:
+                self.stats.llm_checks += 1
+
+        return _verdict
+
+    def _verdict(self, completion_text: str, essay_text: str) -> Verdict:
+        """Apply the rules, without touching the stats."""
+
+        _words = [_word.lower() for _word in _WORD.findall(completion_text)]
+        _essay_words = [_word.lower() for _word in _WORD.findall(essay_text)]
+
+        _swearing = (self.profanity & set(_words)) - set(_essay_words)
+        if _swearing:
+            _msg = f"Pre-check rejected: profanity {sorted(_swearing)}"
+            log.error(_msg)
+            return Verdict.REJECT
+
+        _overlap = self.overlap(_words, _essay_words)
+        if _overlap >= self.reject_overlap:
+            _msg = f"Pre-check rejected: {_overlap:.0%} overlap with the essay"
+            log.error(_msg)
+            return Verdict.REJECT
+
+        _structure_lines = len(_STRUCTURE.findall(completion_text))
+        if (
+            _overlap <= self.accept_overlap
+            and len(_words) >= self.min_words
+            and _structure_lines >= self.min_structure_lines
+        ):
+            return Verdict.ACCEPT
+
+        return Verdict.UNCERTAIN
+
+    def overlap(self, words: list[str], essay_words: list[str]) -> float:
+        """Return the share of the n-grams of `words` that are in the essay."""
+
+        _size = self.ngram_size
+        _ngrams = {
+            tuple(words[_i : _i + _size]) for _i in range(len(words) - _size + 1)
+        }
+        if not _ngrams:
+            return 0.0
+
+        _essay_ngrams = {
+            tuple(essay_words[_i : _i + _size])
+            for _i in range(len(essay_words) - _size + 1)
+        }
+        return len(_ngrams & _essay_ngrams) / len(_ngrams)
@@ -0,0 +1,25 @@
+# Prompts for essays too long to review in one request. Each part is reviewed
+# with the `map` prompt, then the reviews are merged with the `reduce` prompt.
+# Both use the system message from prompts.essay, so the merged review has the
+# same format as a single one. As in prompts.essay, the author, audience and
+# tone line comes last, so the endpoint can reuse the cached prefix.
+
+map_prompt_msg = """
+The essay is too long to review at once, so it has been split into $parts parts.
+Please review only part $part. Keep in mind it is not the whole essay.
+
+$chunk_txt
+
+I am a $author, writing a $essay_type. The target audience is $audience. The tone should be $tone.
+"""
+
+reduce_prompt_msg = """
+My essay was reviewed in $parts parts. These are the reviews of each part:
+
+$reviews
+
+Please combine them into one review of the whole essay, following your
+instructions. Do not mention the parts, and do not repeat the same point twice.
+
+I am a $author, writing a $essay_type. The target audience is $audience. The tone should be $tone.
+"""
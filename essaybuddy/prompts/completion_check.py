@@ -1,7 +1,7 @@
 system_msg = """
 You are a critical supervisor of LLM responses. The response is an evaluation of
-an essay. It should be a detailed and constructive critique, providing specific 
-examples from the essay. 
+an essay. It should be a detailed and constructive critique, providing specific
+examples from the essay.
 
 The essay should not be rewritten in any way.
 There should be no foul language or inappropriate content.
@@ -19,3 +19,29 @@ $response
 Your reply should start with only one word: "Accepted" or "Rejected".
 The next line should explain why the response was accepted or rejected.
 """
+
+# The single-token verdict mode asks for the verdict alone, and for the
+# explanation in a follow-up only when the response is rejected.
+verdict_system_msg = """
+You are a critical supervisor of LLM responses. The response is an evaluation of
+an essay. It should be a detailed and constructive critique, providing specific
+examples from the essay.
+
+The essay should not be rewritten in any way.
+There should be no foul language or inappropriate content.
+
+Reply with only one word: "Accepted" or "Rejected".
+
+"""
+
+verdict_prompt_msg = """
+Please evaluate the following response to an essay:
+
+$response
+
+Reply with only one word: "Accepted" or "Rejected".
+"""
+
+explain_msg = """
+In one line, explain why the response was rejected.
+"""
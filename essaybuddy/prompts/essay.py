@@ -1,3 +1,11 @@
+# Bump when the templates change, so cached evaluations are not reused.
+prompt_version = "2"
+
+# Endpoints cache the longest prompt prefix they have seen before, which
+# cuts the time to first token. Keep the fixed text first and the parts that
+# vary most last: the essay comes before the author, audience and tone line,
+# so evaluating the same essay again with other options reuses the prefix.
+
 system_msg = """
 You are a helpful tutor for English essays. You will be given an essay to evaluate.
 You will provide feedback to help improve the essay.
@@ -21,9 +29,16 @@ Your task is to:
 """
 
 prompt_msg = """
-I am a $author, writing a $essay_type. The target audience is $audience. The tone should be $tone.
-
 Please review this essay:
 
 $essay_txt
+
+I am a $author, writing a $essay_type. The target audience is $audience. The tone should be $tone.
+"""
+
+# Appended to the user message for a quick review, which has a tight token
+# budget.
+quick_msg = """
+This is a quick review: give only the three most important improvements,
+one or two sentences each, and no other sections.
 """
@@ -0,0 +1,450 @@
+import asyncio
+import collections
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+from openai import APIConnectionError, APIStatusError
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hedged duplicates run here, so a slow primary does not hold up a new call.
+_hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+# Async hedges that lost the race, kept until they finish and are counted.
+_discarded: set[asyncio.Future] = set()
+
+
+class LatencyTracker:
+    """A window of recent request latencies, for picking a hedge delay."""
+
+    def __init__(self, window: int = 200) -> None:
+        """Initialize the LatencyTracker class.
+
+        Parameters
+        ----------
+        window : int, optional
+            How many recent latencies to keep. Default is 200.
+
+        """
+
+        self._samples: collections.deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        """Add a latency sample."""
+
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        """Return the number of samples."""
+
+        return len(self._samples)
+
+    def quantile(self, q: float) -> float | None:
+        """Return the `q` quantile of the window, or None if it is empty."""
+
+        with self._lock:
+            _samples = sorted(self._samples)
+        if not _samples:
+            return None
+        return _samples[min(len(_samples) - 1, int(q * len(_samples)))]
+
+
+@dataclass
+class RetryStats:
+    """Counts of retries and hedges.
+
+    A policy is shared by every thread that uses its connection, so the
+    counts are added with `count`, under a lock.
+    """
+
+    attempts: int = 0
+    retries: int = 0
+    hedges_fired: int = 0
+    hedges_won: int = 0
+    deadline_exceeded: int = 0
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock,
+        repr=False,
+        compare=False,
+    )
+
+    def count(self, name: str) -> None:
+        """Add one to the count `name`, e.g. "retries"."""
+
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+@dataclass
+class RetryPolicy:
+    """How to retry and hedge a request.
+
+    Only errors that are safe to retry are retried: connection errors and
+    timeouts, and the HTTP statuses in `retry_statuses`. A chat completion
+    has no side effects, so sending it again is harmless.
+
+    Attributes
+    ----------
+    max_attempts : int
+        The most times a request is sent, counting the first.
+    base_delay, max_delay : float
+        The backoff before retry n is drawn uniformly from
+        [0, min(max_delay, base_delay * 2 ** n)] ("full jitter"), unless the
+        server sent a Retry-After header, which is honored instead.
+    retry_statuses : tuple of int
+        The HTTP statuses to retry.
+    deadline : float or None
+        The most seconds a call may take across all attempts and backoff.
+    hedge : bool
+        If True, send a duplicate request when the first has not answered
+        after the `hedge_quantile` latency of recent requests, and take
+        whichever answers first.
+    hedge_quantile : float
+        The latency quantile after which to hedge. Default is p95.
+    hedge_min_samples : int
+        Do not hedge until this many latencies have been recorded.
+
+    """
+
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 20.0
+    retry_statuses: tuple[int, ...] = (408, 409, 429, 500, 502, 503, 504)
+    deadline: float | None = None
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_samples: int = 20
+    stats: RetryStats = field(default_factory=RetryStats, compare=False)
+
+    def is_retryable(self, error: Exception) -> bool:
+        """Return True if the request that raised `error` may be retried."""
+
+        if isinstance(error, APIConnectionError):
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code in self.retry_statuses
+        return False
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """Return the seconds to wait before retry number `attempt`."""
+
+        _retry_after = retry_after(error)
+        if _retry_after is not None:
+            return min(_retry_after, self.max_delay)
+
+        _cap = min(self.max_delay, self.base_delay * 2**attempt)
+        return random.uniform(0, _cap)  # noqa: S311
+
+    def hedge_delay(self, latency: LatencyTracker | None) -> float | None:
+        """Return when to hedge a request, or None to not hedge it."""
+
+        if (
+            not self.hedge
+            or latency is None
+            or len(latency) < self.hedge_min_samples
+        ):
+            return None
+        return latency.quantile(self.hedge_quantile)
+
+
+def retry_after(error: Exception) -> float | None:
+    """Return the delay asked for by a Retry-After header, in seconds."""
+
+    if not isinstance(error, APIStatusError):
+        return None
+
+    _headers = error.response.headers
+    _value = _headers.get("retry-after-ms")
+    if _value is not None:
+        try:
+            return float(_value) / 1000
+        except ValueError:
+            pass
+
+    _value = _headers.get("retry-after")
+    if _value is None:
+        return None
+    try:
+        return float(_value)
+    except ValueError:
+        pass
+    try:
+        _date = email.utils.parsedate_to_datetime(_value)
+    except (TypeError, ValueError):
+        # A malformed header; the jittered backoff applies instead.
+        _msg = f"Ignoring malformed Retry-After header {_value!r}"
+        log.warning(_msg)
+        return None
+    return max(0.0, _date.timestamp() - time.time())
+
+
+def call_with_retries(
+    send: Callable[[float | None], T],
+    policy: RetryPolicy | None,
+    latency: LatencyTracker | None = None,
+    on_discard: Callable[[T], None] | None = None,
+) -> T:
+    """Call `send`, retrying and hedging it according to `policy`.
+
+    Parameters
+    ----------
+    send : callable
+        Sends the request. Takes the timeout for this attempt in seconds, or
+        None for the client default.
+    policy : RetryPolicy or None
+        None sends the request once.
+    latency : LatencyTracker, optional
+        Records the latency of successful attempts and sets the hedge delay.
+        Without it, the request is never hedged.
+    on_discard : callable, optional
+        Called with the result of a hedged request that lost the race, so
+        its token usage can still be counted.
+
+    Returns
+    -------
+    The result of the first successful attempt.
+
+    Raises
+    ------
+    Exception
+        The last error, if it is not retryable or the attempts or the
+        deadline ran out. TimeoutError if the deadline passed while waiting.
+
+    """
+
+    if policy is None:
+        return _timed(send, None, latency)
+
+    _deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+    _attempt = 0
+    while True:
+        _timeout = _remaining(_deadline, policy)
+        policy.stats.count("attempts")
+        try:
+            _hedge_delay = policy.hedge_delay(latency)
+            if _hedge_delay is None:
+                return _timed(send, _timeout, latency)
+            return _hedged(send, _timeout, _hedge_delay, latency, policy, on_discard)
+        except Exception as e:
+            _attempt += 1
+            if not policy.is_retryable(e) or _attempt >= policy.max_attempts:
+                raise
+            _delay = policy.backoff(_attempt, e)
+            if _deadline is not None and time.monotonic() + _delay >= _deadline:
+                policy.stats.count("deadline_exceeded")
+                raise
+            policy.stats.count("retries")
+            _msg = f"Retrying in {_delay:.2f}s after attempt {_attempt}: {e}"
+            log.warning(_msg)
+            time.sleep(_delay)
+
+
+async def call_with_retries_async(
+    send: Callable[[float | None], Awaitable[T]],
+    policy: RetryPolicy | None,
+    latency: LatencyTracker | None = None,
+    on_discard: Callable[[T], None] | None = None,
+) -> T:
+    """Await `send`, retrying and hedging it according to `policy`.
+
+    The async counterpart of `call_with_retries`. With `on_discard`, a
+    hedged request that loses the race is left to finish so its usage can
+    be counted; without it, the loser is cancelled.
+
+    """
+
+    if policy is None:
+        return await _timed_async(send, None, latency)
+
+    _deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+    _attempt = 0
+    while True:
+        _timeout = _remaining(_deadline, policy)
+        policy.stats.count("attempts")
+        try:
+            _hedge_delay = policy.hedge_delay(latency)
+            if _hedge_delay is None:
+                return await _timed_async(send, _timeout, latency)
+            return await _hedged_async(
+                send,
+                _timeout,
+                _hedge_delay,
+                latency,
+                policy,
+                on_discard,
+            )
+        except Exception as e:
+            _attempt += 1
+            if not policy.is_retryable(e) or _attempt >= policy.max_attempts:
+                raise
+            _delay = policy.backoff(_attempt, e)
+            if _deadline is not None and time.monotonic() + _delay >= _deadline:
+                policy.stats.count("deadline_exceeded")
+                raise
+            policy.stats.count("retries")
+            _msg = f"Retrying in {_delay:.2f}s after attempt {_attempt}: {e}"
+            log.warning(_msg)
+            await asyncio.sleep(_delay)
+
+
+def _remaining(deadline: float | None, policy: RetryPolicy) -> float | None:
+    """Return the time left before the deadline, or raise if it has passed."""
+
+    if deadline is None:
+        return None
+
+    _left = deadline - time.monotonic()
+    if _left <= 0:
+        policy.stats.count("deadline_exceeded")
+        _msg = "Request deadline exceeded"
+        log.error(_msg)
+        raise TimeoutError(_msg)
+    return _left
+
+
+def _timed(
+    send: Callable[[float | None], T],
+    timeout: float | None,
+    latency: LatencyTracker | None,
+) -> T:
+    """Send once and record the latency of a success."""
+
+    _start = time.monotonic()
+    _result = send(timeout)
+    if latency is not None:
+        latency.record(time.monotonic() - _start)
+    return _result
+
+
+async def _timed_async(
+    send: Callable[[float | None], Awaitable[T]],
+    timeout: float | None,
+    latency: LatencyTracker | None,
+) -> T:
+    """Send once and record the latency of a success."""
+
+    _start = time.monotonic()
+    _result = await send(timeout)
+    if latency is not None:
+        latency.record(time.monotonic() - _start)
+    return _result
+
+
+def _hedged(  # noqa: PLR0913
+    send: Callable[[float | None], T],
+    timeout: float | None,
+    hedge_delay: float,
+    latency: LatencyTracker | None,
+    policy: RetryPolicy,
+    on_discard: Callable[[T], None] | None,
+) -> T:
+    """Send, and send again if the first has not answered by `hedge_delay`."""
+
+    _primary = _hedge_pool.submit(_timed, send, timeout, latency)
+    _done, _ = wait([_primary], timeout=hedge_delay)
+    if _done:
+        return _primary.result()
+
+    policy.stats.count("hedges_fired")
+    _msg = f"Hedging a request after {hedge_delay:.2f}s"
+    log.debug(_msg)
+    _hedge = _hedge_pool.submit(_timed, send, timeout, latency)
+
+    _pending: set[Future] = {_primary, _hedge}
+    _error: BaseException | None = None
+    while _pending:
+        _done, _pending = wait(_pending, return_when=FIRST_COMPLETED)
+        for _future in _done:
+            if _future.exception() is not None:
+                _error = _future.exception()
+                continue
+            if _future is _hedge:
+                policy.stats.count("hedges_won")
+            # The other request cannot be cancelled once sent; count its
+            # usage when it finishes.
+            if on_discard is not None:
+                for _loser in _pending:
+                    _loser.add_done_callback(_discard_callback(on_discard))
+            return _future.result()
+
+    assert _error is not None, "both hedged requests finished without a result"
+    raise _error
+
+
+def _discard_callback(
+    on_discard: Callable[[T], None],
+) -> Callable[[Future], None]:
+    """Wrap `on_discard` to be called with the result of a done future."""
+
+    def _callback(future: Future) -> None:
+        if future.exception() is None:
+            on_discard(future.result())
+
+    return _callback
+
+
+async def _hedged_async(  # noqa: PLR0913
+    send: Callable[[float | None], Awaitable[T]],
+    timeout: float | None,
+    hedge_delay: float,
+    latency: LatencyTracker | None,
+    policy: RetryPolicy,
+    on_discard: Callable[[T], None] | None,
+) -> T:
+    """Send, and send again if the first has not answered by `hedge_delay`."""
+
+    _primary = asyncio.ensure_future(_timed_async(send, timeout, latency))
+    _done, _ = await asyncio.wait([_primary], timeout=hedge_delay)
+    if _done:
+        return _primary.result()
+
+    policy.stats.count("hedges_fired")
+    _hedge = asyncio.ensure_future(_timed_async(send, timeout, latency))
+
+    _pending = {_primary, _hedge}
+    _error: BaseException | None = None
+    while _pending:
+        _done, _pending = await asyncio.wait(
+            _pending,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for _task in _done:
+            if _task.exception() is not None:
+                _error = _task.exception()
+                continue
+            if _task is _hedge:
+                policy.stats.count("hedges_won")
+            for _loser in _pending:
+                if on_discard is None:
+                    _loser.cancel()
+                    continue
+                # Keep a reference until it is done, so it is not collected.
+                _discarded.add(_loser)
+                _loser.add_done_callback(_discarded.discard)
+                _loser.add_done_callback(_discard_task_callback(on_discard))
+            return _task.result()
+
+    assert _error is not None, "both hedged requests finished without a result"
+    raise _error
+
+
+def _discard_task_callback(
+    on_discard: Callable[[T], None],
+) -> Callable[[asyncio.Future], None]:
+    """Wrap `on_discard` to be called with the result of a done task."""
+
+    def _callback(task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is None:
+            on_discard(task.result())
+
+    return _callback
@@ -0,0 +1,300 @@
+import logging
+import threading
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from dataclasses import dataclass, field
+from typing import TypeVar
+
+from message_parser import estimate_tokens
+from metrics import MODEL_REQUESTS
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from retry import LatencyTracker
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+STAGES = ("evaluate", "check")
+
+# Errors that say the model or its endpoint is unavailable or overloaded,
+# so another model may do better. A bad request or a bad key would fail the
+# same way on every model, so it is raised as is. A deadline from the retry
+# policy is a TimeoutError.
+FALLBACK_ERRORS = (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+    TimeoutError,
+)
+
+
+@dataclass
+class Route:
+    """Which model serves requests that match the conditions.
+
+    A route matches a request if the essay (or text being checked) has at
+    most `max_tokens` tokens, and its type is in `essay_types`. Unset
+    conditions always match.
+    """
+
+    model: str
+    max_tokens: int | None = None
+    essay_types: list[str] | None = None
+    fallbacks: list[str] = field(default_factory=list)
+
+    def matches(self, tokens: int, essay_type: str | None) -> bool:
+        """Return True if the route applies to the request."""
+
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            return False
+        return self.essay_types is None or essay_type in self.essay_types
+
+
+@dataclass
+class _ModelHealth:
+    """What the router knows about one model at one stage."""
+
+    latency: LatencyTracker = field(default_factory=LatencyTracker)
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    demoted_until: float = 0.0
+
+
+class ModelRouter:
+    """Pick the model for each stage of an evaluation, with fallbacks.
+
+    Each stage has a list of routes; the first one that matches the request
+    gives the model to try first, then its fallbacks, then the caller's
+    default model. A model is tried last for `cooldown_seconds` after it
+    fails `max_failures` times in a row, or after its p95 latency over at
+    least `min_samples` requests exceeds `slo_seconds`. If a model fails with
+    an endpoint error, the request goes to the next one. Health is kept per
+    stage, so slow evaluations do not demote a model for quick checks.
+
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        routes: dict[str, list[Route]],
+        slo_seconds: float | None = None,
+        max_failures: int = 3,
+        cooldown_seconds: float = 60.0,
+        min_samples: int = 5,
+    ) -> None:
+        """Initialize the ModelRouter class.
+
+        Parameters
+        ----------
+        routes : dict
+            The routes of each stage, "evaluate" and "check", in order.
+        slo_seconds : float, optional
+            The latency objective. Default is none.
+        max_failures : int, optional
+            Failures in a row before a model is demoted. Default is 3.
+        cooldown_seconds : float, optional
+            How long a model stays demoted. Default is 60.
+        min_samples : int, optional
+            Requests needed before the latency objective is applied.
+            Default is 5.
+
+        """
+
+        for _stage in routes:
+            if _stage not in STAGES:
+                _msg = f"Unknown routing stage {_stage!r}, expected one of {STAGES}"
+                log.error(_msg)
+                raise ValueError(_msg)
+
+        self.routes = routes
+        self.slo_seconds = slo_seconds
+        self.max_failures = max_failures
+        self.cooldown_seconds = cooldown_seconds
+        self.min_samples = min_samples
+        self._health: dict[tuple[str, str], _ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def candidates(
+        self,
+        stage: str,
+        text: str,
+        essay_type: str | None,
+        default: str,
+    ) -> list[str]:
+        """Return the models to try for a request, in order.
+
+        Demoted models keep their order but go after the healthy ones.
+
+        """
+
+        _tokens = estimate_tokens(text)
+        _models = [default]
+        for _route in self.routes.get(stage, []):
+            if _route.matches(_tokens, essay_type):
+                _models = [_route.model, *_route.fallbacks, default]
+                break
+
+        _models = list(dict.fromkeys(_models))
+        _now = time.monotonic()
+        with self._lock:
+            _demoted = {
+                _model
+                for _model in _models
+                if (stage, _model) in self._health
+                and self._health[stage, _model].demoted_until > _now
+            }
+        return [_m for _m in _models if _m not in _demoted] + [
+            _m for _m in _models if _m in _demoted
+        ]
+
+    def call(  # noqa: PLR0913
+        self,
+        stage: str,
+        text: str,
+        essay_type: str | None,
+        default: str,
+        func: Callable[[str], T],
+    ) -> T:
+        """Call `func(model)` with each candidate model until one succeeds."""
+
+        _error: BaseException | None = None
+        for _model in self.candidates(stage, text, essay_type, default):
+            _start = time.perf_counter()
+            try:
+                _result = func(_model)
+            except FALLBACK_ERRORS as e:
+                self._failed(stage, _model, e)
+                _error = e
+                continue
+            self._succeeded(stage, _model, time.perf_counter() - _start)
+            return _result
+
+        raise _last_error(stage, _error)
+
+    async def call_async(  # noqa: PLR0913
+        self,
+        stage: str,
+        text: str,
+        essay_type: str | None,
+        default: str,
+        func: Callable[[str], Awaitable[T]],
+    ) -> T:
+        """Await `func(model)` with each candidate model until one succeeds."""
+
+        _error: BaseException | None = None
+        for _model in self.candidates(stage, text, essay_type, default):
+            _start = time.perf_counter()
+            try:
+                _result = await func(_model)
+            except FALLBACK_ERRORS as e:
+                self._failed(stage, _model, e)
+                _error = e
+                continue
+            self._succeeded(stage, _model, time.perf_counter() - _start)
+            return _result
+
+        raise _last_error(stage, _error)
+
+    def stream(  # noqa: PLR0913
+        self,
+        stage: str,
+        text: str,
+        essay_type: str | None,
+        default: str,
+        func: Callable[[str], Iterator[str]],
+    ) -> Iterator[str]:
+        """Stream `func(model)`, falling back until a model sends a chunk.
+
+        Once a chunk has been yielded, a failure is raised to the caller,
+        since the text so far cannot be taken back.
+
+        """
+
+        _error: BaseException | None = None
+        for _model in self.candidates(stage, text, essay_type, default):
+            _start = time.perf_counter()
+            try:
+                _chunks = func(_model)
+                _first = next(_chunks, None)
+            except FALLBACK_ERRORS as e:
+                self._failed(stage, _model, e)
+                _error = e
+                continue
+
+            if _first is not None:
+                yield _first
+            try:
+                yield from _chunks
+            except FALLBACK_ERRORS as e:
+                self._failed(stage, _model, e)
+                raise
+            self._succeeded(stage, _model, time.perf_counter() - _start)
+            return
+
+        raise _last_error(stage, _error)
+
+    def stats(self) -> dict[str, dict]:
+        """Return the requests, failures and latency of each model by stage."""
+
+        _now = time.monotonic()
+        _stats: dict[str, dict] = {}
+        with self._lock:
+            for (_stage, _model), _health in self._health.items():
+                _stats.setdefault(_stage, {})[_model] = {
+                    "requests": _health.requests,
+                    "failures": _health.failures,
+                    "p95_seconds": _health.latency.quantile(0.95),
+                    "demoted": _health.demoted_until > _now,
+                }
+        return _stats
+
+    def _succeeded(self, stage: str, model: str, seconds: float) -> None:
+        MODEL_REQUESTS.inc(stage=stage, model=model, outcome="ok")
+        with self._lock:
+            _health = self._health.setdefault((stage, model), _ModelHealth())
+            _health.requests += 1
+            _health.consecutive_failures = 0
+            _health.latency.record(seconds)
+            _p95 = _health.latency.quantile(0.95)
+            if (
+                self.slo_seconds is not None
+                and len(_health.latency) >= self.min_samples
+                and _p95 is not None
+                and _p95 > self.slo_seconds
+            ):
+                _msg = (
+                    f"{model} p95 latency {_p95:.1f}s for {stage} is over the"
+                    f" {self.slo_seconds:.1f}s objective; demoting it"
+                )
+                log.warning(_msg)
+                _health.demoted_until = time.monotonic() + self.cooldown_seconds
+                # Start afresh, so the model can earn its place back.
+                _health.latency = LatencyTracker()
+
+    def _failed(self, stage: str, model: str, error: Exception) -> None:
+        _msg = f"{model} failed for {stage}: {error!r}"
+        log.warning(_msg)
+        MODEL_REQUESTS.inc(stage=stage, model=model, outcome="failed")
+        with self._lock:
+            _health = self._health.setdefault((stage, model), _ModelHealth())
+            _health.requests += 1
+            _health.failures += 1
+            _health.consecutive_failures += 1
+            if _health.consecutive_failures >= self.max_failures:
+                _health.demoted_until = time.monotonic() + self.cooldown_seconds
+
+
+def _last_error(stage: str, error: BaseException | None) -> BaseException:
+    """Return the error to raise once every candidate model has failed."""
+
+    if error is None:
+        _msg = f"No model to try for {stage}"
+        log.error(_msg)
+        return RuntimeError(_msg)
+    return error
@@ -0,0 +1,247 @@
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+log = logging.getLogger(__name__)
+
+# The session and priority of the code running in this context. Set by
+# `request_context`, read by `RequestScheduler.acquire`.
+_request_context: contextvars.ContextVar[tuple[str, int]] = contextvars.ContextVar(
+    "request_context",
+    default=("default", 0),
+)
+
+
+@contextmanager
+def request_context(session: str, priority: int = 0) -> Iterator[None]:
+    """Attribute the requests made in this block to a session.
+
+    Parameters
+    ----------
+    session : str
+        The queue the requests wait in. Sessions are served in turn, so one
+        busy session cannot starve the others.
+    priority : int, optional
+        Requests with a higher priority are served first. Default is 0.
+
+    """
+
+    _token = _request_context.set((session, priority))
+    try:
+        yield
+    finally:
+        _request_context.reset(_token)
+
+
+class TokenBucket:
+    """A bucket that refills continuously up to its capacity.
+
+    The level may go negative when a request turns out to use more than was
+    estimated; the debt is paid back by the refill.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        """Initialize the TokenBucket class.
+
+        Parameters
+        ----------
+        per_minute : float
+            Both the capacity and the refill over one minute.
+
+        """
+
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        """Add what has dripped in since the last refill."""
+
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Return the seconds until `amount` is available, after a refill."""
+
+        _missing = min(amount, self.capacity) - self.level
+        if _missing <= 0:
+            return 0.0
+        return _missing / self.rate
+
+
+@dataclass
+class SchedulerStats:
+    """Queue and wait-time figures for a RequestScheduler."""
+
+    queue_depth: int = 0
+    granted: int = 0
+    delayed: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def mean_wait(self) -> float:
+        """Return the mean wait per granted request, in seconds."""
+
+        if self.granted == 0:
+            return 0.0
+        return self.total_wait / self.granted
+
+
+@dataclass
+class _Waiter:
+    ticket: int
+    session: str
+    priority: int
+    tokens: float
+
+
+class RequestScheduler:
+    """Keep an endpoint under its requests- and tokens-per-minute limits.
+
+    Callers that would exceed a limit wait in a queue instead of being sent
+    and failing with 429. The queue is fair: the highest priority goes
+    first, and among equal priorities the sessions take turns, oldest
+    request first within each session.
+
+    One scheduler is shared by every thread that uses an endpoint; see
+    `OpenAIConnection.scheduler`.
+
+    Attributes
+    ----------
+    stats : SchedulerStats
+        Queue depth and wait times.
+
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 30000,
+        expected_response_tokens: int = 1000,
+    ) -> None:
+        """Initialize the RequestScheduler class.
+
+        Parameters
+        ----------
+        requests_per_minute : float, optional
+            The RPM limit of the endpoint.
+        tokens_per_minute : float, optional
+            The TPM limit of the endpoint.
+        expected_response_tokens : int, optional
+            Added to the prompt estimate when a request sets no max_tokens.
+
+        """
+
+        self.expected_response_tokens = expected_response_tokens
+        self.stats = SchedulerStats()
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._waiters: list[_Waiter] = []
+        self._tickets = itertools.count()
+        self._turns = itertools.count()
+        self._last_turn: dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, tokens: float, timeout: float | None = None) -> float:
+        """Wait until a request of about `tokens` tokens may be sent.
+
+        The session and priority come from `request_context`.
+
+        Parameters
+        ----------
+        tokens : float
+            The estimated prompt plus response tokens of the request.
+        timeout : float, optional
+            The longest to wait, in seconds. Default is no limit.
+
+        Returns
+        -------
+        float
+            The seconds spent waiting.
+
+        Raises
+        ------
+        TimeoutError
+            If the request could not be scheduled within `timeout`.
+
+        """
+
+        _session, _priority = _request_context.get()
+        _start = time.monotonic()
+        _deadline = None if timeout is None else _start + timeout
+
+        with self._cond:
+            _waiter = _Waiter(next(self._tickets), _session, _priority, tokens)
+            self._waiters.append(_waiter)
+            self.stats.queue_depth = len(self._waiters)
+            try:
+                while True:
+                    _now = time.monotonic()
+                    self._requests.refill(_now)
+                    self._tokens.refill(_now)
+
+                    _wait = None
+                    if self._head() is _waiter:
+                        _wait = max(
+                            self._requests.wait_time(1),
+                            self._tokens.wait_time(tokens),
+                        )
+                        if _wait == 0:
+                            break
+
+                    if _deadline is not None:
+                        if _now >= _deadline:
+                            _msg = f"No slot for session {_session} in {timeout}s"
+                            log.warning(_msg)
+                            raise TimeoutError(_msg)
+                        _wait = min(_wait or _deadline - _now, _deadline - _now)
+
+                    self._cond.wait(_wait)
+            finally:
+                self._waiters.remove(_waiter)
+                self.stats.queue_depth = len(self._waiters)
+                self._cond.notify_all()
+
+            self._requests.level -= 1
+            self._tokens.level -= tokens
+            self._last_turn[_session] = next(self._turns)
+
+            _waited = time.monotonic() - _start
+            self.stats.granted += 1
+            self.stats.total_wait += _waited
+            self.stats.max_wait = max(self.stats.max_wait, _waited)
+            if _waited > 0.01:  # noqa: PLR2004
+                self.stats.delayed += 1
+                _msg = f"Session {_session} waited {_waited:.2f}s for a slot."
+                log.debug(_msg)
+
+        return _waited
+
+    def settle(self, estimated: float, actual: float) -> None:
+        """Correct the token budget once a request's real usage is known."""
+
+        with self._cond:
+            self._tokens.level += estimated - actual
+            self._cond.notify_all()
+
+    def _head(self) -> _Waiter | None:
+        """Return the waiter that should be served next."""
+
+        if not self._waiters:
+            return None
+
+        return min(
+            self._waiters,
+            key=lambda _w: (
+                -_w.priority,
+                self._last_turn.get(_w.session, -1),
+                _w.ticket,
+            ),
+        )
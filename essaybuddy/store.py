@@ -0,0 +1,471 @@
+import atexit
+import difflib
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = "./data/essays.sqlite3"
+
+# How hard SQLite works to get a commit onto the disk, see
+# https://www.sqlite.org/pragma.html#pragma_synchronous. In WAL mode,
+# "normal" only syncs at checkpoints: a power loss can lose the last saves
+# but never corrupts the database.
+SYNCHRONOUS = ("off", "normal", "full")
+
+
+def make_delta(old: str, new: str) -> list:
+    """Return the line edits that turn `old` into `new`.
+
+    The delta is a list of ops: ``[start, end]`` copies lines start to end
+    of `old`, and a string is inserted as is.
+
+    """
+
+    _old_lines = old.splitlines(keepends=True)
+    _new_lines = new.splitlines(keepends=True)
+    _matcher = difflib.SequenceMatcher(None, _old_lines, _new_lines, autojunk=False)
+
+    _delta: list = []
+    for _tag, _i1, _i2, _j1, _j2 in _matcher.get_opcodes():
+        if _tag == "equal":
+            _delta.append([_i1, _i2])
+        elif _j2 > _j1:
+            _delta.append("".join(_new_lines[_j1:_j2]))
+    return _delta
+
+
+def apply_delta(old: str, delta: list) -> str:
+    """Apply a delta from `make_delta` to `old`."""
+
+    _old_lines = old.splitlines(keepends=True)
+    return "".join(
+        "".join(_old_lines[_op[0] : _op[1]]) if isinstance(_op, list) else _op
+        for _op in delta
+    )
+
+
+@dataclass
+class Revision:
+    """One saved version of a document."""
+
+    rev: int
+    created: float
+    size: int
+    sha256: str
+
+
+class EssayStore:
+    """Versioned essays in SQLite, keyed by owner and document.
+
+    The latest text of each document is kept whole, so loading it reads one
+    row. Every save also adds a revision, stored as a line delta from the
+    one before it, with a full copy every `snapshot_every` revisions (or
+    when the delta would be larger), so loading a past revision applies at
+    most that many deltas. Each save is one transaction, so a reader never
+    sees half of it, and concurrent writers to the same document are
+    serialized.
+
+    The store is thread-safe and meant to be shared by every session.
+
+    """
+
+    def __init__(
+        self,
+        db_path: str = DEFAULT_DB_PATH,
+        snapshot_every: int = 20,
+        compress_level: int = 6,
+        synchronous: str = "normal",
+    ) -> None:
+        """Initialize the EssayStore class.
+
+        Parameters
+        ----------
+        db_path : str, optional
+            The path to the SQLite database.
+        snapshot_every : int, optional
+            Store a full copy of every n-th revision. Default is 20.
+        compress_level : int, optional
+            The zlib compression level. Default is 6.
+        synchronous : str, optional
+            When to fsync: "full" on every save, "normal" at WAL checkpoints,
+            or "off" to leave it to the operating system. Default is
+            "normal".
+
+        """
+
+        if synchronous not in SYNCHRONOUS:
+            _msg = f"synchronous must be one of {SYNCHRONOUS}, not {synchronous!r}"
+            log.error(_msg)
+            raise ValueError(_msg)
+
+        self.db_path = db_path
+        self.snapshot_every = snapshot_every
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={synchronous.upper()}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " owner TEXT NOT NULL,"
+            " doc TEXT NOT NULL,"
+            " head INTEGER NOT NULL,"
+            " text BLOB NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (owner, doc))",
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS revisions ("
+            " owner TEXT NOT NULL,"
+            " doc TEXT NOT NULL,"
+            " rev INTEGER NOT NULL,"
+            " full INTEGER NOT NULL,"
+            " data BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (owner, doc, rev))",
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " owner TEXT NOT NULL,"
+            " doc TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (owner, doc, name))",
+        )
+
+    def load(self, owner: str, doc: str, rev: int | None = None) -> str | None:
+        """Return a revision of a document, or None if it does not exist.
+
+        Parameters
+        ----------
+        owner : str
+            The user or session the document belongs to.
+        doc : str
+            The name of the document.
+        rev : int, optional
+            The revision to load. Default is the latest.
+
+        """
+
+        with self._lock:
+            if rev is None:
+                _row = self._db.execute(
+                    "SELECT text FROM documents WHERE owner = ? AND doc = ?",
+                    (owner, doc),
+                ).fetchone()
+                return None if _row is None else self._decompress(_row[0])
+
+            _rows = self._db.execute(
+                "SELECT full, data FROM revisions"
+                " WHERE owner = ? AND doc = ? AND rev <= ? AND rev >= ("
+                "  SELECT MAX(rev) FROM revisions"
+                "  WHERE owner = ? AND doc = ? AND rev <= ? AND full = 1)"
+                " ORDER BY rev",
+                (owner, doc, rev, owner, doc, rev),
+            ).fetchall()
+
+        if not _rows:
+            return None
+
+        _text = ""
+        for _full, _data in _rows:
+            _payload = self._decompress(_data)
+            _text = _payload if _full else apply_delta(_text, json.loads(_payload))
+        return _text
+
+    def save(self, owner: str, doc: str, content: str) -> int:
+        """Save a new revision of a document and return its number.
+
+        Nothing is written if the content is the same as the latest
+        revision's; its number is returned.
+
+        """
+
+        _sha256 = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        _now = time.time()
+        _text = self._compress(content)
+
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                _head = self._db.execute(
+                    "SELECT head, text, sha256 FROM documents"
+                    " WHERE owner = ? AND doc = ?",
+                    (owner, doc),
+                ).fetchone()
+                if _head is not None and _head[2] == _sha256:
+                    self._db.execute("ROLLBACK")
+                    return _head[0]
+
+                _rev = 1 if _head is None else _head[0] + 1
+                _full, _data = True, _text
+                if _head is not None and (_rev - 1) % self.snapshot_every != 0:
+                    _delta = self._compress(
+                        json.dumps(
+                            make_delta(self._decompress(_head[1]), content),
+                            separators=(",", ":"),
+                        ),
+                    )
+                    if len(_delta) < len(_text):
+                        _full, _data = False, _delta
+
+                self._db.execute(
+                    "INSERT INTO revisions"
+                    " (owner, doc, rev, full, data, size, sha256, created)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (owner, doc, _rev, int(_full), _data, len(content), _sha256, _now),
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO documents"
+                    " (owner, doc, head, text, sha256, updated)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (owner, doc, _rev, _text, _sha256, _now),
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+        return _rev
+
+    def history(
+        self,
+        owner: str,
+        doc: str,
+        limit: int = 50,
+        before: int | None = None,
+    ) -> list[Revision]:
+        """List the revisions of a document, newest first.
+
+        Parameters
+        ----------
+        owner, doc : str
+            The document.
+        limit : int, optional
+            The most revisions to return. Default is 50.
+        before : int, optional
+            Only list revisions older than this one, to page through them.
+
+        """
+
+        with self._lock:
+            _rows = self._db.execute(
+                "SELECT rev, created, size, sha256 FROM revisions"
+                " WHERE owner = ? AND doc = ? AND rev < ?"
+                " ORDER BY rev DESC LIMIT ?",
+                (owner, doc, before or 2**62, limit),
+            ).fetchall()
+        return [Revision(*_row) for _row in _rows]
+
+    def documents(self, owner: str) -> list[str]:
+        """List the documents of an owner, most recently saved first."""
+
+        with self._lock:
+            _rows = self._db.execute(
+                "SELECT doc FROM documents WHERE owner = ? ORDER BY updated DESC",
+                (owner,),
+            ).fetchall()
+        return [_row[0] for _row in _rows]
+
+    def get_meta(self, owner: str, doc: str, name: str) -> str | None:
+        """Return a named piece of metadata of a document, if set."""
+
+        with self._lock:
+            _row = self._db.execute(
+                "SELECT value FROM metadata WHERE owner = ? AND doc = ? AND name = ?",
+                (owner, doc, name),
+            ).fetchone()
+        return None if _row is None else _row[0]
+
+    def set_meta(self, owner: str, doc: str, name: str, value: str) -> None:
+        """Set a named piece of metadata of a document."""
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO metadata (owner, doc, name, value)"
+                " VALUES (?, ?, ?, ?)",
+                (owner, doc, name, value),
+            )
+
+    def close(self) -> None:
+        """Close the database."""
+
+        with self._lock:
+            self._db.close()
+
+    def _compress(self, text: str) -> bytes:
+        return zlib.compress(text.encode("utf-8"), self.compress_level)
+
+    @staticmethod
+    def _decompress(blob: bytes) -> str:
+        return zlib.decompress(blob).decode("utf-8")
+
+
+@dataclass
+class WriterStats:
+    """Counts kept by a `StoreWriter`."""
+
+    submitted: int = 0
+    coalesced: int = 0
+    written: int = 0
+    failed: int = 0
+    last_error: str | None = field(default=None, repr=False)
+
+
+class StoreWriter:
+    """Save essays on a background thread, coalescing rapid saves.
+
+    `submit` only records the content and returns. The writer thread waits
+    `delay` seconds after the first pending save, then writes the latest
+    content of each pending document, so several saves of one document
+    within that time cost one write. Saves the store finds unchanged are
+    not written at all.
+
+    Pending saves are flushed when the interpreter exits.
+
+    """
+
+    def __init__(self, store: EssayStore, delay: float = 0.5) -> None:
+        """Initialize the StoreWriter class.
+
+        Parameters
+        ----------
+        store : EssayStore
+            The store to write to.
+        delay : float, optional
+            How long to collect saves before writing them. Default is 0.5.
+
+        """
+
+        self.store = store
+        self.delay = delay
+        self.stats = WriterStats()
+        self._pending: dict[tuple[str, str], str] = {}
+        self._writing: dict[tuple[str, str], str] = {}
+        self._closed = False
+        self._flushing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="essay-store-writer",
+            daemon=True,
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, owner: str, doc: str, content: str) -> None:
+        """Queue a save of a document; a pending save of it is replaced."""
+
+        with self._cond:
+            if self._closed:
+                _msg = "StoreWriter is closed"
+                log.error(_msg)
+                raise RuntimeError(_msg)
+
+            self.stats.submitted += 1
+            if (owner, doc) in self._pending:
+                self.stats.coalesced += 1
+            self._pending[(owner, doc)] = content
+            self._cond.notify_all()
+
+    def pending(self, owner: str, doc: str) -> str | None:
+        """Return the content of a save not yet written, if any."""
+
+        with self._cond:
+            _key = (owner, doc)
+            return self._pending.get(_key, self._writing.get(_key))
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Write the pending saves now and wait for them.
+
+        Returns False if they were not all written within `timeout`.
+
+        """
+
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            _done = self._cond.wait_for(
+                lambda: not self._pending and not self._writing,
+                timeout,
+            )
+            if _done:
+                self._flushing = False
+            return _done
+
+    def close(self, timeout: float | None = None) -> None:
+        """Flush the pending saves and stop the writer thread."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                # Collect saves for a while, unless someone is waiting.
+                self._cond.wait_for(
+                    lambda: self._flushing or self._closed,
+                    self.delay,
+                )
+                self._flushing = False
+                self._writing, self._pending = self._pending, {}
+
+            for (_owner, _doc), _content in self._writing.items():
+                self._write(_owner, _doc, _content)
+
+            with self._cond:
+                self._writing = {}
+                self._cond.notify_all()
+
+    def _write(self, owner: str, doc: str, content: str) -> None:
+        """Save one document, counting and logging a failure."""
+
+        try:
+            self.store.save(owner, doc, content)
+            self.stats.written += 1
+        except Exception as e:
+            _msg = f"Failed to save {owner}/{doc}: {e!r}"
+            log.exception(_msg)
+            self.stats.failed += 1
+            self.stats.last_error = _msg
+
+
+_stores: dict[Path, EssayStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(db_path: str = DEFAULT_DB_PATH, **options: object) -> EssayStore:
+    """Return the process-wide store for a database file.
+
+    `options` are passed to `EssayStore` when the store is first created.
+
+    """
+
+    _key = Path(db_path).resolve()
+    with _stores_lock:
+        if _key not in _stores:
+            _stores[_key] = EssayStore(db_path, **options)
+        return _stores[_key]
@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from balancer import EndpointPool
+from fake_openai import DEFAULT_CRITIQUE, FakeOpenAIServer
+from llmlib import OpenAIConnection, check_verdict, request_completion
+from openai import BadRequestError
+from retry import RetryPolicy
+
+MESSAGES = [
+    {"role": "system", "content": "You are an editor."},
+    {"role": "user", "content": "Please review my essay."},
+]
+
+
+@pytest.fixture()
+def servers():
+    with FakeOpenAIServer() as _first, FakeOpenAIServer() as _second:
+        yield _first, _second
+
+
+def make_pool(servers, **pool_options):
+    # One attempt per endpoint, so failures reach the pool at once.
+    _connections = [
+        OpenAIConnection("test_api_key", _server.url, retry=RetryPolicy(max_attempts=1))
+        for _server in servers
+    ]
+    return EndpointPool(_connections, **pool_options)
+
+
+def test_least_outstanding_spreads_requests(servers):
+    pool = make_pool(servers)
+    for _ in range(4):
+        assert request_completion(pool, MESSAGES) == DEFAULT_CRITIQUE
+
+    assert [_server.requests for _server in servers] == [2, 2]
+    assert pool.request_tokens == sum(_c.request_tokens for _c in pool.connections)
+    assert pool.request_tokens > 0
+
+
+def test_ewma_prefers_faster_endpoint(servers):
+    pool = make_pool(servers, strategy="ewma")
+    servers[0].latency = 0.2
+    for _ in range(6):
+        request_completion(pool, MESSAGES)
+
+    assert servers[1].requests > servers[0].requests
+
+
+def test_ewma_cold_start_spreads_requests(servers):
+    pool = make_pool(servers, strategy="ewma")
+    for _server in servers:
+        _server.latency = 0.2
+
+    # No latencies yet: the requests in flight decide, so concurrent
+    # requests do not all go to the first endpoint.
+    with ThreadPoolExecutor(max_workers=2) as _executor:
+        list(_executor.map(lambda _: request_completion(pool, MESSAGES), range(2)))
+    assert [_server.requests for _server in servers] == [1, 1]
+
+    # Latencies are kept by stage, apart from the one-token checks.
+    check_verdict(pool, DEFAULT_CRITIQUE)
+    _stages = [set(_stats["ewma_latency"]) for _stats in pool.stats()]
+    assert set.union(*_stages) == {"completion", "verdict"}
+    assert all("completion" in _stage for _stage in _stages)
+
+
+def test_failover_and_ejection(servers):
+    pool = make_pool(servers, max_failures=1, eject_seconds=60)
+    servers[0].fail_next(503)
+
+    assert request_completion(pool, MESSAGES) == DEFAULT_CRITIQUE
+    assert request_completion(pool, MESSAGES) == DEFAULT_CRITIQUE
+    assert servers[0].requests == 1
+    assert servers[1].requests == 2  # noqa: PLR2004
+
+    _stats = pool.stats()
+    assert not _stats[0]["healthy"]
+    assert _stats[0]["ejections"] == 1
+
+
+def test_client_error_is_not_failed_over(servers):
+    pool = make_pool(servers, max_failures=1)
+    servers[0].fail_next(400)
+
+    with pytest.raises(BadRequestError):
+        request_completion(pool, MESSAGES)
+    assert servers[1].requests == 0
+    assert pool.stats()[0]["healthy"]
+
+
+def test_health_check_restores_endpoint(servers):
+    pool = make_pool(servers, max_failures=1, eject_seconds=0.05)
+    servers[0].fail_next(500)
+    request_completion(pool, MESSAGES)
+    assert not pool.stats()[0]["healthy"]
+
+    time.sleep(0.1)
+    _deadline = time.monotonic() + 5
+    while not pool.stats()[0]["healthy"] and time.monotonic() < _deadline:
+        request_completion(pool, MESSAGES)
+        time.sleep(0.05)
+    assert pool.stats()[0]["healthy"]
+
+
+def test_stream_through_pool(servers):
+    pool = make_pool(servers)
+
+    assert "".join(request_completion(pool, MESSAGES, stream=True)) == DEFAULT_CRITIQUE
+    assert pool.stats()[0]["outstanding"] == 0
+    assert pool.response_tokens > 0
+
+
+def test_pool_needs_connections():
+    with pytest.raises(ValueError, match="at least one connection"):
+        EndpointPool([])
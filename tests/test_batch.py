@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from unittest.mock import patch
+from batch import BatchItem, completed_ids, load_items, run_batch, trim_partial_line
+from llmlib import OpenAIConnection
+
+
+@pytest.fixture()
+def defaults():
+    return {
+        "author": "College student",
+        "audience": "General audience",
+        "essay_type": "an English essay",
+        "tone": "Formal",
+    }
+
+
+def test_load_items_directory(tmp_path, defaults):
+    (tmp_path / "b.md").write_text("Second essay.")
+    (tmp_path / "a.txt").write_text("First essay.")
+    (tmp_path / "notes.pdf").write_text("Skipped.")
+    _items = list(load_items(tmp_path, defaults))
+    assert [_item.item_id for _item in _items] == ["a.txt", "b.md"]
+    assert _items[0].essay_text == "First essay."
+    assert _items[0].essay_options == defaults
+
+
+def test_load_items_manifest(tmp_path, defaults):
+    (tmp_path / "essay.md").write_text("From a file.")
+    _manifest = tmp_path / "manifest.jsonl"
+    _manifest.write_text(
+        json.dumps({"path": "essay.md", "tone": "Informal"})
+        + "\n"
+        + json.dumps({"id": "inline", "text": "Inline essay."})
+        + "\n",
+    )
+    _items = list(load_items(_manifest, defaults))
+    assert _items[0].item_id == "essay.md"
+    assert _items[0].essay_text == "From a file."
+    assert _items[0].essay_options["tone"] == "Informal"
+    assert _items[1].item_id == "inline"
+    assert _items[1].essay_options == defaults
+
+
+def test_completed_ids(tmp_path):
+    _output = tmp_path / "results.jsonl"
+    _output.write_text(
+        json.dumps({"id": "a", "status": "ok"})
+        + "\n"
+        + json.dumps({"id": "b", "status": "error"})
+        + '\n{"id": "c", "sta',
+    )
+    assert completed_ids(_output) == {"a"}
+
+
+def test_run_batch(tmp_path, defaults):
+    _items = [BatchItem(f"essay{_n}", "Text.", defaults) for _n in range(3)]
+    _output = tmp_path / "results.jsonl"
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+
+    def _run_request(*_args, usage, **_kwargs):
+        usage.request_tokens += 10
+        usage.response_tokens += 5
+        return "Good essay."
+
+    with patch("batch.run_request", side_effect=_run_request):
+        _summary = run_batch(_items, _output, _oaiconn, "gpt-4o", workers=2)
+
+    assert _summary["ok"] == 3  # noqa: PLR2004
+    assert _summary["failed"] == 0
+    _results = [json.loads(_line) for _line in _output.read_text().splitlines()]
+    assert {_result["id"] for _result in _results} == {"essay0", "essay1", "essay2"}
+    assert all(_result["request_tokens"] == 10 for _result in _results)  # noqa: PLR2004
+
+
+def test_resume_after_cut_off_line(tmp_path, defaults):
+    _output = tmp_path / "results.jsonl"
+    _output.write_text(json.dumps({"id": "a", "status": "ok"}) + '\n{"id": "b", "sta')
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+
+    with patch("batch.run_request", return_value="Good essay."):
+        run_batch([BatchItem("b", "Text.", defaults)], _output, _oaiconn, "gpt-4o", 1)
+
+    _results = [json.loads(_line) for _line in _output.read_text().splitlines()]
+    assert [_result["id"] for _result in _results] == ["a", "b"]
+    assert completed_ids(_output) == {"a", "b"}
+
+
+def test_trim_partial_line(tmp_path):
+    _output = tmp_path / "results.jsonl"
+    _output.write_text("x" * 5000)
+    trim_partial_line(_output)
+    assert _output.read_text() == ""
+
+    _output.write_text('{"id": "a"}\n')
+    trim_partial_line(_output)
+    assert _output.read_text() == '{"id": "a"}\n'
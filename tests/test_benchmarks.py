@@ -0,0 +1,29 @@
+from benchmarks import suite
+from benchmarks.__main__ import compare
+
+
+def test_bench_run_request():
+    result = suite.bench_run_request(2, 4, 0.0, 0.0, precheck=True)
+    assert result["latency"]["count"] == 4  # noqa: PLR2004
+    assert result["endpoint_requests"] == 4  # noqa: PLR2004
+
+
+def test_bench_run_request_stream():
+    result = suite.bench_run_request(2, 2, 0.0, 0.0, stream=True, precheck=True)
+    assert result["stream"]
+    assert result["latency"]["count"] == 2  # noqa: PLR2004
+
+
+def test_bench_llmlib_overhead():
+    result = suite.bench_llmlib_overhead(10)
+    assert result["overhead_us"]["count"] == 10  # noqa: PLR2004
+    assert result["loopback_roundtrip"]["count"] == 1
+
+
+def test_compare_reports_changes():
+    old = {"commit": "abc", "results": {"case": {"p50": 2.0, "count": 5}}}
+    new = {"commit": "def", "results": {"case": {"p50": 1.0, "count": 5}}}
+    assert compare(new, old) == [
+        "Compared with abc:",
+        "  case.p50: 2.0 -> 1.0 (-50.0%)",
+    ]
@@ -0,0 +1,92 @@
+import pytest
+from unittest.mock import patch
+from cache import ResponseCache, SessionResults, make_key
+
+
+@pytest.fixture()
+def messages():
+    return [
+        {"role": "system", "content": "Be helpful."},
+        {"role": "user", "content": "Review this."},
+    ]
+
+
+def test_make_key(messages):
+    _key = make_key(messages, "gpt-4o", "1")
+    assert _key == make_key(list(messages), "gpt-4o", "1")
+    assert _key != make_key(messages, "gpt-4o-mini", "1")
+    assert _key != make_key(messages, "gpt-4o", "2")
+
+
+def test_memory_hit_and_miss():
+    _cache = ResponseCache()
+    assert _cache.get("a") is None
+    _cache.put("a", "value")
+    assert _cache.get("a") == "value"
+    assert _cache.stats.memory_hits == 1
+    assert _cache.stats.misses == 1
+    assert _cache.stats.hit_rate == 0.5  # noqa: PLR2004
+
+
+def test_lru_eviction():
+    _cache = ResponseCache(max_entries=2)
+    _cache.put("a", "1")
+    _cache.put("b", "2")
+    _cache.get("a")
+    _cache.put("c", "3")
+    assert _cache.get("b") is None
+    assert _cache.get("a") == "1"
+    assert _cache.stats.evictions == 1
+
+
+def test_ttl_expiry():
+    _cache = ResponseCache(ttl_seconds=10)
+    with patch("cache.time.time", return_value=100.0):
+        _cache.put("a", "1")
+    with patch("cache.time.time", return_value=111.0):
+        assert _cache.get("a") is None
+
+
+def test_sqlite_tier(tmp_path):
+    _db_path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(db_path=_db_path).put("a", "persisted " * 100)
+    _cache = ResponseCache(db_path=_db_path)
+    assert _cache.get("a") == "persisted " * 100
+    assert _cache.stats.disk_hits == 1
+    assert _cache.get("a") == "persisted " * 100
+    assert _cache.stats.memory_hits == 1
+
+
+def test_sqlite_size_cap(tmp_path):
+    _cache = ResponseCache(
+        max_entries=0,
+        db_path=str(tmp_path / "cache.sqlite3"),
+        max_db_bytes=40,
+        compress_level=0,
+    )
+    _cache.put("a", "x" * 20)
+    _cache.put("b", "y" * 20)
+    assert _cache.get("a") is None
+    assert _cache.get("b") == "y" * 20
+
+
+def test_session_results_lru_by_count_and_size():
+    results = SessionResults(max_entries=2, max_bytes=10)
+    results.put("a", "1234")
+    results.put("b", "5678")
+    assert results.get("a") == "1234"
+    results.put("c", "90")
+    # "b" was the least recently shown.
+    assert results.get("b") is None
+    assert len(results) == 2  # noqa: PLR2004
+    assert results.size == 6  # noqa: PLR2004
+
+    results.put("d", "é" * 5)
+    assert results.get("a") is None
+    assert results.get("c") is None
+    assert results.get("d") == "é" * 5
+    assert results.evictions == 3  # noqa: PLR2004
+
+    results.clear()
+    assert len(results) == 0
+    assert results.size == 0
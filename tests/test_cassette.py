@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import pytest
+from cassette import Cassette
+from fake_openai import DEFAULT_CRITIQUE, FakeOpenAIServer
+from llmlib import OpenAIConnection, request_completion, request_completion_async
+from openai import NotFoundError
+
+MESSAGES = [
+    {"role": "system", "content": "You are an editor."},
+    {"role": "user", "content": "Please review my essay."},
+]
+
+
+@pytest.fixture()
+def recorded(tmp_path):
+    path = tmp_path / "cassette.jsonl"
+    with FakeOpenAIServer(latency=0.2) as server:
+        oaiconn = OpenAIConnection(
+            "test_api_key",
+            server.url,
+            cassette=Cassette(path, mode="record"),
+        )
+        assert request_completion(oaiconn, MESSAGES) == DEFAULT_CRITIQUE
+        assert "".join(request_completion(oaiconn, MESSAGES, stream=True)) == (
+            DEFAULT_CRITIQUE
+        )
+        assert oaiconn.cassette.stats.recorded == 2  # noqa: PLR2004
+    return path
+
+
+def replay_connection(path, timing_scale=0.0):
+    # Nothing listens here; every answer must come from the cassette.
+    return OpenAIConnection(
+        "other_key",
+        "http://127.0.0.1:9/v1/",
+        cassette=Cassette(path, mode="replay", timing_scale=timing_scale),
+    )
+
+
+def test_replay_plain_and_stream(recorded):
+    oaiconn = replay_connection(recorded)
+    assert len(oaiconn.cassette) == 2  # noqa: PLR2004
+
+    assert request_completion(oaiconn, MESSAGES) == DEFAULT_CRITIQUE
+    assert "".join(request_completion(oaiconn, MESSAGES, stream=True)) == (
+        DEFAULT_CRITIQUE
+    )
+    assert oaiconn.cassette.stats.replayed == 2  # noqa: PLR2004
+    # The usage chunk of the stream was recorded too.
+    assert oaiconn.response_tokens == 2 * len(DEFAULT_CRITIQUE.split(" "))
+
+
+def test_replay_timing_is_scaled(recorded):
+    oaiconn = replay_connection(recorded, timing_scale=1.0)
+    _start = time.monotonic()
+    request_completion(oaiconn, MESSAGES)
+    assert time.monotonic() - _start >= 0.2  # noqa: PLR2004
+
+    oaiconn = replay_connection(recorded, timing_scale=0.0)
+    _start = time.monotonic()
+    request_completion(oaiconn, MESSAGES)
+    assert time.monotonic() - _start < 0.1  # noqa: PLR2004
+
+
+def test_replay_miss(recorded):
+    oaiconn = replay_connection(recorded)
+    messages = [MESSAGES[0], {"role": "user", "content": "Something else."}]
+
+    with pytest.raises(NotFoundError, match="No recording"):
+        request_completion(oaiconn, messages)
+    assert oaiconn.cassette.stats.misses == 1
+
+
+def test_replay_async(recorded):
+    oaiconn = replay_connection(recorded)
+
+    async def _run():
+        return await request_completion_async(oaiconn, MESSAGES)
+
+    assert asyncio.run(_run()) == DEFAULT_CRITIQUE
+
+
+def test_replay_needs_file(tmp_path):
+    with pytest.raises(ValueError, match="not found"):
+        Cassette(tmp_path / "missing.jsonl")
@@ -1,8 +1,23 @@
 import re
+from pathlib import Path
 
 import pytest
+import tomlkit
 from unittest.mock import patch, mock_open
-from main import get_config
+from config import (
+    _load_config,
+    get_config,
+    get_endpoint_pool,
+    get_response_budget,
+    get_settings,
+)
+
+
+@pytest.fixture(autouse=True)
+def _fresh_config():
+    _load_config.cache_clear()
+    yield
+    _load_config.cache_clear()
 
 
 @pytest.fixture()
@@ -92,3 +107,98 @@ def test_get_config_missing_essay_tones():
         match="essay_tones not found in essaybuddy.toml",
     ):
         get_config()
+
+
+def test_get_settings():
+    toml_content = """
+    [openai]
+    max_connections = 5
+    warm_up = true
+    """
+    with patch("builtins.open", mock_open(read_data=toml_content)):
+        assert get_settings("openai") == {"max_connections": 5, "warm_up": True}
+
+
+def test_get_settings_missing_section(mock_toml_file):  # noqa: ARG001
+    assert get_settings("openai") == {}
+
+
+def test_shipped_config_loads():
+    config_file = str(Path(__file__).parent.parent / "essaybuddy" / "essaybuddy.toml")
+    assert get_config(config_file)["author_options"]
+    assert get_settings("openai", config_file)["endpoint_url"]
+
+
+def test_get_endpoint_pool(tmp_path, monkeypatch):
+    config_file = tmp_path / "essaybuddy.toml"
+    config_file.write_text(
+        """
+        [balancer]
+        enabled = true
+        strategy = "ewma"
+
+        [[balancer.endpoints]]
+        endpoint_url = "http://first.test/v1/"
+        api_key_env = "FIRST_KEY"
+
+        [[balancer.endpoints]]
+        endpoint_url = "http://second.test/v1/"
+        api_key_env = "SECOND_KEY"
+        tokens_per_minute = 1000
+        """,
+    )
+    monkeypatch.setenv("FIRST_KEY", "first")
+    monkeypatch.setenv("SECOND_KEY", "second")
+
+    pool = get_endpoint_pool(str(config_file))
+    assert pool.strategy == "ewma"
+    assert [_c.api_key for _c in pool.connections] == ["first", "second"]
+    assert pool.connections[0].scheduler is None
+    assert pool.connections[1].scheduler is not None
+
+    monkeypatch.delenv("SECOND_KEY")
+    with pytest.raises(ValueError, match="SECOND_KEY not set"):
+        get_endpoint_pool(str(config_file))
+
+
+def test_get_response_budget(tmp_path):
+    config_file = tmp_path / "essaybuddy.toml"
+    config_file.write_text(
+        """
+        [budget]
+        enabled = true
+        max_tokens = 1000
+
+        [budget.type_factors]
+        "a README.md" = 0.5
+
+        [budget.quick]
+        max_tokens = 300
+        target_seconds = 5.0
+        """,
+    )
+
+    budget = get_response_budget(str(config_file))
+    assert budget.max_tokens == 1000  # noqa: PLR2004
+    assert budget.type_factors == {"a README.md": 0.5}
+    assert not budget.quick
+
+    quick = get_response_budget(str(config_file), quick=True)
+    assert quick.max_tokens == 300  # noqa: PLR2004
+    assert quick.target_seconds == 5.0  # noqa: PLR2004
+    assert quick.quick
+
+    disabled_file = tmp_path / "disabled.toml"
+    disabled_file.write_text("[budget]\nenabled = false\n")
+    assert get_response_budget(str(disabled_file)) is None
+
+
+def test_config_is_parsed_once(tmp_path):
+    config_file = tmp_path / "essaybuddy.toml"
+    config_file.write_text("[cache]\nenabled = true\n")
+
+    with patch("config.tomlkit.load", wraps=tomlkit.load) as _load:
+        _settings = get_settings("cache", str(config_file))
+        _settings.pop("enabled")
+        assert get_settings("cache", str(config_file)) == {"enabled": True}
+    assert _load.call_count == 1
@@ -0,0 +1,447 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from unittest.mock import patch
+from cache import ResponseCache
+from essaylib import (
+    RequestCoalescer,
+    ChunkSettings,
+    Essay,
+    ResponseBudget,
+    build_messages,
+    option_variants,
+    request_key,
+    revision_chunking,
+    run_request,
+    run_request_async,
+    run_request_stream,
+)
+from llmlib import OpenAIConnection
+from metrics import COALESCED
+from message_parser import estimate_tokens
+from precheck import Prechecker
+from routing import ModelRouter, Route
+from store import EssayStore
+from prompts.essay import quick_msg
+
+
+@pytest.fixture()
+def essay_options():
+    return {
+        "author": "College student",
+        "audience": "General audience",
+        "essay_type": "an English essay",
+        "tone": "Formal",
+    }
+
+
+def test_build_messages(essay_options):
+    _messages = build_messages("My essay.", essay_options)
+    assert [_m["role"] for _m in _messages] == ["system", "user"]
+    assert "My essay." in _messages[1]["content"]
+    assert "College student" in _messages[1]["content"]
+
+
+def test_build_messages_options_come_last(essay_options):
+    _first = build_messages("My essay.", essay_options)[1]["content"]
+    _second = build_messages("My essay.", {**essay_options, "tone": "Casual"})
+    _prefix = os.path.commonprefix([_first, _second[1]["content"]])
+    assert "My essay." in _prefix
+
+
+def test_build_messages_missing_option(essay_options):
+    del essay_options["tone"]
+    with pytest.raises(AssertionError, match="essay_options should contain 'tone'"):
+        build_messages("My essay.", essay_options)
+
+
+def test_response_budget():
+    budget = ResponseBudget(
+        base_tokens=100,
+        per_essay_token=0.5,
+        min_tokens=150,
+        max_tokens=1000,
+        type_factors={"a README.md": 0.5},
+    )
+    essay = "word " * 1000
+    expected = int(100 + 0.5 * estimate_tokens(essay))
+    assert budget.tokens_for(essay, "an English essay") == expected
+    assert budget.tokens_for(essay, "a README.md") == max(150, int(expected * 0.5))
+    assert budget.tokens_for("Short.", "an English essay") == 150  # noqa: PLR2004
+    assert budget.tokens_for(essay * 10, "an English essay") == 1000  # noqa: PLR2004
+
+    budget.target_seconds = 4
+    budget.tokens_per_second = 50
+    assert budget.tokens_for(essay * 10, "an English essay") == 200  # noqa: PLR2004
+
+
+def test_run_request_with_budget(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _budget = ResponseBudget(quick=True)
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.return_value = "Review."
+        mock_check.return_value = True
+        run_request(
+            "My essay.",
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+            budget=_budget,
+        )
+    _kwargs = mock_request.call_args.kwargs
+    assert _kwargs["max_tokens"] == _budget.tokens_for("My essay.", "an English essay")
+    assert _kwargs["messages"][1]["content"].endswith(quick_msg)
+
+
+def test_run_request_stream(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.return_value = iter(["Good ", "essay."])
+        mock_check.return_value = True
+        _chunks = run_request_stream(
+            "My essay.",
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+        )
+        assert list(_chunks) == ["Good ", "essay."]
+        assert mock_check.call_args.kwargs["completion_text"] == "Good essay."
+
+
+def test_run_request_stream_rejected(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.return_value = iter(["Bad ", "essay."])
+        mock_check.return_value = False
+        _chunks = run_request_stream(
+            "My essay.",
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+        )
+        with pytest.raises(ValueError, match="Completion check failed"):
+            list(_chunks)
+
+
+def test_run_request_async(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    with patch("essaylib.request_completion_async") as mock_request, patch(
+        "essaylib.check_completion_async",
+    ) as mock_check:
+        mock_request.return_value = "Good essay."
+        mock_check.return_value = True
+        _content = asyncio.run(
+            run_request_async(
+                "My essay.",
+                essay_options,
+                "test_api_key",
+                "gpt-4o",
+                oaiconn=_oaiconn,
+            ),
+        )
+        assert _content == "Good essay."
+
+
+def test_run_request_cache(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _cache = ResponseCache()
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.return_value = "Good essay."
+        mock_check.return_value = True
+        for _ in range(2):
+            _content = run_request(
+                "My essay.",
+                essay_options,
+                "test_api_key",
+                "gpt-4o",
+                oaiconn=_oaiconn,
+                cache=_cache,
+            )
+            assert _content == "Good essay."
+        assert mock_request.call_count == 1
+        assert _cache.stats.hits == 1
+
+
+def test_request_key_follows_the_request_sent(essay_options):
+    _messages = build_messages("My essay.", essay_options)
+    _key = request_key(_messages, "My essay.", essay_options, "gpt-4o")
+    _router = ModelRouter({"evaluate": [Route("gpt-4o-mini")]})
+    _routed = request_key(
+        _messages,
+        "My essay.",
+        essay_options,
+        "gpt-4o",
+        router=_router,
+    )
+    assert _routed != _key
+    assert _routed == request_key(_messages, "My essay.", essay_options, "gpt-4o-mini")
+    _budgeted = request_key(
+        _messages,
+        "My essay.",
+        essay_options,
+        "gpt-4o",
+        budget=ResponseBudget(min_tokens=100, max_tokens=100),
+    )
+    assert _budgeted != _key
+
+
+def test_run_request_rejected_not_cached(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _cache = ResponseCache()
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.return_value = "Bad essay."
+        mock_check.return_value = False
+        with pytest.raises(ValueError, match="Completion check failed"):
+            run_request(
+                "My essay.",
+                essay_options,
+                "test_api_key",
+                "gpt-4o",
+                oaiconn=_oaiconn,
+                cache=_cache,
+            )
+        assert _cache.stats.stores == 0
+
+
+def test_chunk_settings_applies():
+    _chunking = ChunkSettings(token_threshold=5)
+    assert not _chunking.applies("A short essay.")
+    assert _chunking.applies("A slightly longer essay than that one.")
+
+
+def test_run_request_chunked(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _essay = "First paragraph here.\n\nSecond paragraph here."
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.side_effect = ["Review one.", "Review two.", "Merged."]
+        mock_check.return_value = True
+        _content = run_request(
+            _essay,
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+            chunking=ChunkSettings(token_threshold=5, chunk_tokens=5),
+        )
+        assert _content == "Merged."
+        assert mock_request.call_count == 3  # noqa: PLR2004
+        _reduce_msg = mock_request.call_args.kwargs["messages"][1]["content"]
+        assert "Review one." in _reduce_msg
+        assert "Review two." in _reduce_msg
+
+
+def test_essay_reviews(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    _essay = Essay()
+    assert _essay.load_reviews() == {}
+    assert _essay.changed_paragraphs("One.\n\nTwo.") == [0, 1]
+
+    _essay.save_reviews("One.\n\nTwo.", {"part": "Review."})
+    assert _essay.load_reviews() == {"part": "Review."}
+    assert _essay.changed_paragraphs("One.\n\n  Two.\n\nThree.") == [2]
+
+
+def test_essay_imports_the_old_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "current.md").write_text("One.\n\nTwo.")
+    (tmp_path / "data" / "current.md.reviews.json").write_text(
+        json.dumps({"paragraphs": [], "reviews": {"part": "Review."}}),
+    )
+    _store = EssayStore(str(tmp_path / "essays.sqlite3"))
+
+    assert Essay(owner="someone", store=_store).load() == ""
+    _essay = Essay(store=_store)
+    assert _essay.load() == "One.\n\nTwo."
+    assert [_rev.rev for _rev in _essay.history()] == [1]
+    assert _essay.load_reviews() == {"part": "Review."}
+
+    # Later saves win over the file.
+    _essay.save("Three.")
+    assert _essay.load() == "Three."
+    _store.close()
+
+
+def test_run_request_reuses_part_reviews(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _chunking = ChunkSettings(token_threshold=5, chunk_tokens=8)
+    _essay = "First paragraph here.\n\nSecond paragraph here."
+    _reviews = {}
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_check.return_value = True
+        mock_request.side_effect = ["Review.", "Review.", "Merged."]
+        run_request(
+            _essay,
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+            chunking=_chunking,
+            reviews=_reviews,
+        )
+        assert len(_reviews) == 2  # noqa: PLR2004
+
+        mock_request.reset_mock()
+        mock_request.side_effect = ["New review.", "Merged again."]
+        _content = run_request(
+            _essay.replace("Second", "Revised second"),
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+            chunking=_chunking,
+            reviews=_reviews,
+        )
+        assert _content == "Merged again."
+        assert mock_request.call_count == 2  # noqa: PLR2004
+        assert "Revised second" in str(mock_request.call_args_list[0])
+        assert sorted(_reviews.values()) == ["New review.", "Review."]
+
+
+def test_revision_chunking_counts_calls(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _chunking = ChunkSettings(token_threshold=60, chunk_tokens=40)
+    _incremental = ChunkSettings(token_threshold=10, chunk_tokens=8)
+
+    def _calls(essay_text, reviews):
+        with patch("essaylib.request_completion", return_value="Review.") as (
+            mock_request
+        ), patch("essaylib.check_completion", return_value=True):
+            run_request(
+                essay_text,
+                essay_options,
+                "test_api_key",
+                "gpt-4o",
+                oaiconn=_oaiconn,
+                chunking=revision_chunking(essay_text, _chunking, _incremental),
+                reviews=reviews,
+            )
+        return mock_request.call_count
+
+    # An essay that fits in one request takes one, on submit and on edit.
+    _short = "\n\n".join(f"Paragraph {_n} is short." for _n in range(4))
+    _reviews = {}
+    assert _calls(_short, _reviews) == 1
+    assert _calls(_short.replace("Paragraph 2", "Edited 2"), _reviews) == 1
+
+    # A longer one is reviewed in small parts, and an edit reviews only the
+    # part that changed, then merges.
+    _long = "\n\n".join(f"Paragraph {_n} is short." for _n in range(12))
+    _reviews = {}
+    assert _calls(_long, _reviews) == len(_reviews) + 1
+    assert len(_reviews) > 2  # noqa: PLR2004
+    assert _calls(_long.replace("Paragraph 5", "Edited 5"), _reviews) == 2  # noqa: PLR2004
+
+
+def test_run_request_precheck_skips_llm_check(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _prechecker = Prechecker(min_words=1, min_structure_lines=0)
+    with patch("essaylib.request_completion") as mock_request, patch(
+        "essaylib.check_completion",
+    ) as mock_check:
+        mock_request.return_value = "A clear and helpful review."
+        _content = run_request(
+            "My essay.",
+            essay_options,
+            "test_api_key",
+            "gpt-4o",
+            oaiconn=_oaiconn,
+            prechecker=_prechecker,
+        )
+        assert _content == "A clear and helpful review."
+        assert mock_check.call_count == 0
+        assert _prechecker.stats.skip_rate == 1.0
+
+
+def test_identical_requests_share_one_call(essay_options):
+    _oaiconn = OpenAIConnection("test_api_key", "test_endpoint_url")
+    _started = threading.Event()
+    _release = threading.Event()
+    _joined = COALESCED.value(role="joined")
+
+    def _request(**_kwargs):
+        _started.set()
+        _release.wait(5)
+        return "Review."
+
+    with patch(
+        "essaylib.request_completion",
+        side_effect=_request,
+    ) as mock_request, patch(
+        "essaylib.check_completion",
+        return_value=True,
+    ), ThreadPoolExecutor(max_workers=4) as pool:
+        _futures = [
+            pool.submit(
+                run_request,
+                "My essay.",
+                essay_options,
+                "test_api_key",
+                "gpt-4o",
+                oaiconn=_oaiconn,
+            )
+            for _ in range(4)
+        ]
+        _started.wait(5)
+        while COALESCED.value(role="joined") < _joined + 3:
+            time.sleep(0.01)
+        _release.set()
+        assert [_f.result() for _f in _futures] == ["Review."] * 4
+
+    assert mock_request.call_count == 1
+
+
+def test_coalescer_shares_errors_and_retries_after_cancel():
+    coalescer = RequestCoalescer()
+    future, leader = coalescer.begin("key")
+    joined, second = coalescer.begin("key")
+    assert leader
+    assert not second
+    assert joined is future
+    coalescer.finish("key", future, error=ValueError("rejected"))
+    with pytest.raises(ValueError, match="rejected"):
+        joined.result()
+    assert coalescer.in_flight() == 0
+
+    # A leader that is abandoned hands the call to the one that joined.
+    future, _ = coalescer.begin("key")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        waiter = pool.submit(coalescer.call, "key", lambda: "own result")
+        time.sleep(0.05)
+        coalescer.finish("key", future, error=GeneratorExit())
+        assert waiter.result() == "own result"
+
+
+def test_option_variants(essay_options):
+    variants = option_variants(
+        essay_options,
+        audience=["Experts", "Children"],
+        tone=["Formal", "Playful"],
+    )
+    assert len(variants) == 4  # noqa: PLR2004
+    assert variants[1]["audience"] == "Experts"
+    assert variants[1]["tone"] == "Playful"
+    assert variants[1]["author"] == essay_options["author"]
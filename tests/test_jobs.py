@@ -0,0 +1,65 @@
+import threading
+import time
+
+from jobs import CANCELLED, DONE, FAILED, JobRunner
+from scheduler import _request_context, request_context
+
+
+def _wait(runner, job_id, timeout=5.0):
+    _deadline = time.monotonic() + timeout
+    while not runner.get(job_id).done:
+        assert time.monotonic() < _deadline, "job did not finish"
+        time.sleep(0.01)
+    return runner.get(job_id)
+
+
+def test_submit_and_get():
+    runner = JobRunner(max_workers=2)
+    with request_context("session-1"):
+        job_id = runner.submit(lambda x: (x * 2, _request_context.get()), 21)
+    job = _wait(runner, job_id)
+    assert job.status == DONE
+    assert job.result == (42, ("session-1", 0))
+    assert runner.get("unknown") is None
+    runner.shutdown()
+
+
+def test_failed_and_streamed_jobs():
+    runner = JobRunner(max_workers=2)
+
+    def _fail():
+        _msg = "rejected"
+        raise ValueError(_msg)
+
+    job = _wait(runner, runner.submit(_fail))
+    assert job.status == FAILED
+    assert isinstance(job.error, ValueError)
+
+    job = _wait(runner, runner.submit_stream(lambda: iter(["One ", "two."])))
+    assert job.chunks == ["One ", "two."]
+    assert job.result == "One two."
+    assert runner.stats()[DONE] == 1
+    runner.shutdown()
+
+
+def test_pool_is_bounded_and_queued_jobs_can_be_cancelled():
+    runner = JobRunner(max_workers=1)
+    release = threading.Event()
+    first = runner.submit(release.wait, 5)
+    second = runner.submit(lambda: "never")
+    assert runner.cancel(second)
+    assert runner.get(second).status == CANCELLED
+    assert not runner.cancel(first)
+
+    release.set()
+    assert _wait(runner, first).status == DONE
+    runner.shutdown()
+
+
+def test_finished_jobs_expire():
+    runner = JobRunner(max_workers=1, keep_seconds=0)
+    job_id = runner.submit(lambda: None)
+    _wait(runner, job_id)
+    runner.submit(lambda: None)
+    assert runner.get(job_id) is None
+    runner.shutdown()
@@ -1,6 +1,21 @@
+import asyncio
+import math
+
 import pytest
-from unittest.mock import MagicMock, patch
-from llmlib import OpenAIConnection, request_completion
+from unittest.mock import AsyncMock, MagicMock, patch
+from fake_openai import FakeOpenAIServer
+from llmlib import (
+    OpenAIConnection,
+    TokenUsage,
+    _read_verdict,
+    check_completion,
+    check_verdict,
+    get_connection,
+    request_completion,
+    request_completion_async,
+)
+from openai import OpenAIError
+from openai.types.chat import ChatCompletion
 
 
 @pytest.fixture()
@@ -58,6 +73,14 @@ def test_request_completion_no_usage_info(mock_openai_connection):
             request_completion(mock_openai_connection, ["a", "b"])  # not a dict
 
 
+def test_update_stats_without_usage(mock_openai_connection):
+    _completion = mock_completion()
+    _completion.usage = None
+    mock_openai_connection.update_stats(_completion)
+    assert mock_openai_connection.request_tokens == 0
+    assert mock_openai_connection.response_tokens == 0
+
+
 def test_request_completion_no_message_in_completion(
     mock_openai_connection,
     mock_messages,
@@ -86,3 +109,191 @@ def test_request_completion_no_content_in_message(
         mock_openai.return_value.chat.completions.create.return_value = _mock_completion
         with pytest.raises(ValueError, match=r"No content in completion message"):
             request_completion(mock_openai_connection, mock_messages)
+
+
+def test_request_completion_reuses_client(mock_openai_connection, mock_messages):
+    with patch("llmlib.OpenAI") as mock_openai, patch(
+        "llmlib.sanitize_messages",
+    ):
+        mock_openai.return_value.chat.completions.create.return_value = (
+            mock_completion()
+        )
+        request_completion(mock_openai_connection, mock_messages)
+        request_completion(mock_openai_connection, mock_messages)
+        assert mock_openai.call_count == 1
+        assert (
+            mock_openai.return_value.chat.completions.create.call_count == 2  # noqa: PLR2004
+        )
+
+
+def test_get_connection_is_shared():
+    _first = get_connection("shared_key", "http://localhost:1/v1/")
+    _second = get_connection("shared_key", "http://localhost:1/v1/")
+    _other = get_connection("other_key", "http://localhost:1/v1/")
+    assert _first is _second
+    assert _first is not _other
+
+
+def test_warm_up_failure_is_not_fatal(mock_openai_connection):
+    with patch("llmlib.OpenAI") as mock_openai:
+        mock_openai.return_value.models.list.side_effect = OpenAIError("down")
+        assert not mock_openai_connection.warm_up()
+
+
+def mock_chunk(content, usage=None):
+    _chunk = MagicMock()
+    _chunk.choices = [] if content is None else [MagicMock()]
+    if content is not None:
+        _chunk.choices[0].delta.content = content
+    _chunk.usage = usage
+    return _chunk
+
+
+def test_request_completion_stream(mock_openai_connection, mock_messages):
+    _usage = MagicMock(prompt_tokens=5, completion_tokens=3)
+    with patch("llmlib.OpenAI") as mock_openai, patch("llmlib.sanitize_messages"):
+        mock_openai.return_value.chat.completions.create.return_value = iter(
+            [mock_chunk("I'm "), mock_chunk("fine."), mock_chunk(None, _usage)],
+        )
+        _chunks = request_completion(
+            mock_openai_connection,
+            mock_messages,
+            stream=True,
+        )
+        assert list(_chunks) == ["I'm ", "fine."]
+        assert mock_openai_connection.request_tokens == 5  # noqa: PLR2004
+        assert mock_openai_connection.response_tokens == 3  # noqa: PLR2004
+
+
+def test_request_completion_async(mock_openai_connection, mock_messages):
+    with patch("llmlib.AsyncOpenAI") as mock_openai, patch(
+        "llmlib.sanitize_messages",
+    ):
+        mock_openai.return_value.chat.completions.create = AsyncMock(
+            return_value=mock_completion(),
+        )
+
+        async def _gather():
+            return await asyncio.gather(
+                *(
+                    request_completion_async(mock_openai_connection, mock_messages)
+                    for _ in range(3)
+                ),
+            )
+
+        assert asyncio.run(_gather()) == ["I'm fine, thank you."] * 3
+        assert mock_openai.call_count == 1
+
+
+def test_cached_tokens_are_counted():
+    messages = [
+        {"role": "system", "content": "You are an editor. " * 200},
+        {"role": "user", "content": "Please review my first essay."},
+    ]
+    usage = TokenUsage()
+    with FakeOpenAIServer(prompt_cache_min_tokens=128) as server:
+        oaiconn = OpenAIConnection("test_api_key", server.url)
+        request_completion(oaiconn, messages, usage=usage)
+        assert oaiconn.cached_tokens == 0
+
+        messages[1]["content"] = "Please review my second essay."
+        request_completion(oaiconn, messages, usage=usage)
+        oaiconn.close()
+
+    assert oaiconn.cached_tokens >= 128  # noqa: PLR2004
+    assert usage.cached_tokens == oaiconn.cached_tokens
+    assert 0 < oaiconn.prompt_cache_hit_rate < 1
+
+
+def test_truncated_completions_are_counted():
+    messages = [
+        {"role": "system", "content": "You are an editor."},
+        {"role": "user", "content": "Please review my essay."},
+    ]
+    with FakeOpenAIServer() as server:
+        oaiconn = OpenAIConnection("test_api_key", server.url)
+        request_completion(oaiconn, messages, max_tokens=5)
+        request_completion(oaiconn, messages)
+        assert "".join(request_completion(oaiconn, messages, stream=True, max_tokens=3))
+        oaiconn.close()
+
+    assert oaiconn.completions == 3  # noqa: PLR2004
+    assert oaiconn.truncated == 2  # noqa: PLR2004
+    assert oaiconn.truncation_rate == pytest.approx(2 / 3)
+
+
+def test_check_verdict_is_one_token():
+    with FakeOpenAIServer() as server:
+        oaiconn = OpenAIConnection("test_api_key", server.url)
+        verdict = check_verdict(oaiconn, "A constructive critique.")
+        assert check_completion(oaiconn, "A constructive critique.", fast=True)
+        oaiconn.close()
+
+    assert verdict.accepted
+    assert verdict.confidence == 1.0
+    assert verdict.explanation is None
+    assert server.requests == 2  # noqa: PLR2004
+    assert oaiconn.response_tokens == 2  # noqa: PLR2004
+    assert oaiconn.truncated == 0
+
+
+def test_rejected_verdict_is_explained():
+    def _reply(messages):
+        if len(messages) > 2:  # noqa: PLR2004
+            return "It rewrites the essay."
+        return "Rejected\nIt rewrites the essay."
+
+    with FakeOpenAIServer(reply=_reply) as server:
+        oaiconn = OpenAIConnection("test_api_key", server.url)
+        verdict = check_verdict(oaiconn, "A rewritten essay.")
+        oaiconn.close()
+
+    assert not verdict.accepted
+    assert verdict.explanation == "It rewrites the essay."
+    assert server.requests == 2  # noqa: PLR2004
+
+
+def test_verdict_confidence_from_logprobs():
+    def _token(token, logprob):
+        return {"token": token, "logprob": logprob, "bytes": None}
+
+    completion = ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "Rej"},
+                    "logprobs": {
+                        "content": [
+                            {
+                                **_token("Rej", -0.5),
+                                "top_logprobs": [
+                                    _token("Rej", -0.5),
+                                    _token("Accepted", -1.5),
+                                    _token("The", -3.0),
+                                    _token("A", -3.0),
+                                    _token("Re", -3.0),
+                                ],
+                            },
+                        ],
+                    },
+                    "finish_reason": "length",
+                },
+            ],
+        },
+    )
+
+    verdict = _read_verdict("Rej", completion)
+    assert not verdict.accepted
+    assert verdict.confidence == pytest.approx(1 / (1 + math.exp(-1.0)))
+
+    with pytest.raises(ValueError, match="Invalid response"):
+        _read_verdict("Maybe", completion)
+
+    for content in ("A", "Re", "The"):
+        with pytest.raises(ValueError, match="Invalid response"):
+            _read_verdict(content, completion)
@@ -1,4 +1,15 @@
-from message_parser import message_words
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+import message_parser
+from message_parser import (
+    estimate_tokens,
+    message_words,
+    split_essay,
+    split_sentences,
+)
 
 
 def test_message_words():
@@ -56,3 +67,60 @@ def test_message_words():
         "o'clock",
         ".",
     ]
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Hello, world!") == 4  # noqa: PLR2004
+    assert estimate_tokens("internationalization") == 3  # noqa: PLR2004
+    assert estimate_tokens("It's 3.5 -- ok?!") == 9  # noqa: PLR2004
+
+
+def test_import_does_not_load_nltk():
+    _code = "import sys, message_parser; print('nltk' in sys.modules)"
+    _result = subprocess.run(
+        [sys.executable, "-c", _code],  # noqa: S603
+        cwd=Path(message_parser.__file__).parent,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert _result.stdout.strip() == "False"
+    assert message_parser.warm_up() in (True, False)
+
+
+def test_split_essay_packs_paragraphs():
+    _text = "One two three.\n\nFour five six.\n\nSeven eight nine."
+    assert split_essay(_text, max_tokens=100) == [_text]
+    assert split_essay(_text, max_tokens=8) == [
+        "One two three.\n\nFour five six.",
+        "Seven eight nine.",
+    ]
+
+
+def test_split_essay_breaks_at_headings():
+    _text = "# Intro\n\nShort.\n\n## Usage\n\nAlso short."
+    assert split_essay(_text, max_tokens=100) == [_text]
+    assert split_essay(_text, max_tokens=8) == [
+        "# Intro\n\nShort.",
+        "## Usage\n\nAlso short.",
+    ]
+
+
+def test_split_sentences_without_punkt():
+    _text = "One two. Three four!  Five?"
+    with patch("nltk.tokenize.sent_tokenize", side_effect=LookupError):
+        assert split_sentences(_text) == ["One two.", "Three four!", "Five?"]
+        assert message_words("It's one. Two!") == ["It", "'s", "one", ".", "Two", "!"]
+
+
+def test_split_essay_stable_boundaries():
+    _paras = [f"Paragraph number {_n}." for _n in range(20)]
+    _chunks = split_essay("\n\n".join(_paras), max_tokens=1000, stable=True)
+    _edited = split_essay(
+        "\n\n".join(["Paragraph number zero.", *_paras[1:]]),
+        max_tokens=1000,
+        stable=True,
+    )
+    assert len(_chunks) > 1
+    assert _chunks[1:] == _edited[1:]
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+from cache import ResponseCache
+from essaylib import _cache_lookup, _count_check, build_messages
+from fake_openai import FakeOpenAIServer
+from llmlib import OpenAIConnection, request_completion
+from metrics import (
+    IN_FLIGHT,
+    REGISTRY,
+    STAGE_ERRORS,
+    STAGE_SECONDS,
+    TOKENS,
+    Registry,
+    snapshot,
+    stage,
+    to_prometheus,
+)
+
+MESSAGES = [
+    {"role": "system", "content": "You are an editor."},
+    {"role": "user", "content": "Please review my essay."},
+]
+
+
+@pytest.fixture(autouse=True)
+def _clear_registry():
+    REGISTRY.clear()
+    yield
+    REGISTRY.clear()
+
+
+def test_stage_times_and_counts_errors():
+    with stage("example"):
+        assert IN_FLIGHT.value(stage="example") == 1
+    assert IN_FLIGHT.value(stage="example") == 0
+
+    with pytest.raises(RuntimeError), stage("example"):
+        raise RuntimeError
+
+    assert STAGE_ERRORS.value(stage="example") == 1
+    assert STAGE_SECONDS.quantile(0.5, stage="example") is not None
+
+
+def test_histogram_buckets_in_prometheus_text():
+    registry = Registry()
+    histogram = registry.histogram("demo_seconds", "Demo.", ("stage",), (0.1, 1.0))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+
+    text = registry.to_prometheus()
+    assert "# TYPE demo_seconds histogram" in text
+    assert 'demo_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 'demo_seconds_bucket{stage="a",le="+Inf"} 2' in text
+    assert 'demo_seconds_count{stage="a"} 2' in text
+
+
+def test_registry_rejects_kind_change():
+    registry = Registry()
+    registry.counter("demo", "Demo.")
+    with pytest.raises(ValueError, match="already a counter"):
+        registry.gauge("demo", "Demo.")
+
+
+def test_request_and_render_are_instrumented():
+    with FakeOpenAIServer() as server:
+        oaiconn = OpenAIConnection("test_api_key", server.url)
+        request_completion(oaiconn, MESSAGES)
+
+    build_messages(
+        "An essay.",
+        {
+            "author": "a",
+            "audience": "b",
+            "essay_type": "c",
+            "tone": "d",
+        },
+    )
+
+    values = {
+        _value["labels"]["stage"]: _value
+        for _value in snapshot()["essaybuddy_stage_seconds"]["values"]
+    }
+    assert values["request_completion"]["count"] == 1
+    assert values["render"]["count"] == 1
+    assert TOKENS.value(endpoint=server.url, kind="request") == (
+        oaiconn.request_tokens
+    )
+
+
+def test_rates_in_snapshot():
+    cache = ResponseCache(db_path=None)
+    assert _cache_lookup(cache, "key") is None
+    cache.put("key", "evaluation")
+    _cache_lookup(cache, "key")
+
+    _count_check("local", passed=True)
+    _count_check("llm", passed=False)
+
+    rates = json.loads(json.dumps(snapshot()))["rates"]
+    assert rates == {
+        "cache_hit_rate": 0.5,
+        "coalesce_rate": 0.0,
+        "prompt_cache_hit_rate": 0.0,
+        "rejection_rate": 0.5,
+        "truncation_rate": 0.0,
+    }
+    assert 'essaybuddy_completion_checks_total{checker="llm",verdict="rejected"} 1' in (
+        to_prometheus()
+    )
@@ -1,5 +1,5 @@
 import pytest
-from main import validate_options
+from config import validate_options
 
 
 @pytest.fixture()
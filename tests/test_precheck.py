@@ -0,0 +1,57 @@
+import pytest
+from precheck import Prechecker, Verdict
+
+ESSAY = (
+    "Large language models are changing how we write software. They can "
+    "suggest code, explain errors and draft documentation, but they also "
+    "make mistakes that are easy to miss if you do not review their output."
+)
+
+CRITIQUE = (
+    "### Evaluation\n"
+    "1. **Clarity:** The main idea is stated early and is easy to follow.\n"
+    "2. **Organization:** The paragraph moves from benefits to risks.\n"
+    "3. **Language:** Word choice suits a general audience.\n"
+    "- Consider adding a concrete example of a mistake.\n"
+    "- A short conclusion would help the reader remember the point.\n"
+    "The tone is neutral and fits the purpose of a blog post. Overall the "
+    "piece is a solid start, and a little more detail would make it "
+    "stronger for readers who have not used these tools before."
+)
+
+
+@pytest.fixture()
+def prechecker():
+    return Prechecker(min_words=50)
+
+
+def test_accepts_clear_critique(prechecker):
+    assert prechecker.check(CRITIQUE, ESSAY) is Verdict.ACCEPT
+    assert prechecker.stats.local_accepts == 1
+
+
+def test_rejects_rewrite(prechecker):
+    _rewrite = "Here is a better version:\n\n" + ESSAY
+    assert prechecker.check(_rewrite, ESSAY) is Verdict.REJECT
+    assert prechecker.stats.local_rejects == 1
+
+
+def test_rejects_profanity(prechecker):
+    assert prechecker.check(CRITIQUE + " This is crap.", ESSAY) is Verdict.REJECT
+
+
+def test_profanity_quoted_from_essay_is_not_rejected(prechecker):
+    _essay = ESSAY + " Debugging this is crap."
+    assert prechecker.check(CRITIQUE + " Avoid 'crap'.", _essay) is not Verdict.REJECT
+
+
+def test_uncertain_without_structure(prechecker):
+    _critique = "The essay is fine. " * 20
+    assert prechecker.check(_critique, ESSAY) is Verdict.UNCERTAIN
+    assert prechecker.stats.llm_checks == 1
+
+
+def test_skip_rate(prechecker):
+    prechecker.check(CRITIQUE, ESSAY)
+    prechecker.check("Fine.", ESSAY)
+    assert prechecker.stats.skip_rate == 0.5  # noqa: PLR2004
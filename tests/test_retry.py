@@ -0,0 +1,161 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+from fake_openai import DEFAULT_CRITIQUE, FakeOpenAIServer
+from llmlib import OpenAIConnection, request_completion, request_completion_async
+from openai import BadRequestError, RateLimitError
+from retry import LatencyTracker, RetryPolicy, call_with_retries, retry_after
+
+MESSAGES = [
+    {"role": "system", "content": "You are an editor."},
+    {"role": "user", "content": "Please review my essay."},
+]
+
+
+@pytest.fixture()
+def server():
+    with FakeOpenAIServer() as _server:
+        yield _server
+
+
+def connection(server, **policy_options):
+    return OpenAIConnection(
+        "test_api_key",
+        server.url,
+        retry=RetryPolicy(**{"base_delay": 0.01, "max_delay": 0.05, **policy_options}),
+    )
+
+
+def test_retry_after_server_error(server):
+    oaiconn = connection(server)
+    server.fail_next(503, count=2)
+
+    assert request_completion(oaiconn, MESSAGES) == DEFAULT_CRITIQUE
+    assert server.requests == 3  # noqa: PLR2004
+    assert oaiconn.retry.stats.retries == 2  # noqa: PLR2004
+
+
+def test_retry_honors_retry_after(server):
+    oaiconn = connection(server, max_delay=5.0)
+    server.fail_next(429, retry_after=0.3)
+
+    _start = time.monotonic()
+    request_completion(oaiconn, MESSAGES)
+    assert time.monotonic() - _start >= 0.3  # noqa: PLR2004
+    assert server.requests == 2  # noqa: PLR2004
+
+
+def test_malformed_retry_after_falls_back_to_backoff(server):
+    def _error(value):
+        _request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+        _response = httpx.Response(
+            429,
+            headers={"retry-after": value},
+            request=_request,
+        )
+        return RateLimitError("rate limited", response=_response, body=None)
+
+    assert retry_after(_error("soon")) is None
+    assert retry_after(_error("2")) == 2.0  # noqa: PLR2004
+    _date = formatdate(time.time() + 60, usegmt=True)
+    assert 0 < retry_after(_error(_date)) <= 60  # noqa: PLR2004
+
+    oaiconn = connection(server)
+    server.fail_next(429, retry_after="soon")
+    assert request_completion(oaiconn, MESSAGES) == DEFAULT_CRITIQUE
+    assert server.requests == 2  # noqa: PLR2004
+
+
+def test_no_retry_on_client_error(server):
+    oaiconn = connection(server)
+    server.fail_next(400)
+
+    with pytest.raises(BadRequestError):
+        request_completion(oaiconn, MESSAGES)
+    assert server.requests == 1
+
+
+def test_gives_up_after_max_attempts(server):
+    oaiconn = connection(server, max_attempts=2)
+    server.fail_next(500, count=5)
+
+    with pytest.raises(Exception, match="injected 500"):
+        request_completion(oaiconn, MESSAGES)
+    assert server.requests == 2  # noqa: PLR2004
+
+
+def test_deadline_stops_retries():
+    policy = RetryPolicy(deadline=0.2)
+    policy.backoff = lambda _attempt, _error: 1.0
+
+    def _send(timeout):
+        assert timeout <= 0.2  # noqa: PLR2004
+        raise ConnectionError
+
+    policy.is_retryable = lambda _error: True
+    with pytest.raises(ConnectionError):
+        call_with_retries(_send, policy, LatencyTracker())
+    assert policy.stats.deadline_exceeded == 1
+
+
+def test_hedge_beats_slow_request(server):
+    oaiconn = connection(server, hedge=True, hedge_min_samples=1)
+    oaiconn.latency("completion", "gpt-4o").record(0.05)
+    server.delay_next(1.0)
+
+    _start = time.monotonic()
+    assert request_completion(oaiconn, MESSAGES) == DEFAULT_CRITIQUE
+    assert time.monotonic() - _start < 0.5  # noqa: PLR2004
+    assert oaiconn.retry.stats.hedges_won == 1
+
+    # The losing request's tokens are still counted once it finishes.
+    _tokens = oaiconn.request_tokens
+    _deadline = time.monotonic() + 5
+    while oaiconn.request_tokens < 2 * _tokens and time.monotonic() < _deadline:
+        time.sleep(0.05)
+    assert oaiconn.request_tokens == 2 * _tokens
+
+
+def test_hedge_async_counts_loser(server):
+    oaiconn = connection(server, hedge=True, hedge_min_samples=1)
+    oaiconn.latency("completion", "gpt-4o").record(0.05)
+    server.delay_next(1.0)
+
+    async def _run():
+        _content = await request_completion_async(oaiconn, MESSAGES)
+        _elapsed = time.monotonic() - _start
+        # The losing request's tokens are still counted once it finishes.
+        _tokens = oaiconn.request_tokens
+        _deadline = time.monotonic() + 5
+        while oaiconn.request_tokens < 2 * _tokens and time.monotonic() < _deadline:
+            await asyncio.sleep(0.05)
+        return _content, _elapsed, _tokens
+
+    _start = time.monotonic()
+    _content, _elapsed, _tokens = asyncio.run(_run())
+    assert _content == DEFAULT_CRITIQUE
+    assert _elapsed < 0.5  # noqa: PLR2004
+    assert oaiconn.retry.stats.hedges_won == 1
+    assert oaiconn.request_tokens == 2 * _tokens
+
+
+def test_hedge_delay_is_kept_by_kind(server):
+    oaiconn = connection(server, hedge=True, hedge_min_samples=1)
+    # Fast one-token verdicts do not make a completion look slow.
+    oaiconn.latency("verdict", "gpt-4o").record(0.01)
+    server.delay_next(0.2)
+
+    assert request_completion(oaiconn, MESSAGES) == DEFAULT_CRITIQUE
+    assert oaiconn.retry.stats.hedges_fired == 0
+
+
+def test_stream_retries_opening(server):
+    oaiconn = connection(server)
+    server.fail_next(502)
+
+    _text = "".join(request_completion(oaiconn, MESSAGES, stream=True))
+    assert _text == DEFAULT_CRITIQUE
+    assert server.requests == 2  # noqa: PLR2004
@@ -0,0 +1,144 @@
+import httpx
+import pytest
+from essaylib import run_request
+from fake_openai import FakeOpenAIServer
+from llmlib import OpenAIConnection
+from openai import APIConnectionError, BadRequestError
+from retry import RetryPolicy
+from routing import ModelRouter, Route
+
+OPTIONS = {
+    "author": "a",
+    "audience": "b",
+    "essay_type": "a blog post",
+    "tone": "d",
+}
+
+
+def test_candidates_follow_the_first_matching_route():
+    router = ModelRouter(
+        {
+            "evaluate": [
+                Route("small", max_tokens=50, essay_types=["a blog post"]),
+                Route("medium", max_tokens=500, fallbacks=["large"]),
+            ],
+        },
+    )
+    assert router.candidates("evaluate", "Short.", "a blog post", "large") == [
+        "small",
+        "large",
+    ]
+    assert router.candidates("evaluate", "Short.", "a README.md", "large") == [
+        "medium",
+        "large",
+    ]
+    assert router.candidates("evaluate", "word " * 1000, None, "large") == ["large"]
+    assert router.candidates("check", "Short.", None, "large") == ["large"]
+
+    with pytest.raises(ValueError, match="Unknown routing stage"):
+        ModelRouter({"render": []})
+
+
+def test_failures_fall_back_and_demote():
+    router = ModelRouter(
+        {"check": [Route("small", fallbacks=["medium"])]},
+        max_failures=2,
+    )
+    calls = []
+
+    def _send(model):
+        calls.append(model)
+        if model == "small":
+            raise APIConnectionError(request=httpx.Request("POST", "http://test"))
+        return model
+
+    assert router.call("check", "text", None, "large", _send) == "medium"
+    assert router.call("check", "text", None, "large", _send) == "medium"
+    assert calls == ["small", "medium", "small", "medium"]
+    assert router.candidates("check", "text", None, "large") == [
+        "medium",
+        "large",
+        "small",
+    ]
+    assert router.stats()["check"]["small"]["demoted"]
+
+    with pytest.raises(APIConnectionError):
+        router.call("evaluate", "text", None, "small", _send)
+
+
+def test_bad_requests_are_raised_without_demotion():
+    router = ModelRouter(
+        {"check": [Route("small", fallbacks=["medium"])]},
+        max_failures=1,
+    )
+    calls = []
+
+    def _send(model):
+        calls.append(model)
+        _request = httpx.Request("POST", "http://test")
+        _msg = "bad request"
+        raise BadRequestError(
+            _msg,
+            response=httpx.Response(400, request=_request),
+            body=None,
+        )
+
+    with pytest.raises(BadRequestError):
+        router.call("check", "text", None, "large", _send)
+
+    assert calls == ["small"]
+    assert "check" not in router.stats()
+    assert router.candidates("check", "text", None, "large")[0] == "small"
+
+
+def test_slow_models_are_demoted():
+    router = ModelRouter(
+        {"evaluate": [Route("small")]},
+        slo_seconds=0.0,
+        min_samples=2,
+    )
+    router.call("evaluate", "text", None, "large", str)
+    assert router.candidates("evaluate", "text", None, "large")[0] == "small"
+    router.call("evaluate", "text", None, "large", str)
+    assert router.candidates("evaluate", "text", None, "large") == ["large", "small"]
+
+
+def test_health_is_kept_by_stage():
+    router = ModelRouter(
+        {"evaluate": [Route("small")], "check": [Route("small")]},
+        slo_seconds=0.0,
+        min_samples=1,
+    )
+    router.call("evaluate", "text", None, "large", str)
+    assert router.candidates("evaluate", "text", None, "large")[0] == "large"
+    assert router.candidates("check", "text", None, "large")[0] == "small"
+    assert router.stats()["evaluate"]["small"]["demoted"]
+    assert "check" not in router.stats()
+
+
+def test_run_request_is_routed(monkeypatch):
+    monkeypatch.setattr("essaylib.check_completion", lambda **_kwargs: True)
+    router = ModelRouter({"evaluate": [Route("gpt-4o-mini")]})
+
+    with FakeOpenAIServer() as server:
+        oaiconn = OpenAIConnection(
+            "test_api_key",
+            server.url,
+            retry=RetryPolicy(max_attempts=1),
+        )
+        server.fail_next(503)
+        content = run_request(
+            "A short essay.",
+            essay_options=OPTIONS,
+            open_ai_key="test_api_key",
+            model="gpt-4o",
+            oaiconn=oaiconn,
+            router=router,
+        )
+        oaiconn.close()
+
+    assert content
+    assert oaiconn.model_stats["gpt-4o-mini"].failures == 1
+    assert oaiconn.model_stats["gpt-4o"].requests == 1
+    assert oaiconn.model_stats["gpt-4o"].summary()["response_tokens"] > 0
+    assert router.stats()["evaluate"]["gpt-4o-mini"]["failures"] == 1
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+from scheduler import RequestScheduler, TokenBucket, request_context
+
+
+def test_token_bucket_wait_time():
+    _bucket = TokenBucket(per_minute=60)
+    _bucket.level = 0
+    assert _bucket.wait_time(2) == pytest.approx(2.0)
+    assert _bucket.wait_time(1000) == pytest.approx(60.0)
+
+
+def test_acquire_within_budget_does_not_wait():
+    _scheduler = RequestScheduler(requests_per_minute=60, tokens_per_minute=1000)
+    assert _scheduler.acquire(100) < 0.01  # noqa: PLR2004
+    assert _scheduler.stats.granted == 1
+    assert _scheduler.stats.queue_depth == 0
+
+
+def test_acquire_times_out():
+    _scheduler = RequestScheduler(requests_per_minute=1, tokens_per_minute=1000)
+    _scheduler.acquire(10)
+    with pytest.raises(TimeoutError):
+        _scheduler.acquire(10, timeout=0.05)
+
+
+def test_settle_refunds_tokens():
+    _scheduler = RequestScheduler(tokens_per_minute=1000)
+    _scheduler.acquire(1000)
+    _scheduler.settle(estimated=1000, actual=100)
+    assert _scheduler.acquire(800, timeout=0.05) < 0.05  # noqa: PLR2004
+
+
+def test_sessions_take_turns():
+    # 6000 RPM is one request every 10ms, so the order of the queue shows.
+    _scheduler = RequestScheduler(requests_per_minute=6000, tokens_per_minute=1e9)
+    _scheduler._requests.level = 0  # noqa: SLF001
+    _order = []
+
+    def _worker(session, n):
+        with request_context(session):
+            _scheduler.acquire(1)
+            _order.append((session, n))
+
+    _threads = [
+        threading.Thread(target=_worker, args=("busy", _n)) for _n in range(3)
+    ]
+    for _thread in _threads:
+        _thread.start()
+        time.sleep(0.001)
+    _quiet = threading.Thread(target=_worker, args=("quiet", 0))
+    _quiet.start()
+    for _thread in [*_threads, _quiet]:
+        _thread.join()
+
+    assert _order.index(("quiet", 0)) <= 2  # noqa: PLR2004
+
+
+def test_priority_goes_first():
+    _scheduler = RequestScheduler(requests_per_minute=6000, tokens_per_minute=1e9)
+    _scheduler._requests.level = 0  # noqa: SLF001
+    _order = []
+
+    def _worker(session, priority):
+        with request_context(session, priority):
+            _scheduler.acquire(1)
+            _order.append(session)
+
+    _low = [
+        threading.Thread(target=_worker, args=(f"low{_n}", 0)) for _n in range(3)
+    ]
+    for _thread in _low:
+        _thread.start()
+    time.sleep(0.001)
+    _high = threading.Thread(target=_worker, args=("high", 1))
+    _high.start()
+    for _thread in [*_low, _high]:
+        _thread.join()
+
+    assert _order.index("high") <= 1
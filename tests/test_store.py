@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+from store import EssayStore, StoreWriter, apply_delta, make_delta
+
+
+@pytest.fixture()
+def store(tmp_path):
+    store = EssayStore(str(tmp_path / "essays.sqlite3"), snapshot_every=4)
+    yield store
+    store.close()
+
+
+def test_delta_round_trip():
+    old = "One.\n\nTwo.\n\nThree.\n"
+    new = "One.\n\nTwo, revised.\n\nThree.\n\nFour."
+    assert apply_delta(old, make_delta(old, new)) == new
+    assert apply_delta("", make_delta("", new)) == new
+    assert apply_delta(new, make_delta(new, "")) == ""
+
+
+def test_load_every_revision(store):
+    versions = [
+        "\n\n".join(f"Paragraph {_para} of version {_v // 3}." for _para in range(_v))
+        for _v in range(1, 12)
+    ]
+    for _expected, _content in enumerate(versions, start=1):
+        assert store.save("alice", "essay.md", _content) == _expected
+
+    assert store.load("alice", "essay.md") == versions[-1]
+    for _rev, _content in enumerate(versions, start=1):
+        assert store.load("alice", "essay.md", _rev) == _content
+    assert store.load("alice", "essay.md", 99) == versions[-1]
+    assert store.load("alice", "missing.md") is None
+
+    history = store.history("alice", "essay.md", limit=3)
+    assert [_r.rev for _r in history] == [11, 10, 9]
+    assert history[0].size == len(versions[-1])
+    older = store.history("alice", "essay.md", limit=3, before=history[-1].rev)
+    assert [_r.rev for _r in older] == [8, 7, 6]
+
+
+def test_unchanged_save_is_skipped(store):
+    assert store.save("alice", "essay.md", "Same.") == 1
+    assert store.save("alice", "essay.md", "Same.") == 1
+    assert store.save("alice", "essay.md", "Changed.") == 2  # noqa: PLR2004
+    assert len(store.history("alice", "essay.md")) == 2  # noqa: PLR2004
+
+
+def test_writer_coalesces_saves(store):
+    writer = StoreWriter(store, delay=60)
+    for _n in range(5):
+        writer.submit("alice", "essay.md", f"Draft {_n}.")
+    writer.submit("bob", "essay.md", "Bob's draft.")
+    assert writer.pending("alice", "essay.md") == "Draft 4."
+    assert store.load("alice", "essay.md") is None
+
+    assert writer.flush(timeout=5)
+    assert store.load("alice", "essay.md") == "Draft 4."
+    assert store.load("bob", "essay.md") == "Bob's draft."
+    assert len(store.history("alice", "essay.md")) == 1
+    assert writer.stats.submitted == 6  # noqa: PLR2004
+    assert writer.stats.coalesced == 4  # noqa: PLR2004
+
+    writer.submit("alice", "essay.md", "Final.")
+    writer.close(timeout=5)
+    assert store.load("alice", "essay.md") == "Final."
+
+
+def test_owners_are_separate(store):
+    store.save("alice", "essay.md", "Alice's essay.")
+    store.save("bob", "essay.md", "Bob's essay.")
+    store.save("bob", "notes.md", "Bob's notes.")
+    assert store.load("alice", "essay.md") == "Alice's essay."
+    assert store.load("bob", "essay.md") == "Bob's essay."
+    assert store.documents("alice") == ["essay.md"]
+    assert sorted(store.documents("bob")) == ["essay.md", "notes.md"]
+
+    store.set_meta("alice", "essay.md", "evaluation", "{}")
+    assert store.get_meta("alice", "essay.md", "evaluation") == "{}"
+    assert store.get_meta("bob", "essay.md", "evaluation") is None
+
+
+def test_concurrent_saves(store):
+    def _save(_writer):
+        for _n in range(10):
+            store.save("alice", "essay.md", f"Writer {_writer}, save {_n}.")
+
+    threads = [threading.Thread(target=_save, args=(_w,)) for _w in range(4)]
+    for _thread in threads:
+        _thread.start()
+    for _thread in threads:
+        _thread.join()
+
+    history = store.history("alice", "essay.md", limit=100)
+    assert [_r.rev for _r in history] == list(range(40, 0, -1))